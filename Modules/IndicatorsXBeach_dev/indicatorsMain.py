@@ -36,6 +36,8 @@
 #     it is designated in hotspotLocations.csv
 #     - workDir: Working directory. This should be the Module directory 
 #     ([Region Home]\Modules\IndicatorsXBeach).
+#     - nWorkers (optional): Number of worker processes the per-timestep exports are spread 
+#     over. Defaults to the nWorkers attribute of the hotspotForecast class.
 
 # KEY VARIABLES/INPUTS/PARAMETERS:
 #     - diagOpen.txt: A template file that FEWS populates and uses as a log file
@@ -74,6 +76,16 @@
 #     points. 
 #     - indicators\scw: Folder containing the time-dependent safe corridor width indicators, 
 #     expressed as points.
+#     - indicators_timeseries.gpkg: Only written if the postProcOutput attribute of the 
+#     hotspotForecast instance is "geopackage" or "both". A single GeoPackage holding the 
+#     bsd and scw indicator points for every timestep (layers: bsd_points, scw_points), 
+#     keyed by time in hours (time_hrs). When this mode is on, the gauges and scarps are 
+#     also read from postProcess_timeseries.gpkg in one go, instead of per timestep.
+#     - indicators_cube.nc: The building-scarp distance and safe corridor width indicators 
+#     (distances and levels) for every timestep and every corridor, along with the scarp and 
+#     extreme water line positions they were computed from, as a single netCDF file with 
+#     time and corridor dimensions (see indicatorCube.py in xbfewsTools). The indicators\bsd, 
+#     indicators\scw and GeoPackage outputs are written from it.
 #     - building-scarpDistOverall_pts.shp: Building-scarp distance indicators (i.e., dune 
 #     toe-scarp distance indicators) representing the highest indicator levels over the entire 
 #     forecast window. 
@@ -97,24 +109,30 @@ import traceback
 import os
 import sys
 import traceback
-import shutil
 
 
 def main(args=None):
 
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments from FEWS ==============#
     regionHome = str(args[0])
     sysTime = str(args[1])
     siteName = str(args[2])
     workDir = str(args[3])
+    # Number of worker processes for the exports (optional, not passed by FEWS)
+    nWorkersArg = int(args[4]) if len(args) > 4 else None
 
 
     #============== Modules ==============#
     import pickle
     from xbfewsTools import fewsUtils
     from xbfewsTools import postProcTools
+    from xbfewsTools import indicatorCube
     import geopandas as gpd
     import pandas as pd
     import numpy as np
@@ -142,6 +160,8 @@ def main(args=None):
     regionName = fcst.hotspotDF.loc[fcst.hotspotDF['ID']==siteName]['Region'][0]
     hotspotForecastDir = os.path.join(forecastDir, regionName,"hotspot",siteName)
     hotspotFcst = pickle.load(open(os.path.join(hotspotForecastDir,"forecast_hotspot.pkl"),"rb"))
+    # Number of worker processes for the per-timestep exports
+    nWorkers = nWorkersArg if nWorkersArg is not None else getattr(hotspotFcst, "nWorkers", 1)
     epsg = int(hotspotFcst.xbeachEPSG)
 
     hotspotFcst.indicatorResultsDir = os.path.join(hotspotFcst.postProcessDir,"indicators")
@@ -165,16 +185,21 @@ def main(args=None):
     corridorsShp = os.path.join(indicatorDir,"corridor_pts_50m.shp")
 
     #============== Generate diagnostics file ==============#
-    # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
-    with open(diagFile, "a") as fileObj:
-        currDir = os.getcwd()
-        fileObj.write("</Diag>")
+    # Copy and rename diagOpen.txt, and note which forecast is being processed
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
+        diag.write(3, "Computing storm impact indicators for %s, system time %s" % (siteName, sysTime))
 
 
     #============== More Paths ==============#
     gaugesDir = os.path.join(hotspotFcst.postProcessDir,"gauges\\points")
     scarpDir = os.path.join(hotspotFcst.postProcessDir,"scarp\\points")
+    # Single-file stores holding every timestep (see postProcOutput attribute
+    # of hotspotForecast)
+    postProcStore = os.path.join(hotspotFcst.postProcessDir,"postProcess_timeseries.gpkg")
+    indicatorStore = os.path.join(hotspotFcst.indicatorResultsDir,"indicators_timeseries.gpkg")
+    writeShp = hotspotFcst.postProcOutput in ["shapefile", "both"]
+    writeStore = hotspotFcst.postProcOutput in ["geopackage", "both"]
+    storeLayers = {"bsd_points":[], "scw_points":[]}
 
 
     #============== Load key files ==============#
@@ -231,82 +256,60 @@ def main(args=None):
     # Then express as hours because time is expressed as hours in files
     tseries_hrs = np.divide(tseries,3600.)
 
-    ############################### Compute the building-scarp distance indicator ###############################
-    # Timestep in hours
-    for t_step in tseries_hrs:
-        tstep_hrs_str = f'{(t_step):.2f}'.zfill(6)
-        if t_step % 5 == 0:
-            print("Processing BSD for time: %s hrs" % t_step)
-        fname = "scarp_%shrs_points.shp" % tstep_hrs_str
-        fPath = os.path.join(scarpDir,fname)
-        # Be careful here - the "try" logic here could conceal bugs
-        # This could potentially just assign everything as being "Low" risk
-        try:
-            scarp_gdf = gpd.read_file(fPath)
-            # Merge the scarp_gdf with the plots_gdf
-            # This ensures the correct points are being compared with one another
-            scarp_gdf = scarp_gdf.merge(plots_gdf, how="inner", on="rowInd")
-            # Re-name geometry columns
-            # Regular "geometry" column contain the scarp locations
-            # "geometry_plots" contains locations of where the indicator is being
-            # measured from. Before, it was the locations of plots of land.
-            # In this version, it is from the dune toe. So in this version, 
-            # "geometry_plots" contains the dune toe geometries at every row in
-            # the XBeach grid.
-            scarp_gdf = scarp_gdf.rename(columns={"geometry_x":"geometry",
-                                                  "geometry_y":"geometry_plots"})
-            scarp_gdf = gpd.GeoDataFrame(scarp_gdf, geometry=scarp_gdf.geometry)
-            scarp_gdf['bsd_dist'] = scarp_gdf.geometry_plots.apply(lambda g: scarp_gdf.distance(g).min())
-            scarp_gdf['BSD'] = postProcTools.compute_bsd(scarp_gdf['bsd_dist'])
-            # Remove the "geometry_plots" field so file can be exported
-            scarp_gdf = scarp_gdf.drop(columns='geometry_plots',axis=1)
-            scarp_gdf = scarp_gdf.set_crs(epsg=epsg)
-        except:
-            pass
-
-        # Export these as points
-        ofileName = "bsd_%shrs.shp" % tstep_hrs_str
-        try:
-            scarp_gdf.to_file(os.path.join(bsdDirPts,ofileName))
-        except:
-            pass
-    
-    # Compute overall BSD indicator for the entire forecast
-    if scarpOverall_gdf is not None: # A scarp might not be detected
-        # Convert column to integer
-        scarpOverall_gdf = scarpOverall_gdf.astype({"rowInd": int})
-        # Compute distance between each building plot and the scarp line
-        scarpOverall_gdf= scarpOverall_gdf.merge(plots_gdf, how="inner", on="rowInd")
-        scarpOverall_gdf = scarpOverall_gdf.rename(columns={"geometry_x":"geometry",
-                                                  "geometry_y":"geometry_plots"})
-        scarpOverall_gdf = gpd.GeoDataFrame(scarpOverall_gdf, geometry=scarpOverall_gdf.geometry)
-        scarpOverall_gdf['bsd_dist'] = scarpOverall_gdf.geometry_plots.apply(lambda g: scarpOverall_gdf.distance(g).min())
-        scarpOverall_gdf['BSD'] = postProcTools.compute_bsd(scarpOverall_gdf['bsd_dist'])
-        scarpOverall_gdf = scarpOverall_gdf.drop(columns="geometry_plots", axis=1)
+    #============== Load the gauges and scarps of every timestep ==============#
+    # The extreme water line and erosion scarp positions of the whole forecast are
+    # loaded at once as (time x row) arrays. If post-processing wrote the GeoPackage
+    # store, each layer is read in one go, otherwise the per-timestep shapefiles are
+    # read in.
+    nRows = len(corridors_gdf)
+    if writeStore and os.path.exists(postProcStore):
+        scarpPts = postProcTools.readTimeseriesStore(storePath=postProcStore, layer="scarp_points")
+        gaugePts = postProcTools.readTimeseriesStore(storePath=postProcStore, layer="gauges_points")
     else:
-        plots_gdf["BSD"] = "Low"
-        scarpOverall_gdf = plots_gdf
+        scarpPts = indicatorCube.readTimestepPoints(fDir=scarpDir, fName="scarp_%shrs_points.shp", times=tseries_hrs)
+        gaugePts = indicatorCube.readTimestepPoints(fDir=gaugesDir, fName="gauges_%shrs_points.shp", times=tseries_hrs)
+    scarpX, scarpY = indicatorCube.pointsToArrays(points=scarpPts, times=tseries_hrs, nRows=nRows)
+    ewlX, ewlY = indicatorCube.pointsToArrays(points=gaugePts, times=tseries_hrs, nRows=nRows)
+    # Over the whole forecast
+    scarpMaxX, scarpMaxY = None, None
+    if scarpOverall_gdf is not None: # A scarp might not be detected
+        scarpOverall_gdf = scarpOverall_gdf.astype({"rowInd": int}).assign(time_hrs=0.)
+        scarpMaxX, scarpMaxY = indicatorCube.pointsToArrays(points=scarpOverall_gdf, times=[0.], nRows=nRows)
+        scarpMaxX, scarpMaxY = scarpMaxX[0], scarpMaxY[0]
+
+
+    ############################### Compute the indicators ###############################
+    # Building-scarp distance (dune toe to the nearest scarp point) and safe corridor
+    # width (corridor to the nearest point of the extreme water line), for every 
+    # timestep and every row at once. See indicatorCube.py in xbfewsTools.
+    print("Computing BSD and SCW indicators...")
+    cube = indicatorCube.computeIndicators(times=tseries_hrs,
+                                           toeX=plots_gdf.geometry.x.values, toeY=plots_gdf.geometry.y.values,
+                                           corridorX=corridors_gdf.geometry.x.values, corridorY=corridors_gdf.geometry.y.values,
+                                           scarpX=scarpX, scarpY=scarpY, ewlX=ewlX, ewlY=ewlY,
+                                           scarpMaxX=scarpMaxX, scarpMaxY=scarpMaxY,
+                                           ewlMaxX=ewlOverall.geometry.x.values, ewlMaxY=ewlOverall.geometry.y.values,
+                                           epsg=epsg)
+    # Save the whole time series of the indicators as a single file
+    indicatorCube.saveCube(ds=cube, ofile=os.path.join(hotspotFcst.indicatorResultsDir, indicatorCube.cubeFileName))
+
+    # Indicators over the entire forecast
+    scarpOverall_gdf, ewlOverall = indicatorCube.overallPoints(ds=cube, plots_gdf=plots_gdf, epsg=epsg)
     scarpOverall_gdf.to_file(os.path.join(hotspotFcst.indicatorResultsDir, "building-scarpDistOverall_pts.shp"))
-
-    ############################### Compute the safe corridor width indicator ###############################
-    for t_step in tseries_hrs:
-        tstep_hrs_str = f'{(t_step):.2f}'.zfill(6)
-        if t_step % 5 == 0:
-            print("Processing SCW for time: %s hrs" % t_step)
-        fname = "gauges_%shrs_points.shp" % tstep_hrs_str
-        fPath = os.path.join(gaugesDir,fname)
-        ewl_gdf = gpd.read_file(fPath)
-        # Compute distances between ewl and corridors at timestep
-        ewl_gdf['ewl_dist'] = corridors_gdf.geometry.apply(lambda g: ewl_gdf.distance(g).min())
-        ewl_gdf['SCW'] = postProcTools.compute_scw(ewlDistSeries=ewl_gdf['ewl_dist'])
-        # export to a file
-        ewl_gdf.to_file(os.path.join(scwDirPts,"scw_%shrs.shp" % (tstep_hrs_str)))
-
-    # Compute the distance between each corridor section and the extreme water line
-    ewlOverall['ewl_dist'] = ewlOverall.geometry.apply(lambda g: corridors_gdf.distance(g).min())
-    ewlOverall['SCW'] = postProcTools.compute_scw(ewlOverall['ewl_dist'])
     ewlOverall.to_file(os.path.join(hotspotFcst.indicatorResultsDir, "safe-corridorOverall_pts.shp"))
 
+    #============== Export the indicators at each timestep ==============#
+    # Shapefiles (which FEWS reads) and/or the GeoPackage store, depending on the
+    # postProcOutput attribute of the hotspot forecast. The timesteps are spread over
+    # nWorkers worker processes.
+    indicatorCube.writeTimestepPoints(ds=cube, plots_gdf=plots_gdf,
+                                      bsdDir=bsdDirPts if writeShp else None,
+                                      scwDir=scwDirPts if writeShp else None,
+                                      store=storeLayers if writeStore else None, epsg=epsg,
+                                      nWorkers=nWorkers)
+    if writeStore:
+        postProcTools.writeTimeseriesStore(layers=storeLayers, storePath=indicatorStore, epsg=epsg)
+
 ## If Python throws an error, send to exceptions.log file
 if __name__ == "__main__":
     try:
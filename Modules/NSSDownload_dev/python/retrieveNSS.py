@@ -15,7 +15,11 @@
 #     - Parses the correct BoM file name to fetch using the system time
 #     - Determines the correct location to download the BoM file from (either the BoM server or the 
 #     WRL1 Coastal folder)
-#     - Fetches the file and downloads it to a local directory
+#     - Fetches the file into the local download cache ([Region Home]\Cache\BoM, see 
+#     downloadCache.py in xbfewsTools), unless it is already there, and links it into a 
+#     local directory
+#     - Extracts the points needed by the hotspots and the regional profiles into a small
+#     subset of the file, which the pre-processing modules read instead of the full file
 #     - Writes out diagnostics
 #     - Updates the original pickle file
 
@@ -43,6 +47,10 @@
 #     console) 
 #     - IDZ00154_StormSurge_national_YYMMDDHH.nc: The BoM National Storm Surge System forecast file 
 #     that the script fetches and sends to [Region Home]\ Modules\NSSDownload\ncFiles
+#     - IDZ00154_StormSurge_national_YYMMDDHH_subset.nc: The points on the NSS mesh closest to 
+#     the surge points in hotspotLocations.csv and to the nss_lon/nss_lat points of the regional 
+#     profiles ([Region Home]\Data\CoastSat\[region]\regionalTransects_[region].shp), in 
+#     [Region Home]\Modules\NSSDownload\ncFiles
 #     - forecast.pkl: Updated pickle file for the instance of the fewsForecast class. 
 
 
@@ -59,14 +67,16 @@ import os
 import re
 from datetime import datetime
 import traceback
-import shutil
-import wget
 
 
 def main(args=None):
 
     ############ Arguments for this script ############ 
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments from FEWS ==============#
     # Arguments parsed from RetrieveNSSAdapter.xml if using FEWS
@@ -83,6 +93,10 @@ def main(args=None):
 
     # ========== More Modules ========== #
     from xbfewsTools import fewsForecast, fewsUtils
+    from xbfewsTools import downloadCache
+    from xbfewsTools import preProcWatLevs
+    import pandas as pd
+    import geopandas as gpd
     import pickle
 
 
@@ -96,6 +110,10 @@ def main(args=None):
     # Location of the BoM server where storm surge forecasts are held
     # To view in browser: http://opendap.bom.gov.au:8080/thredds/catalog/surge/forecast/RnD/catalog.html
     serverLoc = "http://opendap.bom.gov.au:8080/thredds/fileServer/surge/forecast/RnD/"
+    # Local cache of downloaded forecast files, shared with the WaveDownload module,
+    # and its maximum size (GB)
+    cacheDir = os.path.join(regionHome,"Cache\\BoM")
+    cacheSizeGB = 20
 
 
     #============== Parse system time and find directory of current forecast ==============#
@@ -122,20 +140,18 @@ def main(args=None):
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
     # Write to diagnostics file
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3,
+        diag.write(3,
             "Command-line arguments sent to python script from FEWS: %s" 
-            % (str(args)) ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"Current directory: %s" %currDir))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Current system time: %s \n" % systemTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Rounding system time down to: % s \n" % roundedTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Destination directory: % s \n" % workDir))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Downloading file: % s \n" %fname))
-        fileObj.write(fewsUtils.write2DiagFile(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory."))
-        fileObj.write("</Diag>")
+            % (str(args)))
+        diag.write(3,"Current directory: %s" %currDir)
+        diag.write(3, "Current system time: %s \n" % systemTime)
+        diag.write(3, "Rounding system time down to: % s \n" % roundedTime)
+        diag.write(3, "Destination directory: % s \n" % workDir)
+        diag.write(3, "Downloading file: % s \n" %fname)
+        diag.write(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory.")
 
 
     #============== Logic for forecast v hindcast ==============#
@@ -151,23 +167,39 @@ def main(args=None):
     
 
     #============== Fetch file from server  ==============#
+    # In forecast mode the file is downloaded from the BoM server, and in hindcast
+    # mode it is copied from the directory where files are stored long-term (WRL1),
+    # or locally. Either way it goes through the local download cache, so it is
+    # only fetched once, and is then linked into the local download directory.
     url = os.path.join(serverLoc,fname)
     # Local directory where file will be downloaded
     downloadDir = os.path.join(workDir,"ncFiles")
-    # Make local download directory if it doesn't exist
-    if not os.path.exists(downloadDir):
-        os.makedirs(downloadDir)
-    # If it's in forecast mode, download from BoM server
-    if fcst.mode == "forecast":
-        bomFile = wget.download(url, out=downloadDir)
-    # Or else if it's in hindcast mode, download from other directory where
-    # files are stored long-term (WRL1), or locally
-    elif fcst.mode == "hindcast":
-        shutil.copy(url,downloadDir)
+    cache = downloadCache.downloadCache(cacheDir=cacheDir, maxSizeGB=cacheSizeGB)
+    bomFile = cache.fetchTo(product="NSS", issueTime=bomDT, source=url, outDir=downloadDir)
+
+
+    #============== Subset the points needed ==============#
+    # Extract the points on the NSS mesh needed by the hotspots (hotspotLocations.csv)
+    # and the regional profiles (regionalTransects_[region].shp) into a small file next
+    # to the national forecast, which the pre-processing modules read instead (see
+    # preProcWatLevs.subsetNSS in xbfewsTools)
+    subsetLon = list(fcst.hotspotDF['Lon_surge'].values)
+    subsetLat = list(fcst.hotspotDF['Lat_surge'].values)
+    regions = pd.read_csv(os.path.join(regionHome,"Config\\MapLayerFiles\\ausStates.csv"))['ID'].unique()
+    for region in regions:
+        transectsFile = os.path.join(regionHome,"Data","CoastSat",region,"regionalTransects_%s.shp" % region)
+        if os.path.exists(transectsFile):
+            transects = gpd.read_file(transectsFile, ignore_geometry=True)
+            subsetLon += list(transects['nss_lon'].values)
+            subsetLat += list(transects['nss_lat'].values)
+    preProcWatLevs.subsetNSS(ifile=bomFile, lon=subsetLon, lat=subsetLat,
+                             cacheDir=os.path.join(workDir,"meshIndex"))
 
     
     #=========== Write fewsForecast instance out to updated pickle file ===========#
-    with open(os.path.join(fcst.forecastDir,"forecast.pkl"), "wb") as output:
+    # The WaveDownload module may be reading it at the same time (see run_forecast_loop.py)
+    picklePath = os.path.join(fcst.forecastDir,"forecast.pkl")
+    with fewsUtils.atomicWrite(picklePath, "wb") as output:
             pickle.dump(fcst, output, pickle.HIGHEST_PROTOCOL)
 
 
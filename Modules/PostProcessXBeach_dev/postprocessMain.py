@@ -12,7 +12,8 @@
 #     class
 #     - Loads the relevant pickle file containing the object instance of the hotspotForecast 
 #     class
-#     - Copies over the XBeach run to the main forecast directory in [Region Home]\Forecasts
+#     - Hands the XBeach run back to the main forecast directory in [Region Home]\Forecasts
+#     (hard-linked rather than copied, see runHandoff.py in xbfewsTools)
 #     - Processes and exports the extreme water line over each time step, and determines the 
 #     extreme water line over the entire simulation 
 #     - Processes and exports the erosion scarps over each time step, and determines the 
@@ -32,6 +33,8 @@
 #     it is designated in hotspotLocations.csv
 #     - workDir: Working directory. This should be the Module directory 
 #     ([Region Home]\Modules\PostProcessXBeach).
+#     - nWorkers (optional): Number of worker processes the per-timestep exports are spread 
+#     over. Defaults to the nWorkers attribute of the hotspotForecast class.
 
 # KEY VARIABLES/INPUTS/PARAMETERS
 #     - diagOpen.txt: A template file that FEWS populates and uses as a log file
@@ -40,14 +43,29 @@
 #     - forecast_hotspot.pkl: The pickle file that stores all the attributes of the instance 
 #     of the hotspotForecast class
 #     - xboutput.nc: XBeach output netCDF file. 
+#     - postProcState.pkl: The XBeach output read while XBeach was running, if 
+#     tailXBeachOutput.py was run alongside XBeach (in the XBeach run directory). If it is 
+#     there, and was made from the xboutput.nc being post-processed (same size, 
+#     modification time and number of records), the results are taken from it rather 
+#     than reading xboutput.nc again.
 #     - Erosion scarp threshold: This is the erosion threshold where the maximum landward 
-#     erosion lines (i.e. the scarps) are delineated. Currently, this is set to 0.5 m. 
+#     erosion lines (i.e. the scarps) are delineated. Currently, this is set to 0.5 m 
+#     (scarpThreshold attribute of the hotspotForecast class, see fewsForecast.py). 
+#     - Number of worker processes: The per-timestep gauge and scarp exports are spread over 
+#     a pool of worker processes (nWorkers argument, or the nWorkers attribute of the 
+#     hotspotForecast class, see fewsForecast.py). By default, only one process is used.
 
 # KEY OUTPUTS:
 #     - diag.xml: The resulting diagnostic file that FEWS populates and uses (i.e. prints to 
 #     its console) 
 #     - gauges\: Folder containing positions of the extreme water line at each timestep, 
 #     given both as point and line shapefiles.
+#     - postProcess_timeseries.gpkg: Only written if the postProcOutput attribute of the 
+#     hotspotForecast instance is "geopackage" or "both". A single GeoPackage holding the 
+#     gauges and scarp points and lines for every timestep (layers: gauges_points, 
+#     gauges_lines, scarp_points, scarp_lines), keyed by time in hours (time_hrs) and row 
+#     index (rowInd). The gauges\ and scarp\ folders are only written if postProcOutput is 
+#     "shapefile" (the default, read by FEWS) or "both".
 #     - ewl_XBeach_points.shp: Maximum extreme water line over the course of the entire 
 #     XBeach simulation, in points
 #     - ewl_XBeach.shp: Maximum extreme water line over the course of the entire XBeach 
@@ -76,13 +94,16 @@
 import os
 import sys
 import traceback
-import shutil
 
 
 def main(args=None):
 
     #============== Parse arguments from FEWS ==============#
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
     # Region home
     regionHome = str(args[0])
     # System time according to FEWS
@@ -91,6 +112,8 @@ def main(args=None):
     siteName = str(args[2])
     # Path to Region Home, defined in global properties file
     workDir = str(args[3])
+    # Number of worker processes for the exports (optional, not passed by FEWS)
+    nWorkersArg = int(args[4]) if len(args) > 4 else None
 
 
     #============== Modules ==============#
@@ -101,8 +124,9 @@ def main(args=None):
     from xbfewsTools import fewsUtils
     import geopandas as gpd
     from shapely.geometry import Point, LineString, shape
-    import xarray as xr
     from xbfewsTools import postProcTools
+    from xbfewsTools import incrementalPostProc
+    from xbfewsTools import runHandoff
     import numpy as np
     import pandas as pd
 
@@ -137,17 +161,17 @@ def main(args=None):
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3, "Post-processing hotspot run: %s" % fcstHotspot.runName))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Forecast for time period starting at: %s" % fcstHotspot.roundedTime))
-        fileObj.write("</Diag>")
+        diag.write(3, "Post-processing hotspot run: %s" % fcstHotspot.runName)
+        diag.write(3, "Forecast for time period starting at: %s" % fcstHotspot.roundedTime)
 
 
-    #============== Copy over contents of run directory for post-processing ==============#
-    from distutils.dir_util import copy_tree
-    copy_tree(fcstHotspot.moduleDir,fcstHotspot.xbWorkDir)
+    #============== Hand the contents of the run directory back for post-processing ==============#
+    # Hard-linked, so xboutput.nc isn't copied. Files XBeach wrote are recorded as
+    # owned by "XBeach" in handoffManifest.json in the forecast directory.
+    runHandoff.handoffDir(srcDir=fcstHotspot.moduleDir, dstDir=fcstHotspot.xbWorkDir,
+                          owner="XBeach", replace=False)
 
 
     #============== Create and designate some new paths ==============#
@@ -177,103 +201,83 @@ def main(args=None):
         os.makedirs(scarpDirLines)
 
 
-    ################ Load XBeach output ################
-    ds = xr.open_dataset(ncOut)
-
-
     #============== Re-load hotspot forecast object with pickle ==============#
     # Read it now from original forecast directory
     fcstHotspot = pickle.load(open(os.path.join(fcstHotspot.forecastDir,"forecast_hotspot.pkl"), "rb"))
+    # Number of worker processes for the per-timestep exports
+    nWorkers = nWorkersArg if nWorkersArg is not None else getattr(fcstHotspot, "nWorkers", 1)
     # Caluclate the total run time, including spin-up time
     fcstHotspot.totalRunTime = fcstHotspot.endTime - fcstHotspot.startTime
     # Set epsg (projection of grid used in XBeach run)
     epsg = int(fcstHotspot.xbeachEPSG)
     fcstHotspot.postProcessDir = os.path.join(fcstHotspot.xbWorkDir,"postProcess")
+    # Output format for the per-timestep gauges and scarps. Shapefiles are what
+    # FEWS reads; the GeoPackage store holds every timestep in a single file.
+    writeShp = fcstHotspot.postProcOutput in ["shapefile", "both"]
+    writeStore = fcstHotspot.postProcOutput in ["geopackage", "both"]
+    storePath = os.path.join(fcstHotspot.postProcessDir,"postProcess_timeseries.gpkg")
+    # Per-timestep GeoDataFrames for each layer of the GeoPackage store
+    storeLayers = {"gauges_points":[], "gauges_lines":[],
+                   "scarp_points":[], "scarp_lines":[]}
+
+
+    ################ Read XBeach output ################
+    # The XBeach output is reduced to the gauge positions, erosion scarps and maximum
+    # grids by an xbPostProcState (see incrementalPostProc.py in xbfewsTools). If the
+    # output was already read while XBeach was running (tailXBeachOutput.py), the saved
+    # state is loaded, so long as it was made from this output file. Otherwise (e.g. a 
+    # state left over from an earlier XBeach run), the whole output file is read here.
+    statePath = os.path.join(fcstHotspot.moduleDir, incrementalPostProc.stateFileName)
+    xbState = incrementalPostProc.loadState(statePath, ncFile=ncOut)
+    if xbState is None:
+        xbState = incrementalPostProc.xbPostProcState(morstart=fcstHotspot.morstart,
+                                                      totalRunTime=fcstHotspot.totalRunTime.total_seconds(),
+                                                      scarpThreshold=fcstHotspot.scarpThreshold)
+    if not xbState.finished:
+        xbState.update(ncFile=ncOut, final=True)
+    globalx = xbState.globalx
+    globaly = xbState.globaly
     
 
     ################################# Process extreme water line #################################
-    #========== Remove dummy point from gauges output ==========#
-    # The dummy point is there because XBeach complains if it isn't
-    dummyPt = Point(fcstHotspot.dummyPtX,fcstHotspot.dummyPtY)
-    # Convert xarray ds to geodataframe to do point searching
-    dsSearch = ds[['point_xz', 'point_yz', 'point_zs']]
-    xbgdf = dsSearch.to_dataframe()
-    xbgdf = gpd.GeoDataFrame(xbgdf, geometry=gpd.points_from_xy(xbgdf.point_xz,xbgdf.point_yz))
-    xbgdf.set_crs(epsg)
-    # unary union of the geomtries 
-    pts = xbgdf.geometry.unary_union
-    ptIndex = postProcTools.nearGeom(dummyPt, pts=pts, gdfIn=xbgdf, outVar="index")[0]
-    # Remove dummy pt from dataset
-    ds = ds.drop_sel(points=0)
-    #========== Loop through, export points and lines for Extreme water line ==========#
-    # Keep track of the column indeces of the extreme water line over the coarse of the
-    # entire run
-    colIndecesTotalRun = []
-    # Keep track of the column indeces of the extreme water line for each time step
-    colIndeces = []
-    # Loop through each time step for the "pointtime" output
+    #========== Locate the extreme water line at each gauge time step ==========#
     # The gauges in XBeach export separate output that abides by a different
-    # timestep to provide higher temporal resolution.
-    for d in np.arange(0,ds["pointtime"].sizes["pointtime"],1):
-        if d % 100 == 0:    
-            print("Processing time step %s" % d)
-        time= ds["pointtime"][d].values
-        time_str = f'{(time/3600):.2f}'.zfill(6)
-        # Subset the dataset by point time steps
-        ds_sub = ds.isel({"pointtime":d})
-        colIndex = []
-        yind = 0
-        # For each time step slice, loop through each row and locate the
-        # x (column) index of the point that is neareest to where the gauge is
-        # The gauges move with the water line in XBeach, so we are essentially
-        # fetching the location of the water line for each row
-        for searchX in ds_sub['point_xz'].values:
-            xx = ds.globalx[yind,:].values
-            # Find point that is closest to gauge's x value
-            landwardx = min(xx, key= lambda x:abs(x-searchX))
-            # Return x index of this point
-            landwardColInd = np.where(xx==landwardx)[0][0]
-            # Append this point to the collection of points specific to the time step
-            colIndex.append(landwardColInd)
-            yind += 1
-        colIndeces.append(colIndex)
-        colIndecesTotalRun.append(colIndex)
-        if time % 900 == 0: # Exports every 15 min (900 sec)
-            dff = pd.DataFrame(colIndeces)
-            # Return maximum value for each column over the 15 min interval
-            colIndeces = dff.max().values
-            # Loop through these values and return the x and y locations as shapely points
-            maxWaterLine = []
-            yind = 0
-            # Find the relevant x and y values for these max landward gauge points
-            for searchI in colIndeces:
-                xpt = ds.globalx[yind,:][searchI]
-                ypt = ds.globaly[:,searchI][yind]
-                point = Point(xpt,ypt)
-                maxWaterLine.append(point)
-                yind += 1
-            # Export max water line as GeoSeries, convert a line shapefile
-            gdf1 = gpd.GeoSeries(maxWaterLine,crs=epsg)
-            gdf1.to_file(os.path.join(gaugesDirPts,"gauges_%shrs_points.shp" % time_str))
-            gdf2 = gpd.GeoSeries(LineString(maxWaterLine),crs=epsg)
-            gdf2.to_file(os.path.join(gaugesDirLines,"gauges_%shrs_lines.shp" % time_str))
-            # Reset the column indeces for the next 15 minute interval
-            colIndeces = []
+    # timestep to provide higher temporal resolution. The gauges move with the
+    # water line in XBeach, so for every row and every "pointtime" step we fetch
+    # the x (column) index of the grid point that is nearest to the gauge, i.e.
+    # the location of the water line. The first gauge is a dummy point that is
+    # there because XBeach complains if it isn't, and is left out. 
+    # See xbPostProcState.update
+    pointTimes = xbState.pointTimes
+    colIndeces = xbState.colIndeces
+    # Row indeces, used to look up the x and y locations of the column indeces
+    rowIndeces = np.arange(0,globalx.shape[0])
+    #========== Export points and lines for Extreme water line every 15 min ==========#
+    # Return maximum column index for each row over each 15 min (900 sec) interval
+    exportTimes, colIndecesMax = postProcTools.intervalMaxima(colIndeces=colIndeces,
+                                                              times=pointTimes,
+                                                              interval=900)
+    # Each export time is written out independently of the others, so the export
+    # times are spread over a pool of worker processes (see postProcTools.mapTimesteps)
+    gaugeShared = {"globalx":globalx, "globaly":globaly, "rowIndeces":rowIndeces,
+                   "exportTimes":exportTimes, "colIndecesMax":colIndecesMax, "epsg":epsg,
+                   "gaugesDirPts":gaugesDirPts, "gaugesDirLines":gaugesDirLines,
+                   "writeShp":writeShp, "writeStore":writeStore}
+    gaugeResults = postProcTools.mapTimesteps(func=postProcTools.exportGaugeTimesteps,
+                                              nTimesteps=len(exportTimes), shared=gaugeShared,
+                                              nWorkers=nWorkers)
+    if writeStore:
+        for gdfPts, gdfLine in gaugeResults:
+            storeLayers["gauges_points"].append(gdfPts)
+            storeLayers["gauges_lines"].append(gdfLine)
     #========== Determine overall extreme water line from XBeach output ==========#
     # This represents the line where the water was most landward over the entire
     # simulation (i.e. the maximum extreme water line)
-    dff = pd.DataFrame(colIndecesTotalRun)
-    # Return maximum value for each column
-    colIndecesTotalRun = dff.max().values
-    # Loop through these values and return the x and y locations as shapely points
-    maxWaterLine = []
-    yind = 0
-    for searchI in colIndecesTotalRun:
-        xpt = ds.globalx[yind,:][searchI]
-        ypt = ds.globaly[:,searchI][yind]
-        point = Point(xpt,ypt)
-        maxWaterLine.append(point)
-        yind += 1
+    # Return maximum column index for each row
+    colIndecesTotalRun = colIndeces.max(axis=0)
+    # Return the x and y locations as shapely points
+    maxWaterLine = [Point(xpt,ypt) for xpt, ypt in zip(globalx[rowIndeces,colIndecesTotalRun],
+                                                       globaly[rowIndeces,colIndecesTotalRun])]
     # Export max water line as GeoSeries, convert a line shapefile
     gdf3 = gpd.GeoSeries(maxWaterLine,crs=epsg)
     gdf3.to_file(os.path.join(fcstHotspot.postProcessDir,"ewl_XBeach_points.shp"))
@@ -292,126 +296,61 @@ def main(args=None):
         # erosion scarp. Correct index is the spinUp interval divided by the timestep 
         # Starts one of the first timesteps after the rounded time because of initial slumping creating artefacts in erosion scarp lines
         roundedTimeIndex = int((fcstHotspot.roundedTime - fcstHotspot.startTime).seconds/fcstHotspot.tintm)
-        dtout = (ds.meantime[1]-ds.meantime[0]).values
-        eroStartIndex = int(fcstHotspot.morstart/dtout)+1
-        ds_zbi = ds.isel({"globaltime":eroStartIndex})
-        # Initialize dataframe
-        df = pd.DataFrame(columns=["timeStepMins","xScarp", 
-                                "yScarp","rowInd",
-                                "colIndexScarp"])
-        # Loop through each time step of the XBeach output
-        for timestep in np.arange(eroStartIndex+2,ds["globaltime"].sizes["globaltime"],1):
-            # Let the user know how post-processing is progressing
-            if timestep == roundedTimeIndex:
-                print("Starting at timestep %s " % roundedTimeIndex)
-            if timestep % 10 == 0: 
-                print("Processing time step %s" % timestep)
-            # Convert timestep to appropriate string for saving the files
-            tstep_hrs = round((timestep*fcstHotspot.tintm),2)/3600
-            tstring = f'{tstep_hrs:.2f}'.zfill(6)
-            # Initialize timestep dataframe
-            dftstep = pd.DataFrame(columns=["xWater","yWater",
-                                        "xScarp", "yScarp"])
-            # Splice the dataset at the given timestep
-            dsstep = ds.isel({"globaltime":timestep}) # global time and mean time not the same
-            # Find the erosion scarp at each row of the XBeach grid, at each time step
-            for index in np.arange(0,len(ds.globaly[:,0]),1):
-                # Access initial elevation along each row
-                elev_i = ds_zbi.zb[index,:].values
-                # Access elevation at time step along each row (cross-shore, x points)
-                elevations = dsstep.zb[index,:].values
-                # Compute the change in elevation from the start of simulation
-                deltaz = elev_i - elevations
-                # Evalute whether change in elevation surpasses 0.1 m 
-                elev_bool = deltaz > 0.5
-                # Sometimes we won't get a scarp and that's fine
-                try:
-                    maxIndex2 = np.max(np.where(elev_bool))
-                    # Get point x,y point locations for the erosion scarp in each row
-                    xScarp = dsstep.globalx[index,maxIndex2].values
-                    yScarp = dsstep.globaly[index,maxIndex2].values 
-                    ######### Append information to main dataframe ######### 
-                    data = {"timeStepHrs":[tstep_hrs],
-                            "xScarp":[xScarp],"yScarp":[yScarp],
-                            "rowInd":[index],
-                            "colIndexScarp":[maxIndex2]}
-                    dftmp = pd.DataFrame(data)
-                    df = df.append(dftmp)
-                    ######### Append information to time step's dataframe ######### 
-                    dftstep = dftstep.append(dftmp)
-                except:
-                    pass         
-            # Export point shapefile for erosion scarp
-            # We won't always get a scarp, so we "try" to export the file
-            try:
-                gdf1 = gpd.GeoDataFrame(dftstep, geometry=gpd.points_from_xy(dftstep.xScarp, dftstep.yScarp), crs=epsg)
-                gdf1 = gdf1[["geometry","rowInd"]]
-                gdf1.to_file(os.path.join(scarpDirPts,"scarp_%shrs_points.shp" % tstring))
-            except:
-                pass
-            # You might not always have enough points to make a line, so we "try"
-            # exporting as a line
-            try:
-                # Export line shapefile for erosion scarp 
-                gdf2 = gpd.GeoDataFrame(dftstep, geometry=gpd.points_from_xy(dftstep.xScarp, dftstep.yScarp), crs=epsg)
-                gdf2 = gdf2[["geometry","rowInd"]]
-                gdf2 = gpd.GeoSeries(LineString(gdf2.geometry.tolist()),crs=epsg)
-                gdf2.to_file(os.path.join(scarpDirLines,"scarp_%shrs.shp" % tstring))
-            except:
-                pass
+        # The erosion scarp in every row of the XBeach grid, for every time step from
+        # just after morphology is switched on. The scarp is the most landward cell where 
+        # the bed has dropped by more than the threshold (hotspotForecast attribute) since 
+        # morphology was switched on. See xbPostProcState.update
+        timesteps = xbState.scarpTimesteps
+        scarpCols = xbState.scarpCols
+        # Collect the scarp points of all time steps into a single dataframe. 
+        # Rows with no scarp have a column index of -1. 
+        tstepInd, rowInd = np.nonzero(scarpCols >= 0)
+        colIndexScarp = scarpCols[tstepInd, rowInd]
+        tstepsHrs = np.round(timesteps*fcstHotspot.tintm, 2)/3600
+        df = pd.DataFrame({"timeStepHrs":tstepsHrs[tstepInd],
+                           "xScarp":globalx[rowInd,colIndexScarp],
+                           "yScarp":globaly[rowInd,colIndexScarp],
+                           "rowInd":rowInd,
+                           "colIndexScarp":colIndexScarp})
+        # Start and end of each time step's points in the dataframe
+        tstepBounds = np.searchsorted(tstepInd, np.arange(0,len(timesteps)+1))
+        # Export the erosion scarp at each time step of the XBeach output, spread 
+        # over a pool of worker processes like the extreme water line above
+        if roundedTimeIndex in timesteps:
+            print("Starting at timestep %s " % roundedTimeIndex)
+        scarpShared = {"df":df, "tstepBounds":tstepBounds, "timesteps":timesteps,
+                       "tstepsHrs":tstepsHrs, "epsg":epsg, "scarpDirPts":scarpDirPts,
+                       "scarpDirLines":scarpDirLines, "writeShp":writeShp, "writeStore":writeStore}
+        scarpResults = postProcTools.mapTimesteps(func=postProcTools.exportScarpTimesteps,
+                                                  nTimesteps=len(timesteps), shared=scarpShared,
+                                                  nWorkers=nWorkers)
+        if writeStore:
+            for gdfPts, gdfLine in scarpResults:
+                if gdfPts is not None:
+                    storeLayers["scarp_points"].append(gdfPts)
+                if gdfLine is not None:
+                    storeLayers["scarp_lines"].append(gdfLine)
         ################ Determine maximum erosion scarp from XBeach output ################
-        # If there's no erosion detected there won't be a maximim landward erosion scarp detected
-        # So we "try" to compute it
-        try:
-            gdf_es = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.xScarp, df.yScarp), 
-                                    crs=epsg)
-            df_es = gdf_es.groupby(['rowInd'])['colIndexScarp'].agg(
-                    [('colIndexScarpMax', 'max')])
-            # Merge dataframes to get the geometry
-            df_es = pd.merge(gdf_es[["rowInd","geometry","colIndexScarp"]],
-                            df_es,
-                            left_on = ["rowInd","colIndexScarp"],
-                            right_on = ["rowInd","colIndexScarpMax"],
-                            how = "right")
-            # Drop duplicates
-            df_es = df_es.drop_duplicates()
-            # Export max erosion scarp lines as points
-            gdf1 = gpd.GeoDataFrame(df_es, geometry="geometry", 
+        # Most landward scarp in each row over the whole forecast. If there's no erosion
+        # detected there won't be a maximum landward erosion scarp.
+        colIndexScarpMax = scarpCols.max(axis=0, initial=-1)
+        rowIndMax = np.nonzero(colIndexScarpMax >= 0)[0]
+        if len(rowIndMax) > 0:
+            colIndexScarpMax = colIndexScarpMax[rowIndMax]
+            gdf1 = gpd.GeoDataFrame({"rowInd":rowIndMax},
+                                    geometry=gpd.points_from_xy(globalx[rowIndMax,colIndexScarpMax],
+                                                                globaly[rowIndMax,colIndexScarpMax]),
                                     crs=epsg)
             gdf1 = gdf1[["geometry","rowInd"]]
+            # Export max erosion scarp lines as points
             gdf1.to_file(os.path.join(fcstHotspot.postProcessDir,"maxEroScarp_points.shp"))
             # Export max erosion scarp line 
-            gdf2 = gpd.GeoDataFrame(df_es, geometry="geometry", 
-                                    crs=epsg)
-            gdf2 = gdf2[["geometry","rowInd"]]
-            gdf2.to_file(os.path.join(fcstHotspot.postProcessDir,"maxEroScarp.shp"))
-        except:
-            pass
+            gdf1.to_file(os.path.join(fcstHotspot.postProcessDir,"maxEroScarp.shp"))
 
 
         ############# Compute the maximum 2D erosion, flow depth, and flow velocity over the forecast #############
-        # Start out by computing the intial bed difference and set that as the initial array
-        max_ero = ds_zbi.zb.values-ds_zbi.zb.values
-        ds_flowi = ds_zbi.isel({"meantime":0})
-        max_flowDepth = ds_flowi.zs_max.values-ds_zbi.zb.values
-        max_flowUVel = ds_flowi.u_max.values 
-        max_flowVVel = ds_flowi.v_max.values
-        for timestep in np.arange(0,ds["meantime"].sizes["meantime"],1):
-            dsstep = ds.isel({"meantime":timestep})
-            dsstep = dsstep.isel({"globaltime":timestep+1}) # global time and mean time not the same
-            # Get the erosion difference from timestep to beginning
-            ero_step = dsstep.zb.values-ds_zbi.zb.values
-            # Get the flow depth at timestep
-            flowDepth_step = dsstep.zs_max.values-dsstep.zb.values
-            # Get the max u velocities at timestep
-            flowUVel_step = dsstep.u_max.values
-            # Get the max v velocities at timestep
-            flowVVel_step = dsstep.v_max.values
-            # Compute the maximums for each
-            max_ero = np.maximum(max_ero, ero_step)
-            max_flowDepth = np.maximum(max_flowDepth,flowDepth_step)
-            max_flowUVel = np.maximum(max_flowUVel,flowUVel_step)
-            max_flowVVel = np.maximum(max_flowVVel,flowVVel_step)
+        # Running maxima kept as the output was read, see postProcTools.maxGrids
+        max_ero, max_flowDepth, max_flowUVel, max_flowVVel = xbState.maxima
         # Export in grd format
         np.savetxt(os.path.join(fcstHotspot.postProcessDir,'xbout_maxEro.grd'),
                    max_ero,delimiter="\t")
@@ -422,6 +361,10 @@ def main(args=None):
         np.savetxt(os.path.join(fcstHotspot.postProcessDir, "xbout_maxVVel.grd"),
                    max_flowVVel, delimiter="\t")
 
+    #============== Write all timesteps to the GeoPackage store ==============#
+    if writeStore:
+        postProcTools.writeTimeseriesStore(layers=storeLayers, storePath=storePath, epsg=epsg)
+
     # Use pickle to save xbeach model object info
     picklePath = os.path.join(fcstHotspot.forecastDir,"forecast_hotspot.pkl")
     with open(picklePath, "wb") as output:
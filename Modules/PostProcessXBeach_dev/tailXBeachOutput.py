@@ -0,0 +1,154 @@
+#==========================================================================================
+# tailXBeachOutput.py
+
+# DESCRIPTION:
+# This script post-processes the XBeach output (xboutput.nc) while XBeach is still
+# running, so that once XBeach has finished, postprocessMain.py only has to export the
+# results. More specifically, this script does the following:
+#     - Determines the current running forecast/hindcast and loads the relevant pickle
+#     file containing the object instance of the hotspotForecast class
+#     - Every pollInterval seconds, reads the gauge ("pointtime") and spatial
+#     ("globaltime"/"meantime") records XBeach has added to xboutput.nc in the XBeach
+#     run directory since the last time, and updates the extreme water line, erosion
+#     scarps and maximum erosion/flow grids (see incrementalPostProc.py in xbfewsTools)
+#     - Once XBeach has finished (i.e. xbeachFinished.txt appears in the run directory),
+#     reads the last records (and the records read last while XBeach was running again,
+#     see incrementalPostProc.py) and saves the results to postProcState.pkl in the run
+#     directory, which postprocessMain.py picks up
+#     - Any read that fails while XBeach is running is recorded in tailXBeachOutput.log 
+#     in the run directory, which run_forecast_loop.py copies to its log file
+# Started alongside XBeach by run_forecast_loop.py if incrementalPostProc_flag is True.
+# If this script isn't run (e.g. when running in FEWS), postprocessMain.py reads the
+# whole output file itself.
+
+# ARGUMENTS FOR THE SCRIPT:
+# The same as postprocessMain.py:
+#     - regionHome: The path to the Region Home directory
+#     - systemTimeStr: The system time for the forecast/hindcast, in the format: “YYYYMMDDHH”
+#     - siteName: The name of the hotspot, designated in hotspotLocations.csv
+#     - workDir: Working directory ([Region Home]\Modules\PostProcessXBeach). Not used, 
+#     since the PostProcessXBeach module may be using it at the same time; only taken so
+#     that the arguments are the same as postprocessMain.py's.
+#     - pollInterval (optional): Seconds between reads of xboutput.nc. Default is 30.
+
+# KEY INPUTS:
+#     - forecast_hotspot.pkl: The pickle file that stores all the attributes of the instance
+#     of the hotspotForecast class
+#     - xboutput.nc: XBeach output netCDF file, in the XBeach run directory
+#     - xbeachFinished.txt: Written to the XBeach run directory once XBeach has exited.
+#     Contains the XBeach exit code.
+
+# KEY OUTPUTS:
+#     - postProcState.pkl: The reduced XBeach output, in the XBeach run directory
+#     - tailXBeachOutput.log: Reads of xboutput.nc that failed, and any error that stopped
+#     this script, in the XBeach run directory
+
+# COMMAND TO DE-BUG AND MODIFY THIS SCRIPT INDIVIDUALLY:
+# python [path to this script] [path to Region Home] [System time in format YYYYMMDDHH] [site name] [working directory, i.e. the path to the folder containing this script]
+#==========================================================================================
+
+
+#============== Modules ==============#
+import os
+import sys
+import time
+import traceback
+
+
+# Name of the file written to the XBeach run directory once XBeach has exited
+finishedFileName = "xbeachFinished.txt"
+# Name of the log file written to the XBeach run directory
+logFileName = "tailXBeachOutput.log"
+
+
+def main(args=None):
+
+    #============== Parse arguments ==============#
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
+    regionHome = str(args[0])
+    sysTimeStr = str(args[1])
+    siteName = str(args[2])
+    # args[3] is the working directory, which isn't used (see above)
+    pollInterval = float(args[4]) if len(args) > 4 else 30.
+
+
+    #============== Modules ==============#
+    # XBeach has xboutput.nc open for writing the whole time it runs. On Windows,
+    # HDF5's file locking would stop every read until XBeach has finished.
+    os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
+    import pickle
+    from datetime import datetime
+    import pandas as pd
+    from xbfewsTools import incrementalPostProc
+
+
+    #============== Load hotspot forecast object with pickle ==============#
+    hotspotLocSet = pd.read_csv(os.path.join(regionHome,"Config\\MapLayerFiles\\hotspotLocations.csv"))
+    regionName = hotspotLocSet.loc[hotspotLocSet['ID']==siteName]['Region'][0]
+    t_str = sysTimeStr[0:8] + '_' + sysTimeStr[8:] + '00'
+    fcstHotspot = os.path.join(regionHome,"Forecasts",t_str,regionName,"hotspot",siteName,"forecast_hotspot.pkl")
+    fcstHotspot = pickle.load(open(fcstHotspot, "rb"))
+    totalRunTime = (fcstHotspot.endTime - fcstHotspot.startTime).total_seconds()
+
+
+    #============== Paths ==============#
+    ncOut = os.path.join(fcstHotspot.moduleDir, "xboutput.nc")
+    finishedFile = os.path.join(fcstHotspot.moduleDir, finishedFileName)
+    statePath = os.path.join(fcstHotspot.moduleDir, incrementalPostProc.stateFileName)
+    logPath = os.path.join(fcstHotspot.moduleDir, logFileName)
+    if os.path.exists(logPath):
+        os.remove(logPath)
+
+    def log(message=None):
+        # Appended straight away, so the log is complete even if this script is killed
+        with open(logPath, "a") as f:
+            f.write("%s: %s\n" % (datetime.now().isoformat(timespec="seconds"), message))
+
+
+    #============== Read the output as XBeach writes it ==============#
+    xbState = incrementalPostProc.xbPostProcState(morstart=fcstHotspot.morstart,
+                                                  totalRunTime=totalRunTime,
+                                                  scarpThreshold=fcstHotspot.scarpThreshold)
+    # Number of reads while XBeach is running, and how many of them failed
+    nReads = 0
+    nFailed = 0
+    while True:
+        finished = os.path.exists(finishedFile)
+        if finished:
+            with open(finishedFile) as f:
+                exitCode = f.read().strip()
+            # If XBeach failed, there is nothing to post-process
+            if exitCode != "0":
+                log("XBeach exited with code %s, stopping." % exitCode)
+                return
+            try:
+                xbState.update(ncFile=ncOut, final=True)
+            except Exception as e:
+                log("Could not read %s once XBeach had finished: %s\n%s" % (ncOut, e, traceback.format_exc()))
+                raise
+            break
+        if os.path.exists(ncOut):
+            # XBeach may be part of the way through writing the file header, in
+            # which case it is tried again next time
+            nReads += 1
+            try:
+                xbState.update(ncFile=ncOut, final=False)
+            except (OSError, KeyError, ValueError, RuntimeError) as e:
+                nFailed += 1
+                log("Could not read %s (%s of %s reads failed): %s" % (ncOut, nFailed, nReads, e))
+        time.sleep(pollInterval)
+    xbState.save(statePath)
+
+
+## If Python throws an error, send to exceptions.log file in the current directory
+## (errors reading xboutput.nc also go to tailXBeachOutput.log in the run directory)
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        with open("exceptions.log", "w") as logfile:
+            logfile.write(str(e))
+            logfile.write(traceback.format_exc())
+        raise
@@ -39,14 +39,24 @@
 #     - regionalTransects_[region].shp: The process CoastSat profiles
 #     - [city]TidesGmt.csv: The process astronomical tides for a given city, 
 #     in GMT (see Section 4.1.3)
+#     - [city]Constituents.csv: The harmonic constituents of the tide station
+#     (optional). If present, tides are predicted from these instead of being
+#     read from [city]TidesGmt.csv (see harmonicTides.py in xbfewsTools).
 #     - IDZ00154_StormSurge_national_YYMMDDHH.nc: The BoM forecast that gets 
-#     fetched by the NSSDownload module. 
+#     fetched by the NSSDownload module. Only the subset of the points needed 
+#     (IDZ00154_StormSurge_national_YYMMDDHH_subset.nc) is read, if the 
+#     NSSDownload module made one with the profiles' points.
 
 # KEY OUTPUTS:
 #     - diag.xml: The resulting diagnostic file that FEWS populates and uses 
 #     (i.e. prints to its console)
+#     - wlFor_[region].nc: The water level forecasts (tide, surge and total water
+#     level) for all of the CoastSat profiles, with the profile id as the 
+#     "transect" dimension. Written if the wlOutput attribute of the 
+#     regionalForecast object is "netcdf" or "both" (see fewsForecast.py).
 #     - [profile id]_wlFor.csv: Each of the individual water level forecast 
-#     files that correspond to each of the CoastSat profiles.  
+#     files that correspond to each of the CoastSat profiles. Written if 
+#     wlOutput is "csv" or "both" (the default is "both").
 
 # COMMAND TO DE-BUG AND MODIFY THIS SCRIPT INDIVIDUALLY:
 # python [path to this script] [path to Region Home] [System time in format YYYYMMDD_HHMM] [region name] [working directory, i.e. the path to the folder containing this script]
@@ -59,25 +69,24 @@
 import os
 import sys
 import traceback
-import shutil
 
 
 def main(args=None):
 
     # More Modules
-    import pandas as pd
     import geopandas as gpd
     import pickle
     from xbfewsTools import preProcWatLevs
-    from xbfewsTools import preProcWaves
     from xbfewsTools import fewsUtils
     from shapely.ops import nearest_points
-    from shapely.geometry import Point
-    import xarray as xr
 
 
     # Arguments for this script
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments from FEWS ==============#
     # Path to Region Home
@@ -103,10 +112,8 @@ def main(args=None):
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
-    with open(diagFile, "a") as fileObj:
-        currDir = os.getcwd()
-        fileObj.write("</Diag>")
+    diag = fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile)
+    currDir = os.getcwd()
 
 
     #============== Parse system time and find directory of current forecast ==============#
@@ -132,8 +139,6 @@ def main(args=None):
     # These CoastSat profiles have NSS and Wave Forecast mesh points
     # manually assigned to them
     gdf = gpd.read_file(os.path.join(dataPath,"CoastSat", regionName, "regionalTransects_%s.shp" % regionName))
-    # TODO: REMMOVE BELOW LINE:
-    gdf = gdf[0:3]
     # Save the geodataframe as an attribute of the regional forecast
     # object
     regionalFcst.profiles_gdf = gdf
@@ -142,28 +147,33 @@ def main(args=None):
     #============== Initial pre-processing for water level forecasts ==============#
 
     # Inform user through FEWS
-    fewsUtils.clearDiagLastLine(diagFile)
     # Write to diagnostics file
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "Pre-processing water levels for regional forecast..."))
-        fileObj.write("</Diag>")
+    diag.write(3, "Pre-processing water levels for regional forecast...")
 
     # Generate time series dataframe in GMT/UTC
     wlTimeSeries = preProcWatLevs.generateTimeSeries(forecast=regionalFcst)
 
                 #   ===     Tides   ===     #
-    # Copy tide predictions to pre-processing working directory
-    # Tides must be in GMT
+    # Tide predictions, must be in GMT
     tidesPath = os.path.join(dataPath,"Tides//%s//processed" % regionalFcst.tideLocation)
-    shutil.copy(os.path.join(tidesPath,"%sTidesGMT.csv" % regionalFcst.tideLocation), workDir)
-    #  Path to the tides input file
-    tideFile = os.path.join(workDir,"%sTidesGMT.csv" % regionalFcst.tideLocation)
-    # Load tide predictions, chop tide time series at start and end time
-    tideSeries = preProcWatLevs.loadTideData(ifile=tideFile,
-                                             forecast=regionalFcst)
-    # Interpolate tide time series at specified deltat (regionalFcst object 
-    # attribute), set when forecast object was initialized
-    tidesInterp = preProcWatLevs.interpSeries(series=tideSeries, forecast=regionalFcst)
+    # If the harmonic constituents of the tide station are available, predict
+    # the tides directly over the forecast window at the specified deltat
+    # (regionalFcst object attribute)
+    consFile = os.path.join(tidesPath,"%sConstituents.csv" % regionalFcst.tideLocation)
+    if os.path.exists(consFile):
+        tidesInterp = preProcWatLevs.predictTideData(ifile=consFile,
+                                                     forecast=regionalFcst)
+    else:
+        #  Path to the tides input file
+        tideFile = os.path.join(tidesPath,"%sTidesGMT.csv" % regionalFcst.tideLocation)
+        # Load tide predictions, chop tide time series at start and end time. Uses
+        # the binary tide store next to the csv file if it has been generated (see
+        # Scripts/waterLevs/convertTides.py)
+        tideSeries = preProcWatLevs.loadTideData(ifile=tideFile,
+                                                 forecast=regionalFcst)
+        # Interpolate tide time series at specified deltat (regionalFcst object 
+        # attribute), set when forecast object was initialized
+        tidesInterp = preProcWatLevs.interpSeries(series=tideSeries, forecast=regionalFcst)
     # Join tides with interpolated time series
     watlevSeries = wlTimeSeries.merge(tidesInterp, left_index=True, right_index=True)
                 #   ===     Surge   ===     #
@@ -177,16 +187,25 @@ def main(args=None):
     fname = "IDZ00154_StormSurge_national_" + bomDT + ".nc"
     # Full path of storm surge forecast file to be loaded
     ifile = os.path.join(surgeDirNC,fname)
-    # Load netCDF file as xarray dataset
-    surge_ds = xr.open_dataset(ifile)
-    # Convert xarray dataset to pandas dataframe
-    surge_df = pd.DataFrame({"Lon":surge_ds.coords['lon'].values,"Lat":surge_ds.coords['lat'].values})
-    # Get datasets into correct geodataframe format. This is so that
-    # the correct points on water level forecast mesh can be found. 
-    gdfPts = gpd.GeoDataFrame(surge_df, geometry=gpd.points_from_xy(surge_df.Lon,surge_df.Lat))
-    gdfPts.set_crs(epsg=int(regionalFcst.epsgWL))
-    # unary union of the geomtries 
-    pts = gdfPts.geometry.unary_union
+    # Load netCDF file as xarray dataset. Reads the subset made when the file was
+    # downloaded (see retrieveNSS.py), if it has all of the profiles' points
+    surge_ds, isSubset = preProcWatLevs.openNSS(ifile=ifile, lon=gdf['nss_lon'].values,
+                                                lat=gdf['nss_lat'].values)
+    # Find the nearest point on the BoM National Storm Surge forecast
+    # mesh to the point location that was manually assigned in the CoastSat 
+    # profile dataset file ("regionalTransects_*.shp"), for all of the profiles
+    # at once. This will ensure that the surge signal is being extracted from 
+    # the correct location for each profile. It's not a direct look-up of a 
+    # perfectly matching point because sometimes the BoM water level forecast 
+    # mesh changes. The index of the mesh is cached next to the NSS downloads, 
+    # and is only rebuilt when the mesh changes (the subset is small enough not to 
+    # need it).
+    nssIndexDir = None if isSubset else os.path.join(modulePath,"NSSDownload","meshIndex")
+    nssInd = preProcWatLevs.nssPointIndeces(ds=surge_ds, lon=gdf['nss_lon'].values,
+                                            lat=gdf['nss_lat'].values, cacheDir=nssIndexDir)
+    # Extract storm surge forecast at all profiles, one column per profile
+    surgeAll = preProcWatLevs.extractNSSPoints(forecast=regionalFcst, ds=surge_ds,
+                                               pointIndeces=nssInd, columns=gdf['id'].values)
     # Make output folder if it doesn't exist
     regionalFcst.inputsDir = os.path.join(forecastDir, regionName,'regional','inputs')
     regionalFcst.wlForecastDir = os.path.join(regionalFcst.inputsDir,"wlForecasts")
@@ -199,40 +218,24 @@ def main(args=None):
 
 
 
-    # Iterate over the CoastSat profiles
-    for index, row in gdf.iterrows():
-        # Find the nearest point on the BoM National Storm Surge forecast
-        # mesh to the point location that was manually assigned in the CoastSat 
-        # profile dataset file ("regionalTransects_*.shp"). This will ensure 
-        # that the surge signal is being extracted from the correct location 
-        # for each profile. It's not a direct look-up of a perfectly matching 
-        # point because sometimes the BoM water level forecast mesh changes. 
-        searchPt = Point(row['nss_lon'],row['nss_lat'])
-        # Returns the closest point on the BoM National Storm Surge forecast
-        # mesh to the CoastSat profile point that was previously assigned
-        # (while examining the mesh and profiles in QGIS)
-        closestPt = preProcWaves.nearGeom(searchPt, pts=pts,
-                                    gdfIn=gdfPts, outVar='geometries')
-        # Extract storm surge forecast at all profiles
-        surgeSeries = preProcWatLevs.extractNSS(forecast=regionalFcst,ds=surge_ds,
-                                  nss_lat=closestPt.y, nss_lon=closestPt.x)
-        # Interpolate surge time series at specified deltat (attirbute of the forecast object)
-        surgeInterp = preProcWatLevs.interpSeries(series=surgeSeries, forecast=regionalFcst)
-        # Combine storm surge and astronomical tide to get offshore water level
-        watlevSeries = watlevSeries.merge(surgeSeries,how='inner',left_index=True,right_index=True)
-        watlevSeries['wl_m'] = (watlevSeries['tide_m'] + watlevSeries['surge (m)']).round(2)
-        # Export water level forecasts as csv files, one for each CoastSat Profile
-        ofileName = '%s_wlFor.csv' % row['id']
-        watlevSeries.to_csv(os.path.join(regionalFcst.wlForecastDir, ofileName),
-                            columns=['wl_m'])
-        watlevSeries = watlevSeries.drop(columns=['surge (m)'], axis=1)
+    # Interpolate surge time series for all profiles at specified deltat (attirbute 
+    # of the forecast object)
+    surgeInterp = preProcWatLevs.interpSeries(series=surgeAll, forecast=regionalFcst)
+    # Combine storm surge and astronomical tide to get offshore water level, for all
+    # of the CoastSat profiles at once (time x transect)
+    wl_ds = preProcWatLevs.regionalWatLevs(watlevSeries=watlevSeries, surgeSeries=surgeInterp)
+    # Export water level forecasts as a single netCDF file, with the profile id 
+    # as the "transect" dimension
+    if regionalFcst.wlOutput in ["netcdf", "both"]:
+        wl_ds.to_netcdf(os.path.join(regionalFcst.wlForecastDir, "wlFor_%s.nc" % regionName))
+    # Export water level forecasts as csv files, one for each CoastSat Profile
+    if regionalFcst.wlOutput in ["csv", "both"]:
+        preProcWatLevs.writeWatLevCSVs(ds=wl_ds, outDir=regionalFcst.wlForecastDir)
 
 
     # Inform user through FEWS, via the diagnostic file
-    fewsUtils.clearDiagLastLine(diagFile)
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "Water levels successfully pre-processed."))
-        fileObj.write("</Diag>")
+    diag.write(3, "Water levels successfully pre-processed.")
+    diag.close()
 
 
 
@@ -45,6 +45,9 @@
 #     same dimensions as the mesh. 
 #     ne_layer: The prepped XBeach non-erodible layer. The file has the same dimensions as 
 #     the mesh. 
+#     The grids are read from a binary copy saved next to them ([grid].npy), which is made 
+#     the first time a grid is read and made again if the grid changes (see gridCache.py 
+#     in xbfewsTools).
 #     - deltat_str: The input time series resolution that will be set for XBeach inputs  
 #     - diagOpen.txt: A template file that FEWS populates and uses as a log file
 #     - forecast.pkl: The pickle file that stores all the attributes of the instance of the 
@@ -53,10 +56,16 @@
 #     of the hotspotForecast class
 #     - [city]TidesGmt.csv: The process astronomical tides for a given city, in GMT (see 
 #     Section 4.1.3)
+#     - [city]Constituents.csv: The harmonic constituents of the tide station
+#     (optional). If present, tides are predicted from these instead of being
+#     read from [city]TidesGmt.csv (see harmonicTides.py in xbfewsTools).
 #     - IDZ00154_StormSurge_national_YYMMDDHH.nc: The BoM surge forecast that gets fetched by 
-#     the NSSDownload module. 
+#     the NSSDownload module. Only the subset of the points needed 
+#     (IDZ00154_StormSurge_national_YYMMDDHH_subset.nc) is read, if it has the hotspot's point.
 #     - [citycode].msh.YYYYMMDDTHHMMZ.nc: The BoM nearshore wave forecast that gets fetched 
-#     by the WaveDownload module. 
+#     by the WaveDownload module. Only the subset of the nodes needed by the hotspot 
+#     ([city code].msh.YYYYMMDDTHHMMZ_[site name].nc) is read, if the WaveDownload module 
+#     made one.
 #     - auswaveOutPts_[site name].csv: Csv file that lists the points on the BoM wave 
 #     forecast mesh that are closest to the XBeach grid boundary points (see Section 4.1.5.3).
 #     - JONSWAP parameters (set in preProcWaves.py, function generateWaveFiles): Several 
@@ -79,6 +88,9 @@
 #     its console) 
 #     - XBeach output directory: Includes params.txt, tide.txt, wave files, loclist.txt, 
 #     x.grd, y.grd, z.grd, ne_layer.grd, XBeach executable
+#     - XBeach run directory ([Region Home]\Modules\XBeach\[site]\[time]SystemTime-[site]):
+#     The XBeach output directory, hard-linked rather than copied (see runHandoff.py in
+#     xbfewsTools), with handoffManifest.json recording where each file came from
 #     - forecast_hotspot.pkl: The updated pickle file that stores all the attributes of the 
 #     hotspotForecast instance
 
@@ -102,7 +114,11 @@ def main(args=None):
 
 
     #============== Arguments for this script ==============#
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments ==============#
     # Arguments parsed from PreProcessXBeachAdapter.xml if using FEWS
@@ -122,6 +138,8 @@ def main(args=None):
     from xbfewsTools import fewsUtils
     from xbfewsTools import preProcWatLevs
     from xbfewsTools import preProcWaves
+    from xbfewsTools import runHandoff
+    from xbfewsTools import gridCache
     from datetime import datetime, timezone, timedelta
     import fileinput
     import pickle
@@ -183,11 +201,9 @@ def main(args=None):
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
     # Write to diagnostics file
-    with open(diagFile, "a") as fileObj:
-        currDir = os.getcwd()
-        fileObj.write("</Diag>")
+    diag = fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile)
+    currDir = os.getcwd()
 
 
     #============== Set more parameters for hotspot forecast instance ==============#
@@ -210,29 +226,24 @@ def main(args=None):
     hotspotFcst.inputGridsDir = xbFilesPath
 
     # Write some of this info to diag file
-    # Remove </Diag> line since more lines are being appended
-    fewsUtils.clearDiagLastLine(diagFile)
     # Write to diagnostics file 
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "XBeach Working Directory: % s" % hotspotFcst.xbWorkDir))
-        fileObj.write(fewsUtils.write2DiagFile(3, "System time (from FEWS): %s" % hotspotFcst.systemTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Rounded time: %s" % hotspotFcst.roundedTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Spin-up window : %s" % hotspotFcst.spinUpWindow))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Forecast horizon : %s" % hotspotFcst.forecastHorizon))
-        fileObj.write(fewsUtils.write2DiagFile(3, "XBeach model start time: %s" % hotspotFcst.startTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "XBeach model end time: %s" % hotspotFcst.endTime))
-        fileObj.write("</Diag>")
+    diag.write(3, "XBeach Working Directory: % s" % hotspotFcst.xbWorkDir)
+    diag.write(3, "System time (from FEWS): %s" % hotspotFcst.systemTime)
+    diag.write(3, "Rounded time: %s" % hotspotFcst.roundedTime)
+    diag.write(3, "Spin-up window : %s" % hotspotFcst.spinUpWindow)
+    diag.write(3, "Forecast horizon : %s" % hotspotFcst.forecastHorizon)
+    diag.write(3, "XBeach model start time: %s" % hotspotFcst.startTime)
+    diag.write(3, "XBeach model end time: %s" % hotspotFcst.endTime)
 
 
     #================= Copy Ready-made input files =================#
     # Transfer pre-made x.grd, y.grd, bed.DEP to working directory
     # (XBeach work directory inside the Forecast directory)
     # Generated with 01preprocess-morpho.py script
-    # Copy grids over
-    shutil.copy(xgrd, hotspotFcst.xbWorkDir)
-    shutil.copy(ygrd, hotspotFcst.xbWorkDir)
-    shutil.copy(zgrd, hotspotFcst.xbWorkDir)
-    shutil.copy(ne_layer, hotspotFcst.xbWorkDir)
+    # Link grids over (hard links, so the grids aren't copied for every forecast;
+    # XBeach only reads them)
+    for grd in [xgrd, ygrd, zgrd, ne_layer]:
+        runHandoff.linkFile(grd, os.path.join(hotspotFcst.xbWorkDir, os.path.basename(grd)))
     hotspotFcst.xgrdPath = xgrd
     hotspotFcst.ygrdPath = ygrd
     hotspotFcst.zgrdPath = zgrd
@@ -241,19 +252,18 @@ def main(args=None):
 
     #============== Generate list of run-up gauges for XBeach output ==============#
     # Read xgrd, left-most cells contain seaward boundary, this is where run-up
-    # gauges will be placed at the start of the simulation
-    hotspotFcst.dfGauges = pd.read_csv(hotspotFcst.xgrdPath, delim_whitespace=True, header=None, prefix='x', usecols=[0])
-    # Read ygrd and add as a column (the correct way), left most cells contain seaward boundary
-    hotspotFcst.dfGauges.loc[:,'y0'] = pd.read_csv(hotspotFcst.ygrdPath, delim_whitespace=True, header=None, prefix='y', usecols=[0])
+    # gauges will be placed at the start of the simulation. The grids are loaded
+    # from their binary cache, which is made the first time a grid is read (see
+    # gridCache.py in xbfewsTools), rather than parsing the text grids each time.
+    hotspotFcst.dfGauges = pd.DataFrame({'x0':np.array(gridCache.loadGrid(hotspotFcst.xgrdPath)[:,0])})
+    # Read ygrd and add as a column, left most cells contain seaward boundary
+    hotspotFcst.dfGauges.loc[:,'y0'] = np.array(gridCache.loadGrid(hotspotFcst.ygrdPath)[:,0])
 
 
     #============== Pre-process water levels ==============#
     # Inform user through FEWS
-    fewsUtils.clearDiagLastLine(diagFile)
     # Write to diagnostics file
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "Pre-processing water levels..."))
-        fileObj.write("</Diag>")
+    diag.write(3, "Pre-processing water levels...")
 
 
     # Generate time series dataframe in GMT/UTC
@@ -262,17 +272,24 @@ def main(args=None):
     
 
                 #   ===     Tides   ===     #
-    # Copy tide predictions to pre-processing working directory
-    # Tides must be in GMT/UTC
+    # Tide predictions, must be in GMT/UTC
     tidesPath = os.path.join(dataPath,"Tides//%s//processed" % hotspotFcst.city)
-    shutil.copy(os.path.join(tidesPath,"%sTidesGMT.csv" % hotspotFcst.city), workDir)
-    # Load tide predictions, chop time series at start and end time to get
-    # tides over the forecast window
-    tideFile = os.path.join(workDir,"%sTidesGMT.csv" % hotspotFcst.city)
-    tideSeries = preProcWatLevs.loadTideData(ifile=tideFile,
-                                             forecast=hotspotFcst)
-    # Interpolate tide time series at specified deltat (hotspotFcst attribute)
-    tidesInterp = preProcWatLevs.interpSeries(series=tideSeries, forecast=hotspotFcst)
+    # If the harmonic constituents of the tide station are available, predict
+    # the tides directly over the forecast window at the specified deltat
+    # (hotspotFcst attribute)
+    consFile = os.path.join(tidesPath,"%sConstituents.csv" % hotspotFcst.city)
+    if os.path.exists(consFile):
+        tidesInterp = preProcWatLevs.predictTideData(ifile=consFile,
+                                                     forecast=hotspotFcst)
+    # Otherwise, load tide predictions, chop time series at start and end time to get
+    # tides over the forecast window. Uses the binary tide store next to the
+    # csv file if it has been generated (see Scripts/waterLevs/convertTides.py)
+    else:
+        tideFile = os.path.join(tidesPath,"%sTidesGMT.csv" % hotspotFcst.city)
+        tideSeries = preProcWatLevs.loadTideData(ifile=tideFile,
+                                                 forecast=hotspotFcst)
+        # Interpolate tide time series at specified deltat (hotspotFcst attribute)
+        tidesInterp = preProcWatLevs.interpSeries(series=tideSeries, forecast=hotspotFcst)
 
     # Join tides with time series - this becomes the basis for the 
     # water level forcing for XBeach. 
@@ -292,10 +309,12 @@ def main(args=None):
     #============== Process surge at hotspot site ==============#
     # Extract surge from netCDF file at prescribed lat/lon point
     # lat/lon point attributes of hotspotFcst (hotspotFcst.latSurge,
-    # hotspotFcst.lonSurge)
+    # hotspotFcst.lonSurge). The point index for the NSS mesh is cached next to
+    # the NSS downloads, shared with the regional pre-processing.
     surgeSeries = preProcWatLevs.processNSS_nc(forecast=hotspotFcst,
                                            nssDir=surgeDirNC,
-                                           fname=fname)
+                                           fname=fname,
+                                           cacheDir=os.path.join(modulePath,"NSSDownload","meshIndex"))
     # Duplicated index in there for some reason (shouldn't be a DST issue)
     # Maybe because of the merge in processNSS_nc?. This removes it. 
     surgeSeries = surgeSeries[~surgeSeries.index.duplicated()]
@@ -319,36 +338,39 @@ def main(args=None):
 
 
     # Inform user through FEWS
-    fewsUtils.clearDiagLastLine(diagFile)
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "Water levels successfully pre-processed."))
-        fileObj.write("</Diag>")
+    diag.write(3, "Water levels successfully pre-processed.")
 
 
 
     #============== Pre-process waves ==============#
     # Inform user through FEWS
-    fewsUtils.clearDiagLastLine(diagFile)
-    with open(diagFile, "a") as fileObj:
-        fileObj.write(fewsUtils.write2DiagFile(3, "Pre-processing waves..."))
-        fileObj.write("</Diag>")
+    diag.write(3, "Pre-processing waves...")
     # Load locations of mesh points on Auswave output
     meshPts = os.path.join(dataPath,"Waves\\%s\\auswave" % hotspotFcst.city,"auswaveOutPts_%s.csv" % hotspotFcst.siteName)
     # Auswave epsg is 4939
     meshPts = preProcWaves.loadMeshPts(meshPts=meshPts, epsg=hotspotFcst.auswaveEPSG)
     # Load Auswave output
     wavesDir= os.path.join(modulePath,"WaveDownload/ncFiles")
-    # Netcdf file as xarray dataset
-    wavesDs = preProcWaves.loadAuswave(forecast=hotspotFcst, wavesDir=wavesDir)
+    # Netcdf file as xarray dataset. Reads the subset made for this hotspot when the
+    # file was downloaded (see retrieveAusWaves.py), if it has the XBeach boundary
+    # points and the point near the offshore buoy
+    wavesDs, isSubset = preProcWaves.openAuswave(ifile=os.path.join(wavesDir,preProcWaves.auswaveFileName(forecast=hotspotFcst)),
+                                                 lon=np.append(meshPts.geometry.x.values, hotspotFcst.offshoreWaveLon),
+                                                 lat=np.append(meshPts.geometry.y.values, hotspotFcst.offshoreWaveLat),
+                                                 name=hotspotFcst.siteName)
     # Slice it to the forecast window
     wavesDs = wavesDs.sel(time=slice(hotspotFcst.roundedTime,hotspotFcst.endTime))
+    # Nearest-node index for the Auswave mesh is cached here, and is only rebuilt if
+    # the mesh changes (the subset is small enough not to need it)
+    waveIndexDir = None if isSubset else os.path.join(modulePath,"WaveDownload","meshIndex")
     # Extract the point that is close to the offshore buoy
     offshore_df = pd.DataFrame({"lat":hotspotFcst.offshoreWaveLat,
                                 "lon":hotspotFcst.offshoreWaveLon},
                                 index=[0])
     offshore_gdf = gpd.GeoDataFrame(offshore_df,geometry=gpd.points_from_xy(offshore_df.lon,offshore_df.lat))
     offshore_gdf.set_crs(epsg=hotspotFcst.auswaveEPSG)
-    wavesOffshoreDs = preProcWaves.extractAusWavePts(ds=wavesDs,meshPts=offshore_gdf,epsg=hotspotFcst.auswaveEPSG)
+    wavesOffshoreDs = preProcWaves.extractAusWavePts(ds=wavesDs,meshPts=offshore_gdf,epsg=hotspotFcst.auswaveEPSG,
+                                                     cacheDir=waveIndexDir,name=hotspotFcst.waveCode)
     wavesOffshoreDs = wavesOffshoreDs[['hs']]
     # Extract Auswave points that will force the XBeach model
     # Looking for an exact "point look-up" match doesn't work
@@ -356,21 +378,17 @@ def main(args=None):
     #    Auswave time series points that are closest to those
     #    points. These are then set along the XBeach seaward 
     #    boundary as forcing.
-    wavesDs = preProcWaves.extractAusWavePts(ds=wavesDs, meshPts=meshPts, epsg=hotspotFcst.auswaveEPSG)
-    # Loop through mesh points and generate wavefile.txt input files for XBeach
-    preProcWaves.generateWaveFiles(ds=wavesDs,forecast=hotspotFcst)
+    wavesDs = preProcWaves.extractAusWavePts(ds=wavesDs, meshPts=meshPts, epsg=hotspotFcst.auswaveEPSG,
+                                             cacheDir=waveIndexDir, name=hotspotFcst.waveCode)
     # Add wavefile name as gdf entry
     meshPts["ind"] = meshPts.index.astype(int)
     meshPts["wavefile"] = [f"wavefile{i+1}.txt" for i in meshPts.index]
     # Place these wave time series on the seaward boundary of the XBeach mesh
     wavesDf, hotspotFcst.ncols, hotspotFcst.nrows = preProcWaves.moveWavestoBoundary(meshPts=meshPts,
                                                                                      forecast=hotspotFcst)
-    # Export the locations of the wave time series 
-    # forcing to XBeach-friendly input file
-    with open(os.path.join(hotspotFcst.xbWorkDir, "loclist.txt"), 'w') as fp:
-        fp.write('LOCLIST\n')
-        fp.write(wavesDf.to_csv(index=False, columns=["xtarget","ytarget","wavefile"],
-            header=False,sep=' ',line_terminator='\n'))
+    # Generate the wavefile.txt input files for XBeach, and the locations of the wave 
+    # time series forcing (loclist.txt), all in one go
+    preProcWaves.generateWaveFiles(ds=wavesDs,forecast=hotspotFcst,boundaryDf=wavesDf,nWorkers=4)
 
 
     #============== Morstart - Hsig condition to turn it on/off =================#
@@ -387,10 +405,7 @@ def main(args=None):
     # in forecast
     if len(hotspotFcst.stormPeriods) > 1:
         # Inform user through FEWS
-        fewsUtils.clearDiagLastLine(diagFile)
-        with open(diagFile, "a") as fileObj:
-            fileObj.write(fewsUtils.write2DiagFile(2, "Warning: more than one storm period detected."))
-            fileObj.write("</Diag>")
+        diag.write(2, "Warning: more than one storm period detected.")
     if len(hotspotFcst.stormPeriods) >= 1:
         # If there's more than one storm period detected, turn on morphology
         # when the first storm starts, then turn it off when the last storm ends
@@ -451,8 +466,8 @@ def main(args=None):
                         line = line.replace(text2search, text2replace)
                 new_data.write(line)
 
-    #============== Copy over executable ==============#
-    shutil.copy(execTemplate,hotspotFcst.xbWorkDir)
+    #============== Link over executable ==============#
+    runHandoff.linkFile(execTemplate, os.path.join(hotspotFcst.xbWorkDir, os.path.basename(execTemplate)))
 
     # Set pre-processing status in model class to "True"
     hotspotFcst.preProcessed = True
@@ -472,19 +487,19 @@ def main(args=None):
         pickle.dump(hotspotFcst, output, pickle.HIGHEST_PROTOCOL)
 
 
-    #============== Copy the contents of the xBeach work dir to XBeach module folder ==============#
-    # Make sure module directory is made if it doesn't exist
-    if not os.path.exists(hotspotFcst.moduleDir):
-        os.makedirs(hotspotFcst.moduleDir)
-    else:
-        # Wipe the contents of the directory if it already exists
-        shutil.rmtree(hotspotFcst.moduleDir)
-    # Copy contents of xbWorkDir into moduleDir
-    from distutils.dir_util import copy_tree
-    copy_tree(hotspotFcst.xbWorkDir, hotspotFcst.moduleDir)
-    # Copy over the pickle file too
+    #============== Hand the contents of the xBeach work dir over to XBeach module folder ==============#
+    # The files are hard-linked into a staging directory, which then replaces the
+    # module directory (wiping any previous run there). Output of a previous XBeach
+    # run of this forecast, handed back by postprocessMain.py, isn't handed over again.
+    runHandoff.handoffDir(srcDir=hotspotFcst.xbWorkDir, dstDir=hotspotFcst.moduleDir,
+                          owner="PreProcessXBeach", replace=True, skipOwners=("XBeach",))
+    # Copy over the pickle file too (copied, not linked: it is rewritten in place by
+    # the later modules)
     shutil.copy(picklePath,hotspotFcst.moduleDir)
 
+    # Write out the diagnostics file
+    diag.close()
+
 
 ## If Python throws an error, send to exceptions.log file
 if __name__ == "__main__":
@@ -15,7 +15,13 @@
 #     each city code
 #     - Determines the correct location to download the BoM file from (either 
 #     the BoM server, the WRL1 Coastal server, or a local folder)
-#     - Fetches the file and downloads it to a local directory
+#     - Fetches the files for all the city codes at the same time (see 
+#     asyncDownload.py in xbfewsTools), into the local download cache 
+#     ([Region Home]\Cache\BoM, see downloadCache.py in xbfewsTools), unless 
+#     they are already there, and links them into a local directory
+#     - Extracts the nodes needed by each hotspot (the XBeach boundary points and 
+#     the point near the offshore buoy) into a small subset of the file, which the 
+#     PreProcessXBeach module reads instead of the full file
 #     - Writes out diagnostics
 #     - Updates the original pickle file
 
@@ -51,6 +57,10 @@
 #     - [city code].msh.YYYYMMDDTHHMMZ.nc: The BoM National Storm Surge 
 #     System forecast file that the script fetches and sends to 
 #     [Region Home]\ Modules\WaveDownload\ncFiles
+#     - [city code].msh.YYYYMMDDTHHMMZ_[site name].nc: The nodes of the BoM 
+#     nearshore wave forecast nearest to the points in auswaveOutPts_[site name].csv
+#     and to the point near the offshore buoy (ausStates.csv), for each hotspot, in
+#     [Region Home]\ Modules\WaveDownload\ncFiles
 #     - forecast.pkl: Updated pickle file for the instance of the 
 #     fewsForecast class. 
 
@@ -66,7 +76,7 @@ import os
 import re
 import traceback
 from datetime import datetime
-import shutil
+import functools
 import sys
 
 
@@ -77,7 +87,11 @@ def main(args=None):
 
 
     #============== Parse arguments from FEWS ==============#
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
     # Path to Region Home
     regionHome = str(args[0])
     # System time according to FEWS
@@ -94,6 +108,12 @@ def main(args=None):
     diagFile = os.path.join(workDir,"diag.xml")
     # Location of the BoM server
     serverLoc = "http://dapds00.nci.org.au/thredds/fileServer/rr6/waves/"
+    # Local cache of downloaded forecast files, shared with the NSSDownload module,
+    # and its maximum size (GB)
+    cacheDir = os.path.join(regionHome,"Cache\\BoM")
+    cacheSizeGB = 20
+    # Maximum number of files downloaded from the same server at once
+    maxPerHost = 4
 
 
     #============== More Modules ==============#
@@ -102,7 +122,8 @@ def main(args=None):
     import pickle
     from xbfewsTools import fewsUtils
     from xbfewsTools import preProcWaves
-    import wget
+    from xbfewsTools import downloadCache
+    from xbfewsTools import asyncDownload
 
 
     #============== Parse system time and find directory of current forecast ==============#
@@ -125,6 +146,9 @@ def main(args=None):
     # Return all unique city codes as a list - these are used in BoM wave forecast
     # file names
     wave_codes = df.wave_code.unique()
+    cache = downloadCache.downloadCache(cacheDir=cacheDir, maxSizeGB=cacheSizeGB)
+    # Downloads to run, as (url, function doing the download) pairs
+    downloads = []
 
 
     # Loop through the different wave codes. Every unique wave code for each of the 
@@ -149,39 +173,64 @@ def main(args=None):
         #============== Fetch file from server  ==============#
         # Local directory where BoM forecast file will be downloaded
         downloadDir = os.path.join(workDir,"ncFiles")
-        # Make local download directory if it doesn't exist
-        if not os.path.exists(downloadDir):
-            os.makedirs(downloadDir)
         # If in "forecast" mode, download straight from the BoM server
         if fcst.mode == "forecast":
             servDir = serverLoc + "%s/%s/" %(bomDate,bomTime)
             url = servDir + fname
-            bomFile = wget.download(url, out=downloadDir)
         # Or else if it's in hindcast mode, download from other directory where
         # files are stored long-term (WRL1), or locally
         elif fcst.mode == "hindcast":
             # Typical os.path.join() doesn't work here because of mixed up slashes
             url = serverLoc + "/%s" % fname
-            shutil.copy(url,downloadDir)
+        # Either way the file goes through the local download cache, so it is only
+        # fetched once, and is then linked into the local download directory. The
+        # files for all the wave codes are fetched at the same time, below.
+        downloads.append((url, functools.partial(cache.fetchTo, product="%s.msh" % code,
+                                                 issueTime=bomDate+bomTime, source=url,
+                                                 outDir=downloadDir)))
+
+    #============== Fetch all files at once ==============#
+    # At most maxPerHost downloads from the same server at once. Each download is
+    # retried (and resumed) if it fails, see asyncDownload.py in xbfewsTools.
+    bomFiles = asyncDownload.fetchAll(jobs=downloads, maxPerHost=maxPerHost)
+
+
+    #============== Subset the nodes needed by each hotspot ==============#
+    # Extract the nodes nearest to the XBeach boundary points (auswaveOutPts_[site].csv)
+    # and to the point near the offshore buoy (ausStates.csv) into a small file per
+    # hotspot, which PreProcessXBeach reads instead of the full file (see 
+    # preProcWaves.subsetAuswave in xbfewsTools)
+    regionsDF = pd.read_csv(os.path.join(regionHome,"Config\\MapLayerFiles\\ausStates.csv"))
+    for code, bomFile in zip(wave_codes, bomFiles):
+        for i, hotspot in df[df.wave_code == code].iterrows():
+            meshPtsFile = os.path.join(regionHome,"Data","Waves",hotspot['City'],"auswave",
+                                       "auswaveOutPts_%s.csv" % hotspot['ID'])
+            if not os.path.exists(meshPtsFile):
+                continue
+            meshPts = pd.read_csv(meshPtsFile)
+            offshore = regionsDF.loc[regionsDF['ID']==hotspot['Region']].iloc[0]
+            preProcWaves.subsetAuswave(ifile=bomFile,
+                                       ofile=preProcWaves.auswaveSubsetPath(ifile=bomFile, name=hotspot['ID']),
+                                       lon=np.append(meshPts['lon'].values, offshore['offshoreWave_lon']),
+                                       lat=np.append(meshPts['lat'].values, offshore['offshoreWave_lat']),
+                                       cacheDir=os.path.join(workDir,"meshIndex"), meshName=code)
 
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
     # Write to FEWS diagnostic file
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3,
+        diag.write(3,
             "Command-line arguments sent to python script from FEWS: %s" 
-            % (str(args)) ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"Current directory: %s" %currDir))
-        fileObj.write(fewsUtils.write2DiagFile(3,"Server location: % s \n" % serverLoc))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Current system time: %s \n" % systemTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Rounding system time down to: % s \n" % roundedTime))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Destination directory: % s \n" % workDir))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Downloading file: % s \n" %fname))
-        fileObj.write(fewsUtils.write2DiagFile(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory."))
-        fileObj.write("</Diag>")
+            % (str(args)))
+        diag.write(3,"Current directory: %s" %currDir)
+        diag.write(3,"Server location: % s \n" % serverLoc)
+        diag.write(3, "Current system time: %s \n" % systemTime)
+        diag.write(3, "Rounding system time down to: % s \n" % roundedTime)
+        diag.write(3, "Destination directory: % s \n" % workDir)
+        diag.write(3, "Downloading file: % s \n" %fname)
+        diag.write(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory.")
 
 
 # If Python throws an error, send to exceptions.log file that appears in module folder
@@ -18,6 +18,9 @@
 #         - [Region Home]\Modules\NSSDownload\ncFiles
 #         - NOTE: This doesn’t (and isn’t supposed to) remove the forecasts from the original 
 #         locations they were downloaded from. 
+#         - NOTE: These are links to the files in the local download cache ([Region Home]\Cache\BoM), 
+#         which is kept, so re-running the forecast doesn't download the files again. The cache 
+#         removes its least recently used files itself (see downloadCache.py in xbfewsTools).
 #     - Writes out diagnostics
 
 # Arguments for the Script
@@ -43,6 +46,8 @@
 #     forecast, stored as a netCDF file.
 #     - [city code].msh.YYYYMMDDTHHMMZ.nc: The BoM nearshore wave forecast, fetched from the 
 #     WaveDownload module.
+#     - [city code].msh.YYYYMMDDTHHMMZ_[site name].nc: The nodes of the BoM nearshore wave
+#     forecast needed by the hotspot, extracted by the WaveDownload module.
 
 # Key Outputs
 #     - diag.xml: The resulting diagnostic file that FEWS populates and uses (i.e. prints to 
@@ -67,10 +72,16 @@ def main(args=None):
     import pickle
     from xbfewsTools import fewsUtils
     from xbfewsTools import postProcTools
+    from xbfewsTools import preProcWatLevs
+    from xbfewsTools import preProcWaves
 
 
     #============== Parse arguments from FEWS ==============#
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
     # Region home
     regionHome = str(args[0])
     # System time according to FEWS
@@ -106,12 +117,10 @@ def main(args=None):
 
     #============== Generate diagnostics file ==============#
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3, "Wiping hotspot run: %s" % hotspotFcst.runName))
-        fileObj.write(fewsUtils.write2DiagFile(3, "Forecast for time period starting at: %s" % hotspotFcst.roundedTime))
-        fileObj.write("</Diag>")
+        diag.write(3, "Wiping hotspot run: %s" % hotspotFcst.runName)
+        diag.write(3, "Forecast for time period starting at: %s" % hotspotFcst.roundedTime)
 
     
     ############ Remove Excess XBeach output to save space ################
@@ -134,8 +143,10 @@ def main(args=None):
             str(hotspotFcst.roundedTime.hour).zfill(2))
     fname = "IDZ00154_StormSurge_national_" + bomDT + ".nc"
     surgeFile = os.path.join(surgeDirNC,fname)
-    if os.path.exists(surgeFile):
-        os.remove(surgeFile)
+    # The national file, and the subset of the points needed (see retrieveNSS.py)
+    for f in [surgeFile, preProcWatLevs.nssSubsetPath(surgeFile)]:
+        if os.path.exists(f):
+            os.remove(f)
 
     # Remove wave forecasts
     waveDirNC = os.path.join(modulePath,"WaveDownload/ncFiles")
@@ -150,8 +161,10 @@ def main(args=None):
     cityCode = hotspotFcst.waveCode
     fname = "%s.msh.%s.nc" % (cityCode,bomDT)
     ausWaveFile = os.path.join(waveDirNC, fname)
-    if os.path.exists(ausWaveFile):
-        os.remove(ausWaveFile)
+    # The full file, and the subset of the nodes this hotspot needs (see retrieveAusWaves.py)
+    for f in [ausWaveFile, preProcWaves.auswaveSubsetPath(ifile=ausWaveFile, name=hotspotFcst.siteName)]:
+        if os.path.exists(f):
+            os.remove(f)
 
 
 
@@ -60,14 +60,17 @@
 import traceback
 import sys
 import os
-import shutil
 
 
 
 def main(args=None):
 
     ############ Arguments for this script ############ 
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments from FEWS ==============#
     # Arguments parsed from InitForecastAdapter.xml if using FEWS
@@ -147,16 +150,14 @@ def main(args=None):
 
     ############### Generate diagnostics file for FEWS ###############
     # Copy and rename diagOpen.txt so that FEWS knows where to find it
-    shutil.copy(diagBlankFile,diagFile)
     # Write to diagnostics file
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3,
+        diag.write(3,
             "Command-line arguments sent to python script from FEWS: %s" 
-            % (str(args)) ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"Forecast initiated" ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory."))
-        fileObj.write("</Diag>")
+            % (str(args)))
+        diag.write(3,"Forecast initiated")
+        diag.write(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory.")
 
 
 ## If Python throws an error, send to exceptions.log file to module directory
@@ -56,7 +56,6 @@
 import traceback
 import sys
 import os
-import shutil
 
 
 def main(args=None):
@@ -64,7 +63,11 @@ def main(args=None):
     
     
     ############ Arguments ############ 
-    args = [a for a in sys.argv[1:] if not a.startswith("-")]
+    # Arguments are taken from the command line (FEWS General Adapter) unless they
+    # are passed in directly, e.g. when run in-process by run_forecast_loop.py
+    if args is None:
+        args = sys.argv[1:]
+    args = [a for a in args if not a.startswith("-")]
 
     #============== Parse arguments from FEWS ==============#
     # Path to Region Home, defined in global properties file
@@ -115,16 +118,14 @@ def main(args=None):
     diagBlankFile = fcst.blankDiagFilePath
     diagFile = os.path.join(fcstRegional.forecastDir, "diag.xml")
     # Copy and rename diagOpen.txt
-    shutil.copy(diagBlankFile,diagFile)
     # Write to diagnostic file
-    with open(diagFile, "a") as fileObj:
+    with fewsUtils.diagWriter(diagFile=diagFile, blankFile=diagBlankFile) as diag:
         currDir = os.getcwd()
-        fileObj.write(fewsUtils.write2DiagFile(3,
+        diag.write(3,
             "Command-line arguments sent to python script from FEWS: %s" 
-            % (str(args)) ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"Regional forecast for %s initiated" % regionName ))
-        fileObj.write(fewsUtils.write2DiagFile(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory."))
-        fileObj.write("</Diag>")
+            % (str(args)))
+        diag.write(3,"Regional forecast for %s initiated" % regionName)
+        diag.write(3,"If Python error exit code 1 is triggered, see exceptions.log file in Module directory.")
 
 
 ## If Python throws an error, send to exceptions.log file
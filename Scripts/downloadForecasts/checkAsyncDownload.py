@@ -0,0 +1,246 @@
+#==========================================================================================
+# checkAsyncDownload.py
+
+# DESCRIPTION:
+# This script checks the forecast downloader (asyncDownload.py in xbfewsTools) against a
+# local stand-in for the BoM server, so that it can be checked without a connection to
+# the BoM. The stand-in server runs on localhost, in this script, and serves:
+#     - /ok/[name]: a file, honouring HTTP Range requests
+#     - /drop/[name]: drops the connection part of the way through the first download,
+#     then honours Range requests (the download should resume, not start again)
+#     - /norange/[name]: drops the connection part of the way through the first download,
+#     then ignores Range requests (the download should start again)
+#     - /busy/[name]: "503 Service Unavailable" for the first two requests (retried)
+#     - /missing/[name]: "404 Not Found" (not retried)
+#     - /slow/[name]: a file, after a short wait, while counting how many downloads are
+#     running at once (limited by maxPerHost)
+# Each check prints PASS or FAIL, and the script exits with an error if any check failed.
+
+# COMMAND TO RUN THIS SCRIPT:
+# python [path to this script]
+# xbfewsTools has to be importable: either run in the virtual environment associated with
+# running FEWS forecasts (where it is installed), or point PYTHONPATH at the folder it is
+# in first, e.g. on Windows:
+# set PYTHONPATH=[Region Home]\bin\windows\python\bin\conda-venv\Lib\site-packages
+#==========================================================================================
+
+
+#=========== Modules ===========#
+import os
+import sys
+import time
+import socket
+import shutil
+import hashlib
+import tempfile
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xbfewsTools import asyncDownload
+
+
+#=========== Variables ===========#
+# Size of the files served. Larger than asyncDownload.chunkSize, so that part of a
+# dropped download reaches the disk and can be resumed.
+fileSize = 3*asyncDownload.chunkSize + 12345
+# Where the connection is dropped, in bytes
+dropAt = fileSize//2
+# Seconds each /slow/ download takes
+slowDelay = 0.3
+# Retry settings used for the checks, short so that the checks run quickly
+retryArgs = {"retries":3, "backoff":0.01, "maxBackoff":0.05, "timeout":10.}
+
+
+#=========== Stand-in server ===========#
+class standInHandler(BaseHTTPRequestHandler):
+    # Set on the server: file contents, request log and counters
+    def log_message(self, format, *args):
+        pass
+
+    def _range(self):
+        # Start of the requested range, or 0
+        rangeHeader = self.headers.get("Range")
+        if rangeHeader is None or not rangeHeader.startswith("bytes="):
+            return 0
+        return int(rangeHeader[len("bytes="):].split("-")[0])
+
+    def _send(self, data=None, start=0, honourRange=True, stopAt=None):
+        if not honourRange:
+            start = 0
+        if start >= len(data):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(data))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)-start))
+        self.end_headers()
+        if stopAt is None:
+            self.wfile.write(data[start:])
+            return
+        # Drop the connection part of the way through
+        self.wfile.write(data[start:stopAt])
+        self.wfile.flush()
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+
+    def do_GET(self):
+        server = self.server
+        kind = self.path.strip("/").split("/")[0]
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Range")))
+            count = server.counts[self.path] = server.counts.get(self.path, 0) + 1
+        data = server.data
+        if kind == "ok":
+            self._send(data, self._range())
+        elif kind in ("drop", "norange"):
+            self._send(data, self._range(), honourRange=(kind == "drop"),
+                       stopAt=dropAt if count == 1 else None)
+        elif kind == "busy":
+            if count <= 2:
+                self.send_error(503)
+            else:
+                self._send(data, self._range())
+        elif kind == "slow":
+            with server.lock:
+                server.running += 1
+                server.maxRunning = max(server.maxRunning, server.running)
+            try:
+                time.sleep(slowDelay)
+                self._send(data, self._range())
+            finally:
+                with server.lock:
+                    server.running -= 1
+        else:
+            self.send_error(404)
+
+
+def startServer(data=None):
+    """
+    Starts the stand-in server on a free port on localhost, in a background
+    thread. Returns the server and its base URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), standInHandler)
+    server.daemon_threads = True
+    server.data = data
+    server.lock = threading.Lock()
+    server.requests = []
+    server.counts = {}
+    server.running = 0
+    server.maxRunning = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+#=========== Checks ===========#
+def runChecks():
+    data = os.urandom(fileSize)
+    sha256 = hashlib.sha256(data).hexdigest()
+    server, baseUrl = startServer(data=data)
+    tmpDir = tempfile.mkdtemp(prefix="checkAsyncDownload_")
+    results = []
+
+    def check(name=None, ok=None):
+        results.append(ok)
+        print("%s: %s" % ("PASS" if ok else "FAIL", name))
+
+    def fileData(ofile=None):
+        with open(ofile, "rb") as f:
+            return f.read()
+
+    def rangesFor(path=None):
+        return [r for p, r in server.requests if p == path]
+
+    try:
+        # Plain download, checked against its size and sha256
+        ofile = os.path.join(tmpDir, "ok.nc")
+        asyncDownload.downloadFile(url=baseUrl+"/ok/ok.nc", ofile=ofile, expectedSize=fileSize,
+                                   sha256=sha256, **retryArgs)
+        check("plain download", fileData(ofile) == data)
+
+        # Dropped connection, resumed with a Range request
+        ofile = os.path.join(tmpDir, "drop.nc")
+        asyncDownload.downloadFile(url=baseUrl+"/drop/drop.nc", ofile=ofile, sha256=sha256, **retryArgs)
+        ranges = rangesFor("/drop/drop.nc")
+        check("dropped connection is resumed",
+              fileData(ofile) == data and len(ranges) == 2 and ranges[0] is None
+              and ranges[1] is not None and ranges[1] != "bytes=0-")
+
+        # Dropped connection, and the server ignores the Range request
+        ofile = os.path.join(tmpDir, "norange.nc")
+        asyncDownload.downloadFile(url=baseUrl+"/norange/norange.nc", ofile=ofile, sha256=sha256, **retryArgs)
+        check("server ignoring Range starts the file again", fileData(ofile) == data)
+
+        # Partial file already complete (server answers 416): started again
+        ofile = os.path.join(tmpDir, "416.nc")
+        with open(ofile, "wb") as f:
+            f.write(os.urandom(fileSize + 10))
+        asyncDownload.downloadFile(url=baseUrl+"/ok/416.nc", ofile=ofile, sha256=sha256, **retryArgs)
+        check("416 (range not satisfiable) starts the file again", fileData(ofile) == data)
+
+        # 503 is retried with backoff
+        ofile = os.path.join(tmpDir, "busy.nc")
+        asyncDownload.downloadFile(url=baseUrl+"/busy/busy.nc", ofile=ofile, **retryArgs)
+        check("503 is retried", fileData(ofile) == data and server.counts["/busy/busy.nc"] == 3)
+
+        # 404 is raised straight away
+        ofile = os.path.join(tmpDir, "missing.nc")
+        try:
+            asyncDownload.downloadFile(url=baseUrl+"/missing/missing.nc", ofile=ofile, **retryArgs)
+            raised = False
+        except asyncDownload.downloadError as e:
+            raised = not e.retry
+        check("404 is not retried", raised and server.counts["/missing/missing.nc"] == 1)
+
+        # Wrong size and wrong checksum are errors, and the bad file is removed
+        for name, kwargs in [("size", {"expectedSize":fileSize+1}), ("checksum", {"sha256":"0"*64})]:
+            ofile = os.path.join(tmpDir, "bad_%s.nc" % name)
+            try:
+                asyncDownload.downloadFile(url=baseUrl+"/ok/bad_%s.nc" % name, ofile=ofile,
+                                           **dict(retryArgs, retries=0), **kwargs)
+                raised = False
+            except asyncDownload.downloadError:
+                raised = True
+            check("wrong %s is an error" % name, raised and not os.path.exists(ofile))
+
+        # Several downloads at once, at most maxPerHost from the server at a time
+        maxPerHost = 2
+        jobs = []
+        for i in range(6):
+            url = baseUrl+"/slow/slow%d.nc" % i
+            jobs.append((url, functools.partial(asyncDownload.downloadFile, url=url,
+                                                ofile=os.path.join(tmpDir, "slow%d.nc" % i), **retryArgs)))
+        start = time.time()
+        ofiles = asyncDownload.fetchAll(jobs=jobs, maxPerHost=maxPerHost, maxWorkers=8)
+        elapsed = time.time() - start
+        check("fetchAll downloads concurrently, at most maxPerHost at once",
+              all(fileData(f) == data for f in ofiles) and server.maxRunning == maxPerHost
+              and elapsed < len(jobs)*slowDelay)
+
+        # fetchAll raises once every download has finished if any of them failed
+        jobs = [(baseUrl+"/ok/all1.nc", functools.partial(asyncDownload.downloadFile, url=baseUrl+"/ok/all1.nc",
+                                                          ofile=os.path.join(tmpDir, "all1.nc"), **retryArgs)),
+                (baseUrl+"/missing/all2.nc", functools.partial(asyncDownload.downloadFile, url=baseUrl+"/missing/all2.nc",
+                                                               ofile=os.path.join(tmpDir, "all2.nc"), **retryArgs))]
+        try:
+            asyncDownload.fetchAll(jobs=jobs)
+            raised = False
+        except asyncDownload.downloadError:
+            raised = True
+        check("fetchAll reports failed downloads", raised and fileData(os.path.join(tmpDir, "all1.nc")) == data)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    print("%s of %s checks passed" % (sum(results), len(results)))
+    return all(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if runChecks() else 1)
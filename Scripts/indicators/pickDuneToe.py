@@ -18,10 +18,10 @@
 
 
 #=============== Modules ===============#
-import numpy as np
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
+from xbfewsTools import gridCache
 
 
 #=============== Variables ===============#
@@ -48,12 +48,11 @@ ifilePath = os.path.join(regionHome, "Data\\xbeach\\%s\\grd\\%s\\pre-storm\\%smA
 
 
 #=============== Specify/load grids ===============#
-xgrd = os.path.join(ifilePath,"x.grd")
-ygrd = os.path.join(ifilePath,"y.grd")
-zgrd = os.path.join(ifilePath,"z.grd")
-xx = np.loadtxt(xgrd,delimiter='\t')
-yy = np.loadtxt(ygrd,delimiter='\t')
-zz = np.loadtxt(zgrd,delimiter='\t')
+# Loaded from their binary cache (parsed once, see gridCache.py in xbfewsTools)
+grids = gridCache.loadGridBundle(ifilePath, names=("x","y","z"))
+xx = grids["x"]
+yy = grids["y"]
+zz = grids["z"]
 
 
 #=============== Plot profile ===============#
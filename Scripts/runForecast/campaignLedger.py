@@ -0,0 +1,250 @@
+#====================================================================================
+# campaignLedger.py
+
+# DESCRIPTION:
+# Keeps a record (a small SQLite database) of every stage run by run_forecast_loop.py,
+# so that a batch of hindcasts ("campaign") that dies part of the way through can be
+# restarted without redoing the work that has already been done. For each (system
+# time, site, module), the ledger stores:
+#     - a hash of the stage's inputs: the contents of the module's Python script,
+#     the source of the xbfewsTools library, its arguments, the size and modification
+#     time of its input files (e.g. the XBeach grids, hotspotLocations.csv), and the 
+#     input hashes of the stages it depends on. If anything upstream changes, the 
+#     hash of everything downstream of it changes too.
+#     - the stage's status ("running", "done" or "failed"), when it started and
+#     finished, and any error message
+#     - the files/folders the stage produces
+# When a campaign is restarted, planCampaign() marks a stage as "skipped" if it
+# finished successfully with the same inputs hash and its outputs still exist.
+# Some outputs (the BoM forecasts, the XBeach run directory and xboutput.nc) are
+# deleted by WipeForecast on purpose; these are only checked if the WipeForecast
+# stages that delete them haven't run since. If a stage that has to be rerun
+# needs one of these deleted outputs, the stage that produces it is rerun too.
+#====================================================================================
+
+
+import os
+import glob
+import json
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+
+# Files in input folders that are made from the other files there (the binary
+# grid caches, see gridCache.py in xbfewsTools, and their temporary files), and
+# so aren't inputs themselves
+derivedSuffixes = (".npy", ".npy.json", ".tmp")
+
+
+def pathsInfo(paths=None):
+    """
+    Returns a list of (path, size, modification time) of every file in paths.
+    Paths may be files or folders (every file inside them is listed), and may
+    contain wildcards. Paths that don't exist are listed with a size of None.
+    """
+    info = []
+    for p in paths:
+        matches = sorted(glob.glob(p))
+        if not matches:
+            info.append((p, None, None))
+        for match in matches:
+            if os.path.isdir(match):
+                files = []
+                for root, dirs, fnames in os.walk(match):
+                    dirs.sort()
+                    files.extend(os.path.join(root, fname) for fname in sorted(fnames)
+                                 if not fname.endswith(derivedSuffixes))
+            else:
+                files = [match]
+            for f in files:
+                st = os.stat(f)
+                info.append((f, st.st_size, st.st_mtime_ns))
+    return info
+
+
+def sourceHash(srcDir=None):
+    """
+    Hash of the contents of every Python file in a folder (e.g. the xbfewsTools
+    package), including sub-folders.
+    """
+    h = hashlib.sha256()
+    if srcDir is None or not os.path.isdir(srcDir):
+        h.update(str(srcDir).encode())
+        return h.hexdigest()
+    for root, dirs, fnames in os.walk(srcDir):
+        # Build folders hold old copies of the package that aren't imported
+        dirs[:] = sorted(d for d in dirs if d not in ("build", "dist", "__pycache__") and not d.endswith(".egg-info"))
+        for fname in sorted(fnames):
+            if fname.endswith(".py"):
+                h.update(os.path.relpath(os.path.join(root, fname), srcDir).replace("\\", "/").encode())
+                with open(os.path.join(root, fname), "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+
+class campaignLedger:
+
+    def __init__(self, dbPath=None, libraryDir=None):
+        self.dbPath = dbPath
+        # Hash of the xbfewsTools library the modules import, which is part of
+        # every stage's inputs hash
+        self.libraryHash = sourceHash(libraryDir)
+        # Stages may finish in several threads at once (see forecastScheduler.py),
+        # so the connection is shared and every query is locked
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(dbPath, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS stages (
+                                      systemTime TEXT NOT NULL,
+                                      site TEXT NOT NULL,
+                                      module TEXT NOT NULL,
+                                      inputsHash TEXT,
+                                      status TEXT,
+                                      outputs TEXT,
+                                      startedAt TEXT,
+                                      finishedAt TEXT,
+                                      error TEXT,
+                                      PRIMARY KEY (systemTime, site, module))""")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _keyValues(key):
+        # Cycle-wide stages have no site, which can't be part of the primary key
+        systemTime, site, module = key
+        return (systemTime, site if site is not None else "", module)
+
+    def getRecord(self, key):
+        """
+        Returns the ledger entry for a stage key (systemTime, site, module) as a
+        dictionary, or None if the stage has never been run.
+        """
+        with self._lock:
+            row = self._conn.execute("""SELECT inputsHash, status, outputs, startedAt, finishedAt, error
+                                        FROM stages WHERE systemTime=? AND site=? AND module=?""",
+                                     self._keyValues(key)).fetchone()
+        if row is None:
+            return None
+        return {"inputsHash":row[0], "status":row[1], "outputs":json.loads(row[2] or "[]"),
+                "startedAt":row[3], "finishedAt":row[4], "error":row[5]}
+
+    def _write(self, stage, status, startedAt=None, finishedAt=None, error=None):
+        outputs = json.dumps(list(stage.outputs) + list(stage.wipedOutputs))
+        with self._lock, self._conn:
+            self._conn.execute("""INSERT OR REPLACE INTO stages
+                                  (systemTime, site, module, inputsHash, status, outputs, startedAt, finishedAt, error)
+                                  VALUES (?,?,?,?,?,?,?,?,?)""",
+                               self._keyValues(stage.key) + (stage.inputsHash, status, outputs,
+                                                         startedAt, finishedAt, error))
+
+    def markStarted(self, stage):
+        self._write(stage, "running", startedAt=datetime.now().isoformat())
+
+    def markDone(self, stage):
+        record = self.getRecord(stage.key)
+        startedAt = record["startedAt"] if record is not None else None
+        self._write(stage, "done", startedAt=startedAt, finishedAt=datetime.now().isoformat())
+
+    def markFailed(self, stage, error=None):
+        record = self.getRecord(stage.key)
+        startedAt = record["startedAt"] if record is not None else None
+        self._write(stage, "failed", startedAt=startedAt, finishedAt=datetime.now().isoformat(),
+                    error=str(error))
+
+    @staticmethod
+    def _pathsExist(paths):
+        # Paths may contain wildcards, e.g. when the exact file name is only known by the module
+        return all(len(glob.glob(p)) > 0 for p in paths)
+
+    def stageHash(self, stage, depHashes):
+        """
+        Computes the inputs hash of a stage from its script, the xbfewsTools library,
+        its arguments, its input files, and the inputs hashes of the stages it 
+        depends on.
+        """
+        h = hashlib.sha256()
+        h.update(stage.module.encode())
+        h.update(self.libraryHash.encode())
+        # Only the contents of Python scripts are hashed. The XBeach executable
+        # lives in the run directory, which WipeForecast deletes.
+        if stage.script is not None and stage.script.endswith(".py") and os.path.exists(stage.script):
+            with open(stage.script, "rb") as f:
+                h.update(f.read())
+        else:
+            h.update(str(stage.script).encode())
+        for arg in stage.args:
+            h.update(str(arg).encode())
+        # Input files are checked by size and modification time only, rather than
+        # hashing their contents (the grids and BoM forecasts are large)
+        for path, size, mtime in pathsInfo(stage.inputs):
+            h.update(("%s|%s|%s" % (path, size, mtime)).encode())
+        for depHash in depHashes:
+            h.update(depHash.encode())
+        return h.hexdigest()
+
+    def _isWiped(self, stage, record):
+        # True if a WipeForecast stage that deletes this stage's outputs ran after it
+        for wipeKey in stage.wipedBy:
+            wipeRecord = self.getRecord(wipeKey)
+            if (wipeRecord is not None and wipeRecord["status"] == "done"
+                    and wipeRecord["finishedAt"] >= record["finishedAt"]):
+                return True
+        return False
+
+    def hashStages(self, scheduler):
+        """
+        Sets the inputs hash of every stage in the scheduler.
+        """
+        # Stages are added to the scheduler after the stages they depend on, so
+        # every dependency's hash is known by the time it is needed
+        for stage in scheduler.stages:
+            stage.inputsHash = self.stageHash(stage, [scheduler.getStage(k).inputsHash for k in stage.deps])
+
+    def planCampaign(self, scheduler):
+        """
+        Works out which stages of the campaign can be skipped, and marks them
+        with the status "skipped" in the scheduler. Also sets the inputs hash of
+        every stage. Returns the number of stages skipped.
+        """
+        stages = scheduler.stages
+        self.hashStages(scheduler)
+
+        # Stages that have to be rerun, either because they never finished, their
+        # inputs have changed, or their outputs are missing
+        toRun = set()
+        for stage in stages:
+            record = self.getRecord(stage.key)
+            if (record is None or record["status"] != "done"
+                    or record["inputsHash"] != stage.inputsHash
+                    or not self._pathsExist(stage.outputs)
+                    or not (self._pathsExist(stage.wipedOutputs) or self._isWiped(stage, record))
+                    or any(k in toRun for k in stage.deps)):
+                toRun.add(stage.key)
+
+        # Rerun any skipped stage whose deleted outputs are needed by a stage that is rerun.
+        # Going backwards means the dependencies of a newly added stage are checked too.
+        # WipeForecast only waits for the other stages, it doesn't need their outputs.
+        for stage in reversed(stages):
+            if stage.key not in toRun or stage.module == "WipeForecast":
+                continue
+            for k in stage.deps:
+                dep = scheduler.getStage(k)
+                if k not in toRun and not self._pathsExist(dep.wipedOutputs):
+                    toRun.add(k)
+
+        # Clean up again after anything that is rerun
+        for stage in stages:
+            if stage.module == "WipeForecast" and any(k in toRun for k in stage.deps):
+                toRun.add(stage.key)
+
+        nSkipped = 0
+        for stage in stages:
+            if stage.key not in toRun:
+                stage.status = "skipped"
+                nSkipped += 1
+        return nSkipped
+
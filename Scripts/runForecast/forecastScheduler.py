@@ -0,0 +1,209 @@
+#====================================================================================
+# forecastScheduler.py
+
+# DESCRIPTION:
+# Runs the stages (external modules and XBeach runs) of a batch of forecasts/
+# hindcasts as a dependency graph, instead of strictly one after another. Used by
+# run_forecast_loop.py. Each stage is one module run for a given system time
+# (cycle) and, where relevant, a given hotspot, e.g.:
+#     initFEWSForecast -> NSSDownload -> WaveDownload -> PreProcessXBeach
+#     -> XBeach -> PostProcessXBeach -> IndicatorsXBeach -> WipeForecast
+# A stage starts as soon as all of the stages it depends on have finished, so
+# independent (cycle, hotspot) pairs can run at the same time. The number of
+# stages running at once is limited by the number of workers, and XBeach runs
+# (and any other stage given a "resource") are further limited by the number of
+# slots given for that resource. The start time, end time and duration of each
+# stage are recorded so that they can be reported at the end of the batch.
+# Stages marked as "skipped" before the batch is run (see campaignLedger.py) are
+# treated as if they had already finished.
+#====================================================================================
+
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class forecastStage:
+
+    def __init__(self, module, systemTime, site=None, script=None, args=None,
+                 deps=None, resource=None, cwd=None, outputs=None, wipedOutputs=None,
+                 wipedBy=None, inputs=None):
+        # Name of the module (e.g. "PreProcessXBeach", "XBeach")
+        self.module = module
+        # System time of the cycle, format YYYYMMDD_HHMM
+        self.systemTime = systemTime
+        # Hotspot or region the stage runs for (None for cycle-wide stages)
+        self.site = site
+        # Python script/executable and its arguments
+        self.script = script
+        self.args = args if args is not None else []
+        # Working directory to run the stage in (None: current directory)
+        self.cwd = cwd
+        # Keys of the stages that must finish before this one starts
+        self.deps = list(deps) if deps is not None else []
+        # Limited resource the stage needs a slot of (e.g. "xbeach")
+        self.resource = resource
+        # Files/folders the stage produces. Used to check whether the stage needs 
+        # to be rerun when a campaign is restarted (see campaignLedger.py). 
+        # wipedOutputs are deleted by the WipeForecast stages listed in wipedBy.
+        self.outputs = list(outputs) if outputs is not None else []
+        self.wipedOutputs = list(wipedOutputs) if wipedOutputs is not None else []
+        self.wipedBy = list(wipedBy) if wipedBy is not None else []
+        # Input files/folders the stage reads, other than the outputs of the stages
+        # it depends on (e.g. the XBeach grids). Their sizes and modification times
+        # are part of the stage's inputs hash (see campaignLedger.py).
+        self.inputs = list(inputs) if inputs is not None else []
+        self.inputsHash = None
+        # Status: "pending", "running", "done", "failed", "cancelled" or "skipped"
+        self.status = "pending"
+        self.startTime = None
+        self.endTime = None
+        self.error = None
+
+    @property
+    def key(self):
+        return (self.systemTime, self.site, self.module)
+
+    @property
+    def duration(self):
+        if self.startTime is None or self.endTime is None:
+            return None
+        return (self.endTime - self.startTime).total_seconds()
+
+    def __repr__(self):
+        return "%s (%s, %s)" % (self.module, self.systemTime, self.site)
+
+
+class forecastScheduler:
+
+    def __init__(self, maxWorkers=1, resourceSlots=None, stopOnFailure=True):
+        # Maximum number of stages running at once
+        self.maxWorkers = int(maxWorkers)
+        # Maximum number of stages running at once for each resource,
+        # e.g. {"xbeach": 2}
+        self.resourceSlots = resourceSlots if resourceSlots is not None else {}
+        # If True, no new stages are started once a stage fails (this mimics
+        # the original serial loop). If False, only the stages that depend on
+        # the failed stage are cancelled, and everything else keeps running.
+        self.stopOnFailure = stopOnFailure
+        # Stages, in the order they were added. With a single worker the
+        # stages run in this order.
+        self.stages = []
+        self._stagesByKey = {}
+
+    def addStage(self, stage):
+        """
+        Adds a stage to the graph. Its dependencies must already have been
+        added. Returns the key of the stage so later stages can depend on it.
+        """
+        for dep in stage.deps:
+            if dep not in self._stagesByKey:
+                raise ValueError("Stage %s depends on %s, which has not been added." % (stage, dep))
+        if stage.key in self._stagesByKey:
+            raise ValueError("Stage %s has already been added." % stage)
+        self.stages.append(stage)
+        self._stagesByKey[stage.key] = stage
+        return stage.key
+
+    def getStage(self, key):
+        return self._stagesByKey[key]
+
+    def _cancelDependents(self, key):
+        # Cancel every pending stage downstream of a failed/cancelled stage
+        for stage in self.stages:
+            if stage.status == "pending" and key in stage.deps:
+                stage.status = "cancelled"
+                self._cancelDependents(stage.key)
+
+    def _isReady(self, stage, running):
+        if stage.status != "pending":
+            return False
+        if any(self._stagesByKey[dep].status not in ("done","skipped") for dep in stage.deps):
+            return False
+        if stage.resource is not None:
+            slots = self.resourceSlots.get(stage.resource, self.maxWorkers)
+            inUse = sum(1 for s in running if s.resource == stage.resource)
+            if inUse >= slots:
+                return False
+        return True
+
+    def _runStage(self, stage, runStage):
+        stage.startTime = datetime.now()
+        try:
+            runStage(stage)
+        finally:
+            stage.endTime = datetime.now()
+
+    def run(self, runStage=None):
+        """
+        Runs all of the stages, respecting their dependencies and the worker
+        and resource limits.
+
+        INPUTS:
+            - runStage: function that runs a single stage. Takes the stage as
+              its only argument, and raises an error if the stage fails.
+
+        Raises a RuntimeError listing the failed stages once everything that
+        can run has run.
+        """
+        running = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            while True:
+                # Start every stage that is ready, in the order they were added
+                if not (self.stopOnFailure and failed):
+                    for stage in self.stages:
+                        if len(running) >= self.maxWorkers:
+                            break
+                        if self._isReady(stage, running.values()):
+                            stage.status = "running"
+                            future = executor.submit(self._runStage, stage, runStage)
+                            running[future] = stage
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        stage.status = "done"
+                    else:
+                        stage.status = "failed"
+                        stage.error = error
+                        failed.append(stage)
+                        self._cancelDependents(stage.key)
+        # Anything still pending could not run because of a failure
+        for stage in self.stages:
+            if stage.status == "pending":
+                stage.status = "cancelled"
+        if failed:
+            raise RuntimeError("%s stage(s) failed: %s" % (len(failed),
+                               "; ".join("%s: %s" % (s, s.error) for s in failed)))
+
+    def timingsTable(self):
+        """
+        Returns a pandas dataframe with the status and timing of every stage.
+        """
+        import pandas as pd
+        df = pd.DataFrame({"systemTime":[s.systemTime for s in self.stages],
+                           "site":[s.site for s in self.stages],
+                           "module":[s.module for s in self.stages],
+                           "status":[s.status for s in self.stages],
+                           "start":[s.startTime for s in self.stages],
+                           "end":[s.endTime for s in self.stages],
+                           "duration_s":[s.duration for s in self.stages]})
+        return df
+
+    def reportTimings(self, ofile=None):
+        """
+        Prints a summary of how long each module took over the batch, and
+        optionally writes the timing of every stage out to a csv file.
+        """
+        df = self.timingsTable()
+        if ofile is not None:
+            df.to_csv(ofile, index=False)
+        summary = df[df["duration_s"].notnull()].groupby("module", sort=False)["duration_s"].agg(
+                        ["count","mean","max","sum"]).round(1)
+        print("********************** Stage timings (seconds) **********************")
+        print(summary.to_string())
+        return summary
@@ -0,0 +1,103 @@
+#====================================================================================
+# moduleRunner.py
+
+# DESCRIPTION:
+# Runs the FEWS external modules (Python scripts) in-process, by importing each
+# module once and calling its main() function with the module's arguments, instead
+# of starting a new Python interpreter for every module run. Starting a new
+# interpreter means importing geopandas, xarray, shapely, rasterio, pyproj, etc.
+# all over again, which takes several seconds each time. Used by
+# run_forecast_loop.py when inProcess_flag is set to True.
+
+# Modules can either be run in the same process as run_forecast_loop.py, or in a
+# pool of "warm" worker processes (warmModulePool) that have already imported the
+# heavy libraries. The worker pool is used when running modules in parallel,
+# because the libraries that read/write netcdf and GIS files are not thread-safe.
+
+# The modules themselves are unchanged when run by FEWS: the General Adapter still
+# calls them from the command line, and main() then reads its arguments from
+# sys.argv.
+#====================================================================================
+
+
+import os
+import hashlib
+import importlib
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Libraries imported by every worker process in the warm pool before any modules
+# are run
+warmImports = ["numpy", "pandas", "xarray", "netCDF4", "geopandas", "shapely",
+               "pyproj", "rasterio", "xbfewsTools"]
+
+# Modules that have already been imported, keyed by script path
+_loadedModules = {}
+
+
+def loadModule(script=None):
+    """
+    Imports a module script (e.g. preprocessMain.py) from its path, or returns the
+    already imported module if it has been loaded before and not changed since.
+
+    INPUTS:
+        - script: path to the module's Python script
+
+    OUTPUTS:
+        - The imported module
+    """
+    script = os.path.abspath(script)
+    mtime = os.path.getmtime(script)
+    if script in _loadedModules and _loadedModules[script][0] == mtime:
+        return _loadedModules[script][1]
+    # Scripts from different modules may share a name, so the name of the imported
+    # module is made unique using the path
+    name = "fewsModule_%s_%s" % (os.path.splitext(os.path.basename(script))[0],
+                                 hashlib.md5(script.encode()).hexdigest()[:8])
+    spec = importlib.util.spec_from_file_location(name, script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _loadedModules[script] = (mtime, module)
+    return module
+
+
+def runModuleInProcess(script=None, args=None):
+    """
+    Runs a module script in the current process, by calling its main() function.
+
+    INPUTS:
+        - script: path to the module's Python script
+        - args: the specific arguments the above script takes (the same list of
+          strings that would be passed on the command line)
+    """
+    module = loadModule(script)
+    module.main(list(args) if args is not None else [])
+
+
+def _warmUp():
+    # Runs once in each worker process when the pool starts
+    for name in warmImports:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+class warmModulePool:
+
+    def __init__(self, nWorkers=1):
+        # Number of worker processes
+        self.nWorkers = int(nWorkers)
+        self._executor = ProcessPoolExecutor(max_workers=self.nWorkers, initializer=_warmUp)
+
+    def run(self, script=None, args=None):
+        """
+        Runs a module script in one of the worker processes, and waits for it to
+        finish. Errors raised by the module are raised again here.
+        """
+        future = self._executor.submit(runModuleInProcess, script, list(args) if args is not None else [])
+        return future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
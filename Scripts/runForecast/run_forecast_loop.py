@@ -36,6 +36,38 @@
 #     - PostProcessXBeach_flag: "True" to run module, "False" to not.
 #     - IndicatorsXBeach_flag: "True" to run module, "False" to not.
 #     - WipeForecast_flag: "True" to run module, "False" to not.
+#     - parallel_flag: "True" to run independent (system time, hotspot) pairs at the
+#     same time (see forecastScheduler.py), "False" to run every module one after the
+#     other, as FEWS does.
+#     Only one run of each module is run at a time, since the runs of a module share
+#     its working directory (diag.xml, exceptions.log).
+#     - maxWorkers: Maximum number of modules running at once when parallel_flag is True
+#     - maxXBeachRuns: Maximum number of XBeach simulations running at once when 
+#     parallel_flag is True. XBeach runs are by far the most CPU/memory hungry stage, so 
+#     this is normally set lower than maxWorkers.
+#     - postProcWorkers: Number of worker processes each PostProcessXBeach and 
+#     IndicatorsXBeach run spreads its per-timestep exports over. Worked out from 
+#     maxWorkers: with parallel_flag, the cores not taken by XBeach runs are split 
+#     between the two modules, so the total stays within maxWorkers.
+#     - resume_flag: "True" to skip any module runs that already finished successfully
+#     in a previous attempt at the same batch of hindcasts, with the same inputs, and 
+#     whose outputs still exist (see campaignLedger.py). "False" to rerun everything. 
+#     Either way, every module run is recorded in campaignLedger.db. The inputs of a 
+#     module run include its script, the xbfewsTools library and the size/modification
+#     time of the input data it reads (e.g. the XBeach grids in Data\xbeach).
+#     - inProcess_flag: "True" to import each module once and call its main() function
+#     directly (see moduleRunner.py), rather than starting a new Python interpreter for
+#     every module run. "False" to run each module from the command line, as FEWS does.
+#     - warmPool_flag: When inProcess_flag is True, "True" runs the modules in a pool
+#     of worker processes that have already imported the heavy libraries (geopandas,
+#     xarray, etc.). Always used when parallel_flag is True. "False" runs the modules
+#     in this process.
+#     - incrementalPostProc_flag: "True" to read the XBeach output while XBeach is still
+#     running (tailXBeachOutput.py in the PostProcessXBeach module), so that the 
+#     PostProcessXBeach module only has to export the results once XBeach has finished. 
+#     "False" to read the whole output file after XBeach has finished, as FEWS does.
+#     - tailPollInterval: Seconds between reads of the XBeach output when 
+#     incrementalPostProc_flag is True.
 
 # For inputs pertaining to the individual modules, see their relevant code blocks. 
 
@@ -49,6 +81,12 @@ import zipfile
 import sys
 import traceback
 import subprocess
+import threading
+import importlib.util
+from xbfewsTools import fewsUtils
+from forecastScheduler import forecastStage, forecastScheduler
+from campaignLedger import campaignLedger
+from moduleRunner import runModuleInProcess, warmModulePool
 
 # Full script resides in this "main" function so that
 # the script can receive command-line arguments from 
@@ -70,6 +108,34 @@ def main(args=None):
     IndicatorsXBeach_flag = True
     WipeForecast_flag = True
 
+    # Parallel execution
+    # Set as True to run independent system times/hotspots at the same time, 
+    # limited by maxWorkers and maxXBeachRuns
+    parallel_flag = False
+    maxWorkers = 4
+    maxXBeachRuns = 2
+    # Worker processes for the post-processing/indicator exports. Only one module
+    # runs at a time when parallel_flag is False, so it can use all of maxWorkers.
+    if parallel_flag:
+        postProcWorkers = max(1, (maxWorkers - maxXBeachRuns)//2)
+    else:
+        postProcWorkers = maxWorkers
+
+    # Resuming a batch of hindcasts
+    # Set as True to skip module runs that already finished in a previous attempt
+    resume_flag = False
+
+    # In-process module runs
+    # Set as True to call each module's main() function directly, rather than 
+    # starting a new Python interpreter each time
+    inProcess_flag = False
+    warmPool_flag = True
+
+    # Incremental post-processing
+    # Set as True to post-process the XBeach output while XBeach is running
+    incrementalPostProc_flag = False
+    tailPollInterval = 30
+
 
     #============== Arguments from run_forecast_loop*.bat file =============#
     args = [a for a in sys.argv[1:] if not a.startswith("-")]
@@ -124,6 +190,20 @@ def main(args=None):
     moduleDataSetDir = os.path.join(regionHomeDir,"Config\\ModuleDataSetFiles")
     # Any python-related errors dumped here
     logf = open(os.path.join(workDir,"exceptions_forecastLoop.log"), "w")
+    # Timing of each module run dumped here
+    timingsFile = os.path.join(workDir,"stageTimings_forecastLoop.csv")
+    # Record of every module run, used to resume a batch of hindcasts
+    ledgerFile = os.path.join(workDir,"campaignLedger.db")
+    # Input data the modules read, part of the inputs hash of each module run (see 
+    # campaignLedger.py)
+    dataDir = os.path.join(regionHomeDir,"Data")
+    # xbfewsTools library the modules import. Its source is part of the inputs hash
+    # of every module run, so that changes to the library rerun the modules.
+    xbfewsToolsSpec = importlib.util.find_spec("xbfewsTools")
+    if xbfewsToolsSpec is not None and xbfewsToolsSpec.origin is not None:
+        xbfewsToolsDir = os.path.dirname(xbfewsToolsSpec.origin)
+    else:
+        xbfewsToolsDir = os.path.join(regionHomeDir,"bin\\windows\\python\\bin\\conda-venv\\Lib\\site-packages\\xbfewsTools")
 
 
 
@@ -154,30 +234,126 @@ def main(args=None):
         os.remove(destPath)
 
 
-    def runModule(script=None, args=None):
+    # Modules may run in several threads at once, so writes to the log file are locked
+    logLock = threading.Lock()
+
+    # Pool of worker processes for running modules in-process. Needed when running in
+    # parallel, since the netcdf/GIS libraries the modules use are not thread-safe.
+    if inProcess_flag and (warmPool_flag or parallel_flag):
+        modulePool = warmModulePool(nWorkers=maxWorkers if parallel_flag else 1)
+    else:
+        modulePool = None
+
+    def runModule(script=None, args=None, cwd=None):
         """
         Description: Mimics the way FEWS runs external modules (meaing that it basically
         runs a Python script.) Throws an error if there are any errors raised in the
         relevant python scripts.
 
         Inputs:
-           - script: the Python script to run
+           - script: the Python script to run (or, for XBeach, the executable)
            - args: the specific arguments the above script takes
+           - cwd: directory to run the script in. XBeach has to be run from the 
+           directory xbeach.exe is in. None runs it in the current directory.
         """ 
+        # Call the module's main() function directly, either in a warm worker process or 
+        # in this one
+        if inProcess_flag and script.endswith(".py"):
+            try:
+                if modulePool is not None:
+                    modulePool.run(script=script, args=args)
+                else:
+                    runModuleInProcess(script=script, args=args)
+            # If there is an error, send it to the log file.
+            except Exception as e:
+                with logLock:
+                    logf.write("Failed. %s %s: %s\n" % (script, " ".join(args), str(e)))
+                    logf.write(traceback.format_exc())
+                    logf.write('Recorded at %s.\n' % (datetime.now()))
+                    logf.flush()
+                raise RuntimeError("module '{}' returned with error: {}".format(script, e))
+            return
         try:
             # Each external FEWS module takes on its own individual arguments
             arguments = " ".join(args)
-            command = "python %s %s" % (script, arguments)
+            if script.endswith(".py"):
+                command = "python %s %s" % (script, arguments)
+            else:
+                command = script
             #subprocess.check_output(command,shell=True,stderr=subprocess.STDOUT)
-            subprocess.run(command, check=True, shell=True)
+            subprocess.run(command, check=True, shell=True, cwd=cwd)
         # If there is an error, send it to the log file. We want each module to be run
         # each time. 
         except subprocess.CalledProcessError as e:
-            logf.write("Failed. {0}\n".format(str(e)))
-            logf.write('Recorded at %s.\n' % (datetime.now()))
+            with logLock:
+                logf.write("Failed. {0}\n".format(str(e)))
+                logf.write('Recorded at %s.\n' % (datetime.now()))
+                logf.flush()
             raise RuntimeError("command '{}' return with error (code {}): {}".format(e.cmd, e.returncode, e.output))
 
 
+    # Script and arguments of the script that reads the output of each XBeach run
+    # while it is running (incrementalPostProc_flag), keyed by XBeach stage
+    tailers = {}
+
+    def runXBeachTailed(stage=None):
+        """
+        Description: Runs XBeach, and tailXBeachOutput.py alongside it to read the
+        XBeach output as it is written. Once XBeach exits, its exit code is written to 
+        xbeachFinished.txt in the run directory, which tells tailXBeachOutput.py to 
+        read the rest of the output and save the results. Throws an error if XBeach
+        fails. If only tailXBeachOutput.py fails, the error is logged and the 
+        PostProcessXBeach module reads the whole output file itself.
+        """
+        tailScript, tailArgs = tailers[stage.key]
+        finishedFile = os.path.join(stage.cwd, "xbeachFinished.txt")
+        if os.path.exists(finishedFile):
+            os.remove(finishedFile)
+        tail = subprocess.Popen("python %s %s" % (tailScript, " ".join(tailArgs)), shell=True)
+        returnCode = subprocess.run(stage.script, shell=True, cwd=stage.cwd).returncode
+        with fewsUtils.atomicWrite(finishedFile, "w") as f:
+            f.write(str(returnCode))
+        tailReturnCode = tail.wait()
+        # Reads of the XBeach output that failed while XBeach was running
+        tailLog = os.path.join(stage.cwd, "tailXBeachOutput.log")
+        if os.path.exists(tailLog) and os.path.getsize(tailLog) > 0:
+            with open(tailLog) as f, logLock:
+                logf.write("%s (%s): %s" % (os.path.basename(tailScript), stage, f.read()))
+                logf.flush()
+        if tailReturnCode != 0:
+            with logLock:
+                logf.write("Failed (XBeach output is post-processed once XBeach has finished instead). "
+                           "%s %s: exit code %s\n" % (tailScript, " ".join(tailArgs), tailReturnCode))
+                logf.write('Recorded at %s.\n' % (datetime.now()))
+                logf.flush()
+        if returnCode != 0:
+            with logLock:
+                logf.write("Failed. {0} returned exit code {1}\n".format(stage.script, returnCode))
+                logf.write('Recorded at %s.\n' % (datetime.now()))
+                logf.flush()
+            raise RuntimeError("command '{}' return with error (code {})".format(stage.script, returnCode))
+
+
+    def runStage(stage=None):
+        """
+        Description: Runs a single stage of the forecast loop (see forecastScheduler.py)
+        and informs the user which module is being run.
+        """
+        sysTime_dt = datetime.strptime(stage.systemTime, '%Y%m%d_%H%M')
+        print("*********Running %s module for time: %s GMT (%s) *********" % (stage.module,sysTime_dt,stage.site))
+        ledger.markStarted(stage)
+        try:
+            if stage.key in tailers:
+                runXBeachTailed(stage=stage)
+            else:
+                runModule(script=stage.script,args=stage.args,cwd=stage.cwd)
+        except Exception as e:
+            ledger.markFailed(stage, e)
+            raise
+        ledger.markDone(stage)
+        print("*********Finished %s module for time: %s GMT (%s) *********" % (stage.module,sysTime_dt,stage.site))
+
+
     #============================== Load location sets ==============================#
     # Mimics what FEWS does, which is that it loops through Location Sets
     # Two location sets are relevant here: the regional location set, which consists
@@ -213,8 +389,46 @@ def main(args=None):
     forecastTimes_str = [pd.to_datetime(str(date_obj)) for date_obj in forecastTimes]
     forecastTimes_str = [date_obj.strftime('%Y%m%d_%H%M') for date_obj in forecastTimes_str]
 
+    # Rather than running each module straight away, each module run is added as a 
+    # "stage" to the scheduler, along with the stages it has to wait for. The stages
+    # are then all run at the end (see forecastScheduler.py). With a single worker, 
+    # the stages are run in the same order as the loop below.
+    # - Modules that are run once per system time and region (initialising, downloading
+    # and pre-processing the regional forecast) are run one after another, because 
+    # they all read/write the same forecast.pkl file.
+    # - Each hotspot then runs its own chain (PreProcessXBeach -> XBeach -> 
+    # PostProcessXBeach -> IndicatorsXBeach) once the downloads are done.
+    # - WipeForecast deletes the downloaded BoM forecasts, so it waits until every
+    # hotspot for that system time has been pre-processed.
+    # - Every run of a module shares the module's working directory, including its 
+    # diag.xml and exceptions.log, so only one run of each module (e.g. the 
+    # PreProcessXBeach module for two hotspots) runs at a time. The resource of each
+    # module stage is the name of its working directory.
+    if parallel_flag:
+        # If a stage fails, keep running the system times/hotspots that don't depend on it
+        moduleSlots = {m:1 for m in ["initFEWSForecast","NSSDownload","WaveDownload","PreProcessRegional",
+                                     "PreProcessXBeach","PostProcessXBeach","IndicatorsXBeach","WipeForecast"]}
+        scheduler = forecastScheduler(maxWorkers=maxWorkers,
+                                      resourceSlots=dict(moduleSlots, xbeach=maxXBeachRuns),
+                                      stopOnFailure=False)
+    else:
+        scheduler = forecastScheduler(maxWorkers=1, stopOnFailure=True)
+
     # Loop through hindcast times
     for systemTime in forecastTimes_str:
+        # Date/time of current hindcast being looped through. 
+        sysTime_dt = datetime.strptime(systemTime, '%Y%m%d_%H%M')
+        # Directory of the current forecast
+        forecastDir = os.path.join(regionHomeDir,"Forecasts",systemTime)
+        # Stages that the next system time/region-wide stage has to wait for
+        cycleDeps = []
+        # Stages whose outputs (the BoM forecasts) are deleted by every WipeForecast 
+        # stage for this system time
+        wipedByAllStages = []
+        # Pre-processing stages for this system time, which WipeForecast waits for
+        preProcessKeys = []
+        # WipeForecast stages, added once every hotspot for this system time has been added
+        wipeStages = []
         # Loop through regions (specified in ausStates.csv location set file, regions are Australian states)
         for region in regions:
 
@@ -228,17 +442,19 @@ def main(args=None):
             sysTime_dt = datetime.strptime(systemTime, '%Y%m%d_%H%M')
             # Only run if flag is set to True
             if initFEWSForecast_flag:
-                # Inform user which module is being run.
-                print("**********************Running initialization module for time: %s GMT **********************" % sysTime_dt)
                 # Working directory, location of below python script
                 workDir_initializeForecastPy = os.path.join(moduleDir,"initFEWSForecast")
                 # Python script being called for this module
                 initializeForecastPy = os.path.join(workDir_initializeForecastPy,"python\\initializeForecast.py")
                 # Arguments for the above Python script
                 arguments = [regionHomeDir,systemTime,region,workDir_initializeForecastPy]
-                # Run the module (i.e. run the python script), calling the function runModule defined 
-                # above
-                runModule(script=initializeForecastPy,args=arguments)
+                # Add the module run (i.e. the python script) to the scheduler. It is run 
+                # by the function runStage defined above, once the stages it depends on are done
+                stageKey = scheduler.addStage(forecastStage("initFEWSForecast", systemTime, site=region, script=initializeForecastPy,
+                                                            args=arguments, deps=cycleDeps, resource="initFEWSForecast",
+                                                            inputs=[ausStates, hotspots],
+                                                            outputs=[os.path.join(forecastDir,"forecast.pkl")]))
+                cycleDeps = [stageKey]
 
 
             # =========================== Initialize Regional Forecast Module ===========================#
@@ -253,17 +469,17 @@ def main(args=None):
             hotspotIDs = hotspots_subset['ID'].unique()
             # Only run if flag is set to True
             if initRegionalForecast_flag:
-                # Inform user which module is being run.
-                print("**************** Initializing regional forecast for time: %s GMT ****************" % sysTime_dt)
                 # Working directory, location of below python script
                 workDir_initializeForecastPy = os.path.join(moduleDir,"initFEWSForecast")
                 # Python script being called for this module
                 initializeRegionalPy = os.path.join(workDir_initializeForecastPy,"python\\initializeRegional.py")
                 # Arguments for the above Python script
                 arguments = [regionHomeDir,systemTime,region,workDir_initializeForecastPy]
-                # Run the module (i.e. run the python script), calling the function runModule defined 
-                # above
-                runModule(script=initializeRegionalPy,args=arguments)
+                # Add the module run (i.e. the python script) to the scheduler. It is run 
+                # by the function runStage defined above, once the stages it depends on are done
+                stageKey = scheduler.addStage(forecastStage("initRegionalForecast", systemTime, site=region, script=initializeRegionalPy,
+                                                            args=arguments, deps=cycleDeps, resource="initFEWSForecast"))
+                cycleDeps = [stageKey]
 
 
                 
@@ -277,17 +493,20 @@ def main(args=None):
                 if initHotspotForecast_flag:
                     # Loop through hotspots in a given region (state)
                     for hotspotName in hotspotIDs:
-                        # Inform user which module is being run. 
-                        print("*********** Initializing hotspot forecast for %s site in %s... ***********" %(hotspotName,region))
                         # Working directory, location of below python script
                         workDir_initializeHotspotPy = os.path.join(moduleDir,"initFEWSForecast")
                         # Python script being called for this module
                         initializeHotspotPy = os.path.join(workDir_initializeForecastPy,"python\\initializeHotspot.py")
                         # Arguments for the above Python script
                         arguments = [regionHomeDir,systemTime,hotspotName,workDir_initializeHotspotPy]
-                        # Run the module (i.e. run the python script), calling the function runModule defined 
-                        # above
-                        runModule(script=initializeHotspotPy,args=arguments)
+                        # Add the module run (i.e. the python script) to the scheduler. It is run 
+                        # by the function runStage defined above, once the stages it depends on are done
+                        stageKey = scheduler.addStage(forecastStage("initHotspotForecast", systemTime, site=hotspotName, script=initializeHotspotPy,
+                                                                    args=arguments, deps=cycleDeps, resource="initFEWSForecast",
+                                                                    inputs=[hotspots],
+                                                                    outputs=[os.path.join(forecastDir,region,"hotspot",hotspotName,
+                                                                                          "forecast_hotspot.pkl")]))
+                        cycleDeps = [stageKey]
 
 
 
@@ -301,10 +520,14 @@ def main(args=None):
             # If running a forecast, the code will automatically pull it from the BoM's servers.
             # See RetrieveNSSAdapter.xml
             
+            # The storm surge and wave downloads only read forecast.pkl (retrieveNSS.py 
+            # rewrites it unchanged, atomically), so they both wait for the same stages
+            # and can run at the same time. The next stages wait for both.
+            downloadDeps = list(cycleDeps)
+            downloadKeys = []
+
             # Only run if flag is set to True
             if NSSDownload_flag:
-                # Inform user which module is being run. 
-                print("*********Running NSSDownload module for time: %s GMT *********" % sysTime_dt)
                 # Working directory, location of below python script
                 workDir_RetrieveNSS = os.path.join(moduleDir,"NSSDownload")
                 # Python script being called for this module
@@ -314,9 +537,17 @@ def main(args=None):
                 serverLoc = surgeLocation
                 # Arguments for the above Python script
                 arguments = [regionHomeDir, systemTime, workDir_RetrieveNSS, serverLoc]
-                # Run the module (i.e. run the python script), calling the function runModule defined 
-                # above
-                runModule(script=retrieveNSSPy,args=arguments)
+                # Add the module run (i.e. the python script) to the scheduler. It is run 
+                # by the function runStage defined above, once the stages it depends on are done
+                # Downloaded storm surge forecast and its subset, deleted by WipeForecast
+                surgeFile = os.path.join(workDir_RetrieveNSS,"ncFiles",
+                                         "IDZ00154_StormSurge_national_%s.nc" % sysTime_dt.strftime('%Y%m%d%H'))
+                surgeSubsetFile = surgeFile.replace(".nc","_subset.nc")
+                stageKey = scheduler.addStage(forecastStage("NSSDownload", systemTime, site=region, script=retrieveNSSPy,
+                                                            args=arguments, deps=downloadDeps, resource="NSSDownload",
+                                                            wipedOutputs=[surgeFile, surgeSubsetFile]))
+                downloadKeys.append(stageKey)
+                wipedByAllStages.append(scheduler.getStage(stageKey))
 
 
 
@@ -331,8 +562,6 @@ def main(args=None):
             
             # Only run if flag is set to True
             if WaveDownload_flag:
-                # Inform user which module is being run. 
-                print("*********Running WaveDownload module for time: %s GMT *********" % sysTime_dt)
                 # Working directory, location of below python script
                 workDir_RetrieveAusWaves = os.path.join(moduleDir,"WaveDownload")
                 # Python script being called for this module
@@ -342,9 +571,20 @@ def main(args=None):
                 serverLoc = wavesLocation
                 # Arguments for the above Python script
                 arguments = [regionHomeDir,systemTime,workDir_RetrieveAusWaves, serverLoc]
-                # Run the module (i.e. run the python script), calling the function runModule defined 
-                # above
-                runModule(script=retrieveAusWavesPy,args=arguments)
+                # Add the module run (i.e. the python script) to the scheduler. It is run 
+                # by the function runStage defined above, once the stages it depends on are done
+                # Downloaded wave forecast(s) and their per-hotspot subsets, deleted by WipeForecast
+                waveFiles = os.path.join(workDir_RetrieveAusWaves,"ncFiles",
+                                         "*.msh.%s.nc" % sysTime_dt.strftime('%Y%m%dT%H%MZ'))
+                waveSubsetFiles = waveFiles.replace(".nc","_*.nc")
+                stageKey = scheduler.addStage(forecastStage("WaveDownload", systemTime, site=region, script=retrieveAusWavesPy,
+                                                            args=arguments, deps=downloadDeps, resource="WaveDownload",
+                                                            wipedOutputs=[waveFiles, waveSubsetFiles]))
+                downloadKeys.append(stageKey)
+                wipedByAllStages.append(scheduler.getStage(stageKey))
+
+            if downloadKeys:
+                cycleDeps = downloadKeys
 
 
 
@@ -358,23 +598,33 @@ def main(args=None):
             
             # Only run if flag is set to True
             if PreProcessRegional_flag:
-                # Inform user which module is being run. 
-                print("*********Running PreProcessRegional module for time: %s GMT *********" % sysTime_dt)
                 # Working directory, location of below python script
                 workDir_preProcessRegionalPy = os.path.join(moduleDir,"PreProcessRegional")
                 # Python script being called for this module
                 preProcessRegionalPy = os.path.join(workDir_preProcessRegionalPy,"preprocessMainRegional.py")
                 # Arguments for the above Python script
                 arguments = [regionHomeDir,systemTime,region,workDir_preProcessRegionalPy]
-                # Run the module (i.e. run the python script), calling the function runModule defined 
-                # above
-                runModule(script=preProcessRegionalPy,args=arguments)
+                # Add the module run (i.e. the python script) to the scheduler. It is run 
+                # by the function runStage defined above, once the stages it depends on are done
+                stageKey = scheduler.addStage(forecastStage("PreProcessRegional", systemTime, site=region, script=preProcessRegionalPy,
+                                                            args=arguments, deps=cycleDeps, resource="PreProcessRegional"))
+                cycleDeps = [stageKey]
+                preProcessKeys.append(stageKey)
             
 
 
 
             # Loop through hotspots in a particular region
             for hotspotName in hotspotIDs:
+                # Stages that the next stage for this hotspot has to wait for
+                hotspotDeps = list(cycleDeps)
+                # Directory of the hotspot forecast, and the XBeach run within it
+                xbWorkDir = os.path.join(forecastDir,region,"hotspot",hotspotName,"XBeach")
+                # Directory XBeach is run in, deleted by WipeForecast
+                workDir_runXBeach = os.path.join(moduleDir,"XBeach",hotspotName,
+                                                 "%sSystemTime-%s" % (sysTime_dt.strftime('%Y%m%d%H'),hotspotName))
+                # WipeForecast stage for this hotspot
+                wipeKey = [(systemTime,hotspotName,"WipeForecast")] if WipeForecast_flag else []
 
                 # =========================== Pre-process XBeach ===========================#
                 # Calls the script that pre-processes the hotspot forecast (XBeach run - 
@@ -386,17 +636,26 @@ def main(args=None):
 
                 # Only run if flag is set to True
                 if PreProcessXBeach_flag:
-                    # Inform user which module is being run. 
-                    print("*********Running PreProcessXBeach module for time: %s GMT *********" % sysTime_dt)
                     # Working directory, location of below python script
                     workDir_PreProcessXBeach = os.path.join(moduleDir,"PreProcessXBeach")
                     # Python script being called for this module
                     preProcessXBeachPy = os.path.join(workDir_PreProcessXBeach,"preprocessMain.py")
                     # Arguments for the above Python script
                     arguments = [regionHomeDir,systemTime,hotspotName,workDir_PreProcessXBeach]
-                    # Run the module (i.e. run the python script), calling the function runModule defined 
-                    # above
-                    runModule(script=preProcessXBeachPy,args=arguments)
+                    # Add the module run (i.e. the python script) to the scheduler. It is run 
+                    # by the function runStage defined above, once the stages it depends on are done
+                    stageKey = scheduler.addStage(forecastStage("PreProcessXBeach", systemTime, site=hotspotName,
+                                                                script=preProcessXBeachPy, args=arguments,
+                                                                deps=hotspotDeps, resource="PreProcessXBeach",
+                                                                inputs=[hotspots,
+                                                                        os.path.join(dataDir,"xbeach",hotspotName),
+                                                                        os.path.join(dataDir,"Tides"),
+                                                                        os.path.join(dataDir,"Waves")],
+                                                                outputs=[os.path.join(xbWorkDir,"params.txt")],
+                                                                wipedOutputs=[os.path.join(workDir_runXBeach,"params.txt")],
+                                                                wipedBy=wipeKey))
+                    hotspotDeps = [stageKey]
+                    preProcessKeys.append(stageKey)
 
 
 
@@ -409,7 +668,6 @@ def main(args=None):
                 
                 # Only run if flag is set to True
                 if runXBeach_flag:
-                    print("*********Running PreProcessXBeach module for time: %s GMT *********" % sysTime_dt)
                     #Reforamt system time string to get the correct path
                     systemTime_str = sysTime_dt.strftime('%Y%m%d%H')
                     # Working directory - i.e. the directory where xbeach.exe is located for the
@@ -418,22 +676,23 @@ def main(args=None):
                     workDir_runXBeach = os.path.join(moduleDir,"XBeach",hotspotName,workDir_runXBeachName)
                     # Location of xbeach.exe
                     xbeach_exe = os.path.join(workDir_runXBeach,"xbeach.exe")
-                    # Try, except logic here - we want XBeach to run when this module is 
-                    # called
-                    try:
-                        # Change the directory to the same directory xbeach.exe is in, or else
-                        # Xbeach doens't know what to do.
-                        os.chdir(workDir_runXBeach)
-                        #subprocess.check_output(xbeach_exe,shell=True,stderr=subprocess.STDOUT)
-                        # Run xbeach.exe
-                        subprocess.run(xbeach_exe, check=True, shell=True)
-                        # Change the directory back to the Region Home
-                        os.chdir(regionHomeDir)
-                    # Throw an error if it doesn't run
-                    except subprocess.CalledProcessError as e:  # most generic exception you can catch
-                        logf.write("Failed. {0}\n".format(str(e)))
-                        logf.write('Recorded at %s.\n' % (datetime.now()))
-                        raise RuntimeError("command '{}' return with error (code {}): {}".format(e.cmd, e.returncode, e.output))
+                    # XBeach is run from the same directory xbeach.exe is in, or else
+                    # Xbeach doens't know what to do. The directory is passed to the 
+                    # subprocess rather than changed with os.chdir, since other modules
+                    # may be running at the same time. 
+                    stageKey = scheduler.addStage(forecastStage("XBeach", systemTime, site=hotspotName,
+                                                                script=xbeach_exe, cwd=workDir_runXBeach,
+                                                                deps=hotspotDeps, resource="xbeach",
+                                                                wipedOutputs=[os.path.join(workDir_runXBeach,"xboutput.nc")],
+                                                                wipedBy=wipeKey))
+                    hotspotDeps = [stageKey]
+                    # Read the XBeach output while XBeach is running. The script takes the
+                    # same arguments as the PostProcessXBeach module, plus the poll interval.
+                    if incrementalPostProc_flag:
+                        workDir_PostProcessXBeach = os.path.join(moduleDir,"PostProcessXBeach")
+                        tailers[stageKey] = (os.path.join(workDir_PostProcessXBeach,"tailXBeachOutput.py"),
+                                             [regionHomeDir,systemTime_str,hotspotName,
+                                              workDir_PostProcessXBeach,str(tailPollInterval)])
 
 
                 # =============================== Post-process XBeach ===============================#
@@ -445,8 +704,6 @@ def main(args=None):
 
                 # Only run if flag is set to True
                 if PostProcessXBeach_flag:
-                    # Inform user which module is being run. 
-                    print("*********Running PostProcessXBeach module for time: %s GMT *********" % sysTime_dt)
                     # Working directory, location of below python script
                     workDir_PostProcessXBeach = os.path.join(moduleDir,"PostProcessXBeach")
                     # Python script being called for this module
@@ -454,10 +711,15 @@ def main(args=None):
                     # Formatted system time string
                     systemTime_str = sysTime_dt.strftime('%Y%m%d%H')
                     # Arguments for the above Python script
-                    arguments = [regionHomeDir,systemTime_str,hotspotName,workDir_PostProcessXBeach]
-                    # Run the module (i.e. run the python script), calling the function runModule defined 
-                    # above
-                    runModule(script=postProcessXBeachPy,args=arguments)
+                    arguments = [regionHomeDir,systemTime_str,hotspotName,workDir_PostProcessXBeach,
+                                 str(postProcWorkers)]
+                    # Add the module run (i.e. the python script) to the scheduler. It is run 
+                    # by the function runStage defined above, once the stages it depends on are done
+                    stageKey = scheduler.addStage(forecastStage("PostProcessXBeach", systemTime, site=hotspotName,
+                                                                script=postProcessXBeachPy, args=arguments,
+                                                                deps=hotspotDeps, resource="PostProcessXBeach",
+                                                                outputs=[os.path.join(xbWorkDir,"postProcess")]))
+                    hotspotDeps = [stageKey]
 
 
                 # ============================ Storm Impact Indicators XBeach ===========================#
@@ -469,17 +731,21 @@ def main(args=None):
 
                 # Only run if flag is set to True
                 if IndicatorsXBeach_flag:
-                    # Inform user which module is being run. 
-                    print("*********Running IndicatorsXBeach module for time: %s GMT *********" % sysTime_dt)
                     # Working directory, location of below python script
                     workDir_IndicatorsXBeach = os.path.join(moduleDir,"IndicatorsXBeach")
                     # Python script being called for this module
                     indicatorsXBeachPy = os.path.join(workDir_IndicatorsXBeach,"indicatorsMain.py")
                     # Arguments for the above Python script
-                    arguments = [regionHomeDir,systemTime,hotspotName,workDir_IndicatorsXBeach]
-                    # Run the module (i.e. run the python script), calling the function runModule defined 
-                    # above
-                    runModule(script=indicatorsXBeachPy,args=arguments)
+                    arguments = [regionHomeDir,systemTime,hotspotName,workDir_IndicatorsXBeach,
+                                 str(postProcWorkers)]
+                    # Add the module run (i.e. the python script) to the scheduler. It is run 
+                    # by the function runStage defined above, once the stages it depends on are done
+                    stageKey = scheduler.addStage(forecastStage("IndicatorsXBeach", systemTime, site=hotspotName,
+                                                                script=indicatorsXBeachPy, args=arguments,
+                                                                deps=hotspotDeps, resource="IndicatorsXBeach",
+                                                                inputs=[os.path.join(dataDir,"Indicators","Hotspot",hotspotName)],
+                                                                outputs=[os.path.join(xbWorkDir,"postProcess","indicators")]))
+                    hotspotDeps = [stageKey]
 
 
                 # ======================== Wipe Extra Files from Forecast for Space =========================#
@@ -491,17 +757,45 @@ def main(args=None):
 
                 # Only run if flag is set to True
                 if WipeForecast_flag:
-                    # Inform user which module is being run. 
-                    print("*********Running WipeForecast module for time: %s GMT *********" % sysTime_dt)
                     # Working directory, location of below python script
                     workDir_WipeForecast = os.path.join(moduleDir,"WipeForecast")
                     # Python script being called for this module
                     wipeForecastPy = os.path.join(workDir_WipeForecast,"wipeForecast.py")
                     # Arguments for the above Python script
                     arguments = [regionHomeDir,systemTime,hotspotName,workDir_WipeForecast]
-                    # Run the module (i.e. run the python script), calling the function runModule defined 
-                    # above
-                    runModule(script=wipeForecastPy,args=arguments)
+                    # Add the module run (i.e. the python script) to the scheduler. It is run 
+                    # by the function runStage defined above, once the stages it depends on are done
+                    # Added to the scheduler below, once every hotspot has been pre-processed
+                    wipeStages.append(forecastStage("WipeForecast", systemTime, site=hotspotName,
+                                                    script=wipeForecastPy, args=arguments,
+                                                    deps=hotspotDeps, resource="WipeForecast"))
+
+        # WipeForecast deletes the BoM forecasts that every hotspot for this system time
+        # is pre-processed from, so it also waits for all of the pre-processing stages
+        for stage in wipeStages:
+            stage.deps = stage.deps + [k for k in preProcessKeys if k not in stage.deps]
+            scheduler.addStage(stage)
+        for stage in wipedByAllStages:
+            stage.wipedBy = [wipeStage.key for wipeStage in wipeStages]
+
+
+    #======================================== Run forecast stages ========================================#
+    ledger = campaignLedger(ledgerFile, libraryDir=xbfewsToolsDir)
+    if resume_flag:
+        # Skip anything that already finished successfully in a previous attempt
+        nSkipped = ledger.planCampaign(scheduler)
+        print("********** Resuming: skipping %s of %s module runs already done **********" % (nSkipped,len(scheduler.stages)))
+    else:
+        ledger.hashStages(scheduler)
+    try:
+        scheduler.run(runStage=runStage)
+    finally:
+        # Report how long each module took, whether or not all of them ran successfully
+        scheduler.reportTimings(ofile=timingsFile)
+        ledger.close()
+        if modulePool is not None:
+            modulePool.shutdown()
+        logf.close()
 
 
 
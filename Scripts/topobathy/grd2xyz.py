@@ -9,9 +9,9 @@
 #==========================================================================================
 
 
-import numpy as np
 import os
 import pandas as pd
+from xbfewsTools import gridCache
 
 storm = "2020_02_09"
 site = "Narrabeen"
@@ -27,7 +27,7 @@ zgrd = os.path.join(ifilePath,"z.grd")
 
 def flattenGrd(arr2d_grdfile):
     "Takes a grd file, formatted for XBeach."
-    arr2d = np.loadtxt(arr2d_grdfile,delimiter='\t')
+    arr2d = gridCache.loadGrid(arr2d_grdfile)
     print(arr2d.shape)
     arr1d = arr2d.flatten()
     return arr1d
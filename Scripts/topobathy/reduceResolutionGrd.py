@@ -13,6 +13,7 @@
 import numpy as np
 import os
 import pandas as pd
+from xbfewsTools import gridCache
 
 reductionFactorLongshore = int(1)
 reductionFactorCrosshore = int(1)
@@ -27,7 +28,7 @@ zgrd = "z.grd"
 ne_layer = "ne_layer.grd"
 
 def reduceReso(fname,factorLongshore,factorCrosshore):
-    arr2d = np.loadtxt(os.path.join(ifilePath,fname))
+    arr2d = gridCache.loadGrid(os.path.join(ifilePath,fname))
     print(arr2d.shape)
     arr2d = arr2d[::factorLongshore,::factorCrosshore].round(2)
     print(arr2d.shape)
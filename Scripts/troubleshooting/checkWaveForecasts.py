@@ -29,7 +29,10 @@ offshore_df = pd.DataFrame({"lat":hotspotFcst.offshoreWaveLat,
                                 index=[0])
 offshore_gdf = gpd.GeoDataFrame(offshore_df,geometry=gpd.points_from_xy(offshore_df.lon,offshore_df.lat))
 offshore_gdf.set_crs(epsg=hotspotFcst.auswaveEPSG)
-wavesOffshoreDs = preProcWaves.extractAusWavePts(ds=wavesDs,meshPts=offshore_gdf,epsg=hotspotFcst.auswaveEPSG)
+# Same cached nearest-node index for the Auswave mesh as used by preprocessMain.py
+waveIndexDir = os.path.join(hotspotFcst.regionHome,"Modules","WaveDownload","meshIndex")
+wavesOffshoreDs = preProcWaves.extractAusWavePts(ds=wavesDs,meshPts=offshore_gdf,epsg=hotspotFcst.auswaveEPSG,
+                                                 cacheDir=waveIndexDir,name=hotspotFcst.waveCode)
 wavesOffshoreDs = wavesOffshoreDs[['hs']]
 offshore_df = wavesOffshoreDs.to_dataframe()
 #print(offshore_df)
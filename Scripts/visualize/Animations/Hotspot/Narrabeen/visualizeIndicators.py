@@ -19,6 +19,7 @@ import matplotlib.patches as patches
 import cartopy.crs as ccrs
 import geopandas as gpd
 from xbfewsTools import postProcTools
+from xbfewsTools import gridCache
 import pickle
 from datetime import datetime, timedelta
 from shapely.geometry import Point, LineString
@@ -47,6 +48,9 @@ imagery = os.path.join(regionHome,"Data\\imagery\\Narrabeen\\narrabeen_epsg28356
 indicatorsPath = os.path.join(postProcessDir,"indicators")
 scwPath = os.path.join(indicatorsPath,"scw\\points")
 bsdPath = os.path.join(indicatorsPath,"bsd\\points")
+# Single GeoPackage holding the indicators for every timestep. Only written if the
+# forecast's postProcOutput attribute is set to "geopackage" or "both"
+indicatorStore = os.path.join(indicatorsPath,"indicators_timeseries.gpkg")
 dataDir = os.path.join(regionHome,"Data")
 transectsDir = os.path.join(dataDir,"Indicators\\Hotspot\\Narrabeen")
 transectsShp = os.path.join(transectsDir,"xb_transects_utm.shp")
@@ -153,7 +157,11 @@ def plotmymap(fig, axs, gaugefile=None, ewlgdf= None,
     # Plot SCW Indicators:
     if scwMode:
 
-        gdf_scw = gpd.read_file(scwFile)
+        # Either a timestep already sliced out of the GeoPackage store, or a shapefile
+        if isinstance(scwFile, gpd.GeoDataFrame):
+            gdf_scw = scwFile
+        else:
+            gdf_scw = gpd.read_file(scwFile)
         # Merge with Xbeach grid gdf to get the col/row indeces
         gdf_scw = gdfgrd.merge(gdf_scw, how='inner', on=['geometry'])
         gdf_scw = gdf_scw.sort_values('rowInd')
@@ -178,7 +186,11 @@ def plotmymap(fig, axs, gaugefile=None, ewlgdf= None,
     # Plot BSD Indicators:
     if bsdFlag:
         try:
-            gdf_bsd = gpd.read_file(bsdFile)
+            # Either a timestep already sliced out of the GeoPackage store, or a shapefile
+            if isinstance(bsdFile, gpd.GeoDataFrame):
+                gdf_bsd = bsdFile
+            else:
+                gdf_bsd = gpd.read_file(bsdFile)
 
             # Merge with Xbeach grid gdf to get the col/row indeces
             gdf_bsd = gdfgrd.merge(gdf_bsd, how='inner', on=['geometry'])
@@ -238,8 +250,8 @@ print(hotspotFcst.deltat)
 
 
 ################ Load x.grd, y.grd ################
-xx = np.loadtxt(xgrd,delimiter='\t')
-yy = np.loadtxt(ygrd,delimiter='\t')
+xx = gridCache.loadGrid(xgrd)
+yy = gridCache.loadGrid(ygrd)
 nrows = xx.shape[0]
 ncols = xx.shape[1]
 # Flatten the xx, yy arrays
@@ -259,6 +271,18 @@ gdfgrd = gdfgrd.set_crs(epsg)
 gdfgrd = gdfgrd.reset_index()
 
 
+################ Load indicator time series from GeoPackage store ################
+# If the store exists, each indicator's whole time series is read in once, rather
+# than reading one shapefile per timestep
+scwSeries = None
+bsdSeries = None
+if os.path.exists(indicatorStore):
+    if scwFlag:
+        scwSeries = postProcTools.readTimeseriesStore(storePath=indicatorStore, layer="scw_points")
+    if bsdFlag:
+        bsdSeries = postProcTools.readTimeseriesStore(storePath=indicatorStore, layer="bsd_points")
+
+
 ################ loop through and generate plots ################
 # Construct time series to iterate through
 # Numpy timedelta64 objects are easier to deal with
@@ -283,6 +307,10 @@ for t_step in tseries_hrs:
     tstep_hrs_str = f'{(t_step):.2f}'.zfill(6)
     scwFile = os.path.join(scwPath,"scw_%shrs.shp" % tstep_hrs_str)
     bsdFile = os.path.join(bsdPath, "bsd_%shrs.shp" % tstep_hrs_str)
+    if scwSeries is not None:
+        scwFile = scwSeries[np.isclose(scwSeries["time_hrs"], round(t_step, 2))].drop(columns=["time_hrs"])
+    if bsdSeries is not None:
+        bsdFile = bsdSeries[np.isclose(bsdSeries["time_hrs"], round(t_step, 2))].drop(columns=["time_hrs"])
 
     ########### Map parameters ###########
     fig = plt.figure(figsize=(8.75, 10.5),facecolor="white")
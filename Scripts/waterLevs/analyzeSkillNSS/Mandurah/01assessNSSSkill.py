@@ -5,6 +5,7 @@ import pytz # for handling time zones
 from datetime import datetime, timedelta
 import xarray as xr
 import re
+from xbfewsTools import preProcWatLevs
 
 
 ####################### Parameters #######################
@@ -38,6 +39,12 @@ forecastPeriodEnd = forecastPeriodStart + timedelta(days=366) # leap year!
 dataDir = 'C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Data\\waterLevs\\Mandurah'
 workDir = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Scripts\\waterLevs\\analyzeSkillNSS\\mandurah"
 oDir = os.path.join(workDir,"ofiles")
+# Subsets of the NSS forecast files with just the point to compare, made the first
+# time each file is read (see preProcWatLevs.subsetNSS), so that re-running this
+# script doesn't have to read the national files again
+subsetDir = os.path.join(oDir,"nssSubsets")
+if not os.path.exists(subsetDir):
+    os.makedirs(subsetDir)
 
 
 ####################### Local functions #######################
@@ -134,7 +141,8 @@ for fi in df_files['fileName']:
         print("Processing file: %s" % fi)
         print("File number: %s " % str(counter))
         # Load forecast file
-        ds = xr.open_dataset(os.path.join(wlDir,fi))
+        ds = preProcWatLevs.openNSS(ifile=os.path.join(wlDir,fi), lon=[lon], lat=[lat],
+                                    subsetDir=subsetDir, create=True)[0]
         # Parse time from file
         dateTime = parseTimeNSS(string=fi)
         # Keep only surge and tide components of forecast (assume here that surge = non-tidal residuals)
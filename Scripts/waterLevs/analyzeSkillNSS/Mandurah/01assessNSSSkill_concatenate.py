@@ -5,6 +5,7 @@ import pytz # for handling time zones
 from datetime import datetime, timedelta
 import xarray as xr
 import re
+from xbfewsTools import preProcWatLevs
 import numpy as np
 
 ####################### Parameters #######################
@@ -38,6 +39,12 @@ leadtimes = [0,6,12,24,48,72,96,120,144,162] # in hours
 dataDir = 'C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Data\\waterLevs\\Mandurah'
 workDir = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Scripts\\waterLevs\\analyzeSkillNSS\\mandurah"
 oDir = os.path.join(workDir,"ofiles")
+# Subsets of the NSS forecast files with just the point to compare, made the first
+# time each file is read (see preProcWatLevs.subsetNSS), so that re-running this
+# script doesn't have to read the national files again
+subsetDir = os.path.join(oDir,"nssSubsets")
+if not os.path.exists(subsetDir):
+    os.makedirs(subsetDir)
 
 
 ####################### Local functions #######################
@@ -135,7 +142,8 @@ for fi in df_files['fileName']:
         print("Processing file: %s" % fi)
         print("File number: %s" % counter)
         # Load forecast file
-        ds = xr.open_dataset(os.path.join(wlDir,fi))
+        ds = preProcWatLevs.openNSS(ifile=os.path.join(wlDir,fi), lon=[lon], lat=[lat],
+                                    subsetDir=subsetDir, create=True)[0]
         # Parse time from file
         dateTime = parseTimeNSS(string=fi)
         # Keep only surge and tide components of forecast (assume here that surge = non-tidal residuals)
@@ -155,7 +163,8 @@ for fi in df_files['fileName']:
         deltat_nss = ds.time.values[1]-ds.time.values[0]
         # load each as a ds, select appropriate time frame, point, and variables (see above); append to ds
         for fiConcat in concatFiles['fileName']:
-            dsConcat = xr.open_dataset(os.path.join(wlDir,fiConcat))
+            dsConcat = preProcWatLevs.openNSS(ifile=os.path.join(wlDir,fiConcat), lon=[lon], lat=[lat],
+                                              subsetDir=subsetDir, create=True)[0]
             dateTimeConcat = parseTimeNSS(string=fiConcat)
             dsConcat = dsConcat[['time','surge','tide']]
             dsConcat = dsConcat.where((dsConcat.lat==lat) & 
@@ -6,6 +6,7 @@ import re
 import pytz # for handling time zones
 from datetime import datetime, timedelta
 import xarray as xr
+from xbfewsTools import preProcWaves
 
 
 # ================== Paths ================== #
@@ -17,6 +18,12 @@ waveOutDir = os.path.join(waveAnalysisDir,"ofiles")
 workDir = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Scripts\\waterLevs"
 print(waveObs)
 oDir = os.path.join(workDir,'ofiles')
+# Subsets of the Auswave files with just the node to compare, made the first time
+# each file is read (see preProcWaves.subsetAuswave), so that re-running this
+# script doesn't have to read the full mesh files again
+subsetDir = os.path.join(oDir,"auswaveSubsets")
+if not os.path.exists(subsetDir):
+    os.makedirs(subsetDir)
 
 
 # ================== Parameters ================== #
@@ -67,7 +74,8 @@ for fi in df_files['fileName']:
     print("Processing file: %s" % fi)
     print("File number: %s " % str(counter))
     # Load forecast file
-    ds = xr.open_dataset(os.path.join(waveForecastDir,fi))
+    ds = preProcWaves.openAuswave(ifile=os.path.join(waveForecastDir,fi), lon=[lon], lat=[lat],
+                                  subsetDir=subsetDir, create=True)[0]
     # Keep only the variables of interest
     ds = ds[['time','hs','latitude','longitude']]
     # Keep only the point to compare to (nearest point to actual gauge where
@@ -0,0 +1,68 @@
+#======================================================================================
+# checkHarmonicTides.py
+
+# DESCRIPTION:
+# Checks the harmonic tide predictions (harmonicTides.py in xbfewsTools) against the
+# precomputed tide predictions they replace. For each city with both a
+# [city]Constituents.csv and a [city]TidesGMT.csv in
+# [Region Home]\Data\Tides\[city]\processed, the tides predicted from the constituents
+# are compared with the csv file at every time in it. The check passes if the RMS
+# difference is under rmsTolerance. Each check prints PASS or FAIL, and the script exits
+# with an error if any check failed. Re-run this script whenever the constituents or
+# the tide csv files are updated. If a city fails, remove its [city]Constituents.csv
+# so that the pre-processing modules go back to reading the csv file.
+
+# COMMAND TO RUN THIS SCRIPT:
+# python [path to this script] [Region Home, optional]
+#======================================================================================
+
+
+import os
+import sys
+import glob
+import numpy as np
+from xbfewsTools import preProcWatLevs, harmonicTides
+
+
+#====================== Paths ======================#
+regionHome = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus"
+
+
+#====================== Tolerance ======================#
+# Largest RMS difference (m) between the harmonic predictions and the csv file. The
+# csv files are themselves harmonic predictions, so the two should agree to within a
+# few cm; more than this points to missing constituents, wrong phases (e.g. local
+# time rather than GMT) or a different datum.
+rmsTolerance = 0.05
+
+
+def compareTides(station=None, dft=None):
+    """
+    Compares the tides predicted by a tideStation with a dataframe of tide
+    predictions (see preProcWatLevs.readTideCSV). Returns the RMS and the
+    largest absolute difference (m).
+    """
+    diff = station.predict(dft.index) - dft['tide_m'].to_numpy(dtype=np.float64)
+    return np.sqrt(np.mean(diff**2)), np.abs(diff).max()
+
+
+#====================== Check each city ======================#
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        regionHome = sys.argv[1]
+    tidesDir = os.path.join(regionHome,"Data","Tides")
+    results = []
+    for consFile in sorted(glob.glob(os.path.join(tidesDir,"*","processed","*Constituents.csv"))):
+        city = os.path.basename(consFile)[:-len("Constituents.csv")]
+        tideFile = os.path.join(os.path.dirname(consFile),"%sTidesGMT.csv" % city)
+        if not os.path.exists(tideFile):
+            print("SKIP: %s, no %s" % (city, tideFile))
+            continue
+        dft = preProcWatLevs.readTideCSV(ifile=tideFile)
+        rms, maxErr = compareTides(station=harmonicTides.loadConstituents(ifile=consFile), dft=dft)
+        results.append(rms < rmsTolerance)
+        print("%s: %s, RMS %.3f m (tolerance %.3f m), max %.3f m, %s to %s" % (
+              "PASS" if results[-1] else "FAIL", city, rms, rmsTolerance, maxErr,
+              dft.index[0], dft.index[-1]))
+    print("%s of %s checks passed" % (sum(results), len(results)))
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,29 @@
+#======================================================================================
+# convertTides.py
+
+# DESCRIPTION:
+# One-time conversion of the processed astronomical tide predictions
+# ([Region Home]\Data\Tides\[city]\processed\[city]TidesGMT.csv) to binary tide stores
+# ([city]TidesGMT_times.npy and [city]TidesGMT_values.npy, in the same folder). Once
+# a store exists, preProcWatLevs.loadTideData reads the forecast window straight
+# from the store instead of parsing the whole csv file. Re-run this script whenever
+# the tide csv files are updated; loadTideData goes back to the csv file if it is
+# newer than the store.
+#======================================================================================
+
+
+import os
+import glob
+from xbfewsTools import preProcWatLevs
+
+
+#====================== Paths ======================#
+regionHome = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus"
+tidesDir = os.path.join(regionHome,"Data\\Tides")
+
+
+#====================== Convert tide predictions ======================#
+for tideFile in glob.glob(os.path.join(tidesDir,"*","processed","*TidesGMT.csv")):
+    print("Converting %s..." % tideFile)
+    timesFile, valuesFile = preProcWatLevs.convertTideData(ifile=tideFile)
+    print("    -> %s, %s" % (timesFile, valuesFile))
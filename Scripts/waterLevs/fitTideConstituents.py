@@ -0,0 +1,61 @@
+#======================================================================================
+# fitTideConstituents.py
+
+# DESCRIPTION:
+# Harmonic analysis of the processed astronomical tide predictions of a city
+# ([Region Home]\Data\Tides\[city]\processed\[city]TidesGMT.csv). The harmonic
+# constituents of the tide station are fitted to the first fitYears of the
+# predictions (see harmonicTides.fitConstituents in xbfewsTools), and then checked
+# against the rest of them (see checkHarmonicTides.py). Only if the check passes are
+# they saved to [city]Constituents.csv in the same folder, after which the
+# pre-processing modules predict the tides from the constituents instead of reading
+# the csv file. If it fails, nothing is written.
+
+# COMMAND TO RUN THIS SCRIPT:
+# python [path to this script] [city] [Region Home, optional]
+# e.g. python fitTideConstituents.py Sydney
+#======================================================================================
+
+
+import os
+import sys
+import pandas as pd
+from xbfewsTools import preProcWatLevs, harmonicTides
+from checkHarmonicTides import compareTides, rmsTolerance
+
+
+#====================== Paths ======================#
+city = sys.argv[1]
+regionHome = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus"
+if len(sys.argv) > 2:
+    regionHome = sys.argv[2]
+tidesPath = os.path.join(regionHome,"Data","Tides",city,"processed")
+tideFile = os.path.join(tidesPath,"%sTidesGMT.csv" % city)
+consFile = os.path.join(tidesPath,"%sConstituents.csv" % city)
+
+
+#====================== Fit ======================#
+# Years of predictions the constituents are fitted to. At least a year is needed to
+# separate the annual (SA) constituent from the mean water level.
+fitYears = 2
+dft = preProcWatLevs.readTideCSV(ifile=tideFile)
+fitEnd = dft.index[0] + pd.DateOffset(years=fitYears)
+dfFit = dft[dft.index < fitEnd]
+dfCheck = dft[dft.index >= fitEnd]
+station = harmonicTides.fitConstituents(times=dfFit.index, heights=dfFit['tide_m'].values)
+print("Fitted %s constituents to %s to %s" % (len(station.constituents), dfFit.index[0], dfFit.index[-1]))
+
+
+#====================== Check and save ======================#
+# Against the predictions that weren't part of the fit, if there are any
+if len(dfCheck) == 0:
+    print("Predictions only cover %s, checking against the fitted period" % dft.index[-1])
+    dfCheck = dfFit
+rms, maxErr = compareTides(station=station, dft=dfCheck)
+print("RMS %.3f m (tolerance %.3f m), max %.3f m, %s to %s" % (
+      rms, rmsTolerance, maxErr, dfCheck.index[0], dfCheck.index[-1]))
+if rms >= rmsTolerance:
+    print("Check failed, %s not written" % consFile)
+    sys.exit(1)
+harmonicTides.saveConstituents(station=station, ofile=consFile)
+print("Saved %s" % consFile)
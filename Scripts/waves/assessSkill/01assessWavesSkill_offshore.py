@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 import xarray as xr
 import re
 from sklearn.metrics import mean_squared_error, r2_score
+from xbfewsTools import preProcWaves
 
 # TODO:
 # Need to evaluate:
@@ -31,6 +32,12 @@ forecastPeriodEnd = forecastPeriodStart + timedelta(days=366) # leap year!
 ####################### Paths #######################
 workDir = "C:\\Users\\mandiruns\\Documents\\01_FEWS-RegionHome-Aus\\Scripts\\waves"
 oDir = os.path.join(workDir,"ofiles")
+# Subsets of the Auswave files with just the node to compare, made the first time
+# each file is read (see preProcWaves.subsetAuswave), so that re-running this
+# script doesn't have to read the full mesh files again
+subsetDir = os.path.join(oDir,"auswaveSubsets")
+if not os.path.exists(subsetDir):
+    os.makedirs(subsetDir)
 
 
 ####################### Local functions #######################
@@ -87,7 +94,8 @@ for fi in df_files['fileName']:
     print("Processing file: %s" % fi)
     print("File number: %s " % str(counter))
     # Load forecast file
-    ds = xr.open_dataset(os.path.join(waveDirectory,fi))
+    ds = preProcWaves.openAuswave(ifile=os.path.join(waveDirectory,fi), lon=[lon], lat=[lat],
+                                  subsetDir=subsetDir, create=True)[0]
     # Parse time from file
     dateTime = parseTimeAusWv(string=fi)
     print(dateTime)
@@ -1,8 +1,16 @@
 #====== A package to assist with using XBeach and FEWS together. ======#
 
 from .fewsUtils import fewsUtils
+from .fewsUtils import runHandoff
+from .fewsUtils import asyncDownload
+from .fewsUtils import downloadCache
 from .preProcess import preProcWatLevs
 from .preProcess import preProcWaves
 from .preProcess import regionalPreProc
+from .preProcess import spatialIndex
+from .preProcess import gridCache
+from .preProcess import harmonicTides
 from .postProcess import postProcTools
+from .postProcess import incrementalPostProc
+from .postProcess import indicatorCube
 from . import fewsForecast
\ No newline at end of file
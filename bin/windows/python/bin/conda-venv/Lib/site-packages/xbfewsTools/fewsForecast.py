@@ -130,6 +130,22 @@ class hotspotForecast:
         self.tintg = 900
         self.morstart = None
 
+        ######## Post-processing ########
+        # Format of the per-timestep post-processing outputs (gauges, scarps
+        # and indicators): "shapefile" writes one shapefile per timestep (the
+        # format FEWS reads), "geopackage" writes all timesteps to a single
+        # GeoPackage, and "both" writes both.
+        self.postProcOutput = "shapefile"
+        # Minimum drop in bed level (m) from when morphology is switched on for
+        # a grid cell to count as eroded. The erosion scarp in each row is the
+        # most landward eroded cell.
+        self.scarpThreshold = 0.5
+        # Number of worker processes the per-timestep post-processing and 
+        # indicator exports are spread over. 1 runs them in the main process,
+        # None uses every core. run_forecast_loop.py passes its own number to
+        # the modules, so that it stays within the loop's maxWorkers.
+        self.nWorkers = 1
+
     # Grab all the key properties from the main fewsForecast object
     @property
     def systemTime(self): # pass accesses to fewsForecast
@@ -215,6 +231,14 @@ class regionalForecast:
         ####### Projection info ######
         self.epsgWL = int(4326)
 
+        ######## Outputs ########
+        # Format of the water level forecasts for the profiles: "netcdf" writes
+        # a single netCDF file with all profiles (profile id as a dimension), 
+        # "csv" writes one csv file per profile, "both" writes both. The csv
+        # files are what the module has always written, so they are kept by
+        # default; set to "netcdf" to only write the netCDF file.
+        self.wlOutput = "both"
+
         ######## Paths ########
         # Forecast directory
         self.forecastDir = None
@@ -0,0 +1,161 @@
+import os
+import re
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+#====== Downloading forecast files concurrently ======#
+# The BoM forecast files for a cycle (the storm surge file and a nearshore wave
+# file for every wave code) are downloaded at the same time, rather than one
+# after the other. downloadFile fetches a single file over HTTP with:
+#     - a timeout on every request, and retries with exponential backoff (plus a
+#     bit of random jitter, so that retries from several downloads don't all hit
+#     the server at the same time)
+#     - resuming: if the download is interrupted, the next attempt asks the server
+#     for the rest of the file only (HTTP Range request), rather than starting again
+#     - checks that the file is complete (size given by the server, or expectedSize)
+#     and optionally that its sha256 matches
+# fetchAll runs a list of downloads concurrently with asyncio, each in a worker
+# thread, with at most maxPerHost downloads from the same server at once.
+
+# Size of the chunks files are downloaded in
+chunkSize = 1 << 20
+# HTTP status codes that are worth retrying. Any other HTTP error (e.g. 404, the
+# file isn't on the server yet) is raised straight away.
+retryStatus = (408, 425, 429, 500, 502, 503, 504)
+
+
+class downloadError(IOError):
+    def __init__(self, message=None, retry=True):
+        super().__init__(message)
+        # False if trying again won't help
+        self.retry = retry
+
+
+def _downloadOnce(url=None, ofile=None, timeout=60.):
+    # Downloads url to ofile, carrying on from the end of ofile if it is there
+    # already. Returns the total size of the file according to the server, or None.
+    start = os.path.getsize(ofile) if os.path.exists(ofile) else 0
+    headers = {"Range":"bytes=%d-" % start} if start > 0 else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and start > 0:
+            # Nothing left to download, or the file changed on the server: start again
+            os.remove(ofile)
+            raise downloadError("%s: range not satisfiable, starting again" % url)
+        raise downloadError("%s: HTTP %s" % (url, e.code), retry=e.code in retryStatus)
+    with response:
+        contentRange = response.headers.get("Content-Range")
+        length = response.headers.get("Content-Length")
+        if start > 0 and response.status == 206 and contentRange is not None:
+            # Rest of the file, e.g. "bytes 1000-4999/5000"
+            total = re.search(r"/(\d+)\s*$", contentRange)
+            total = int(total.group(1)) if total else None
+            mode = "ab"
+        else:
+            # The server ignored the Range request (or this is the first attempt),
+            # so the whole file is sent again
+            total = int(length) if length is not None else None
+            mode = "wb"
+        with open(ofile, mode) as f:
+            shutil.copyfileobj(response, f, chunkSize)
+    return total
+
+
+def downloadFile(url=None, ofile=None, expectedSize=None, sha256=None, retries=5,
+                 backoff=2., maxBackoff=120., timeout=60.):
+    """
+    Downloads a file over HTTP, retrying (and resuming from where it stopped) if
+    the download fails.
+
+    INPUTS:
+        - url: URL of the file
+        - ofile: path to download the file to. If it already exists, it is taken
+          to be the first part of the file (e.g. from an interrupted download),
+          and only the rest of the file is downloaded.
+        - expectedSize: size of the file in bytes, if known
+        - sha256: sha256 (hex string) of the file, if known
+        - retries: number of times to try again after a failed attempt
+        - backoff: seconds to wait before the first retry. Doubled for every
+          retry after that, up to maxBackoff.
+        - timeout: seconds to wait for the server before an attempt fails
+
+    OUTPUTS:
+        - ofile
+    """
+    for attempt in range(retries+1):
+        try:
+            total = _downloadOnce(url=url, ofile=ofile, timeout=timeout)
+            size = os.path.getsize(ofile)
+            if total is None:
+                total = expectedSize
+            if total is not None and size < total:
+                # Connection dropped part of the way through; resumed next attempt
+                raise downloadError("%s: only %s of %s bytes received" % (url, size, total))
+            if (total is not None and size > total) or (expectedSize is not None and size != expectedSize):
+                os.remove(ofile)
+                raise downloadError("%s: %s bytes received, expected %s" % (url, size, expectedSize or total))
+            if sha256 is not None:
+                h = hashlib.sha256()
+                with open(ofile, "rb") as f:
+                    for chunk in iter(lambda: f.read(chunkSize), b""):
+                        h.update(chunk)
+                if h.hexdigest() != sha256:
+                    os.remove(ofile)
+                    raise downloadError("%s: checksum does not match" % url)
+            return ofile
+        except (downloadError, urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if isinstance(e, downloadError) and not e.retry:
+                raise
+            if attempt == retries:
+                raise downloadError("%s: failed after %s attempts (%s)" % (url, retries+1, e), retry=False)
+            time.sleep(min(maxBackoff, backoff*2**attempt)*random.uniform(0.5, 1.))
+
+
+async def _runAll(jobs=None, maxPerHost=4, maxWorkers=8):
+    # One semaphore per server, plus one overall
+    hostLimits = {}
+    allLimit = asyncio.Semaphore(maxWorkers)
+    loop = asyncio.get_running_loop()
+
+    async def run(url, func):
+        host = urllib.parse.urlsplit(url).netloc or "local"
+        if host not in hostLimits:
+            hostLimits[host] = asyncio.Semaphore(maxPerHost)
+        async with hostLimits[host], allLimit:
+            return await loop.run_in_executor(None, func)
+
+    return await asyncio.gather(*[run(url, func) for url, func in jobs], return_exceptions=True)
+
+
+def fetchAll(jobs=None, maxPerHost=4, maxWorkers=8):
+    """
+    Runs several downloads at the same time.
+
+    INPUTS:
+        - jobs: list of (url, function) pairs. Each function takes no arguments
+          and does the download of url, e.g. functools.partial(downloadFile,
+          url=url, ofile=ofile), or a downloadCache fetch.
+        - maxPerHost: maximum number of downloads from the same server at once
+        - maxWorkers: maximum number of downloads at once
+
+    OUTPUTS:
+        - List of what each function returned, in the same order as jobs. If any
+          download failed, an error is raised once all the others have finished.
+    """
+    if not jobs:
+        return []
+    results = asyncio.run(_runAll(jobs=jobs, maxPerHost=maxPerHost, maxWorkers=maxWorkers))
+    failed = [(url, r) for (url, func), r in zip(jobs, results) if isinstance(r, BaseException)]
+    if failed:
+        raise downloadError("%s of %s downloads failed: %s" % (len(failed), len(jobs),
+                            "; ".join("%s (%s)" % (url, e) for url, e in failed)), retry=False)
+    return results
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from datetime import datetime
+from . import fewsUtils
+from . import runHandoff
+from . import asyncDownload
+
+#====== Local cache of downloaded forecast products ======#
+# The BoM storm surge (NSS) and nearshore wave (Auswave) forecasts are fetched
+# once per cycle, by the NSSDownload and WaveDownload modules, either from the
+# BoM servers (forecast mode) or from the folder the forecasts are archived in
+# (hindcast mode). Rather than downloading/copying a file again each time it is
+# needed (e.g. when a cycle is re-run, or by another region that uses the same
+# file), the files are kept in a shared cache, [Region Home]\Cache\BoM by default:
+#
+#     [cacheDir]\objects\[first 2 characters of sha256]\[sha256].nc
+#     [cacheDir]\index.json
+#
+# Files are stored by content (sha256), and the index maps each product and issue
+# time (e.g. "NSS/2020020800") to the stored file, along with its size and when it
+# was last used. Files are written to a temporary file and then renamed, so the
+# cache never holds a half-downloaded file (downloads are retried and resumed, see
+# asyncDownload.py), and are checked against their size (every time they are used)
+# and sha256 (when stored, or if verify=True). Once the cache grows past maxSizeGB,
+# the least recently used files are removed.
+#
+# The modules hard-link the cached file into their ncFiles folder (see
+# runHandoff.linkFile), so the file isn't duplicated on disk, and wipeForecast.py
+# deleting the ncFiles folder leaves the cache as it is.
+
+# Size of the chunks files are read/downloaded in
+chunkSize = 1 << 20
+# Seconds to wait for another process to release the index lock before
+# assuming it was left behind by a process that crashed
+lockTimeout = 120.
+
+
+def fileHash(ifile=None):
+    """
+    Returns the sha256 (hex string) of a file.
+    """
+    h = hashlib.sha256()
+    with open(ifile, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class downloadCache:
+
+    def __init__(self, cacheDir=None, maxSizeGB=20.):
+        # Cache directory
+        self.cacheDir = cacheDir
+        self.objectDir = os.path.join(cacheDir, "objects")
+        self.indexFile = os.path.join(cacheDir, "index.json")
+        self.lockFile = os.path.join(cacheDir, "index.lock")
+        # Maximum size of the cache, in bytes
+        self.maxBytes = int(maxSizeGB*1024**3)
+        if not os.path.exists(self.objectDir):
+            os.makedirs(self.objectDir)
+
+    #====== Index ======#
+    def _lock(self):
+        # Simple cross-process lock on the index: a lock file created exclusively
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self.lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return
+            except FileExistsError:
+                # Lock left behind by a process that crashed
+                try:
+                    if time.time() - os.path.getmtime(self.lockFile) > lockTimeout:
+                        os.remove(self.lockFile)
+                        continue
+                except OSError:
+                    continue
+                if time.time() - start > 2*lockTimeout:
+                    raise TimeoutError("Could not lock cache index: %s" % self.lockFile)
+                time.sleep(0.1)
+
+    def _unlock(self):
+        try:
+            os.remove(self.lockFile)
+        except OSError:
+            pass
+
+    def _readIndex(self):
+        if not os.path.exists(self.indexFile):
+            return {}
+        with open(self.indexFile) as f:
+            return json.load(f)
+
+    def _writeIndex(self, index=None):
+        with fewsUtils.atomicWrite(self.indexFile, "w") as f:
+            json.dump(index, f, indent=1)
+
+    def objectPath(self, sha256=None, ext=".nc"):
+        """
+        Path a file with the given sha256 is stored at.
+        """
+        return os.path.join(self.objectDir, sha256[:2], sha256 + ext)
+
+    @staticmethod
+    def key(product=None, issueTime=None):
+        """
+        Index key of a product (e.g. "NSS" or "PER.msh") and issue time (datetime
+        or string).
+        """
+        if isinstance(issueTime, datetime):
+            issueTime = issueTime.strftime("%Y%m%d%H%M")
+        return "%s/%s" % (product, issueTime)
+
+    #====== Lookup ======#
+    def lookup(self, product=None, issueTime=None, verify=False):
+        """
+        Returns the path of the cached file for a product and issue time, or None
+        if it isn't cached (or the cached file fails its integrity check, in which
+        case it is removed from the cache).
+        """
+        key = self.key(product, issueTime)
+        self._lock()
+        try:
+            index = self._readIndex()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = self.objectPath(entry["sha256"], entry["ext"])
+            ok = os.path.exists(path) and os.path.getsize(path) == entry["size"]
+            if ok and verify:
+                ok = fileHash(path) == entry["sha256"]
+            if not ok:
+                del index[key]
+                if os.path.exists(path) and not self._inUse(index, entry["sha256"]):
+                    os.remove(path)
+                self._writeIndex(index)
+                return None
+            entry["lastUsed"] = time.time()
+            self._writeIndex(index)
+            return path
+        finally:
+            self._unlock()
+
+    @staticmethod
+    def _inUse(index=None, sha256=None):
+        # True if any entry in the index points to the file with this sha256
+        return any(e["sha256"] == sha256 for e in index.values())
+
+    #====== Storing ======#
+    def _store(self, key=None, tmpFile=None, fname=None, source=None, expectedSize=None):
+        # Checks a downloaded/copied temporary file and moves it into the cache
+        size = os.path.getsize(tmpFile)
+        if expectedSize is not None and size != expectedSize:
+            os.remove(tmpFile)
+            raise IOError("%s is incomplete: %s of %s bytes" % (source, size, expectedSize))
+        sha256 = fileHash(tmpFile)
+        ext = os.path.splitext(fname)[1]
+        path = self.objectPath(sha256, ext)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock()
+        try:
+            # Identical content already stored (e.g. under another key)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                os.remove(tmpFile)
+            else:
+                os.replace(tmpFile, path)
+            index = self._readIndex()
+            index[key] = {"fname":fname, "sha256":sha256, "ext":ext, "size":size,
+                          "source":source, "stored":time.time(), "lastUsed":time.time()}
+            self._evict(index, keep=key)
+            self._writeIndex(index)
+        finally:
+            self._unlock()
+        return path
+
+    def _evict(self, index=None, keep=None):
+        # Removes the least recently used files until the cache fits in maxBytes
+        sizes = {}
+        for e in index.values():
+            sizes[e["sha256"]] = e["size"]
+        total = sum(sizes.values())
+        for key in sorted(index, key=lambda k: index[k]["lastUsed"]):
+            if total <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            if not self._inUse(index, entry["sha256"]):
+                path = self.objectPath(entry["sha256"], entry["ext"])
+                if os.path.exists(path):
+                    os.remove(path)
+                total -= entry["size"]
+
+    def _tmpFile(self, fname=None, resumable=False):
+        # Partial downloads keep the same name from one attempt to the next, so
+        # that an interrupted download can be resumed
+        if resumable:
+            return os.path.join(self.cacheDir, "%s.part" % fname)
+        return os.path.join(self.cacheDir, "%s.%s.part" % (fname, os.getpid()))
+
+    def fetch(self, product=None, issueTime=None, source=None, fname=None, **downloadArgs):
+        """
+        Returns the path of the cached file for a product and issue time, fetching
+        it into the cache first if it isn't cached yet.
+
+        INPUTS:
+            - product: product name, e.g. "NSS" or "PER.msh"
+            - issueTime: issue time of the forecast (datetime or string)
+            - source: URL (http/https) or path of the file to fetch
+            - fname: file name (defaults to the last part of source)
+            - downloadArgs: passed on to asyncDownload.downloadFile for URLs
+              (e.g. retries, timeout, sha256)
+
+        OUTPUTS:
+            - Path of the file in the cache
+        """
+        if fname is None:
+            fname = os.path.basename(source.replace("\\", "/").rstrip("/"))
+        path = self.lookup(product, issueTime)
+        if path is not None:
+            return path
+        if source.startswith(("http://", "https://")):
+            # Downloaded with retries; a partial download is left in place for the
+            # next attempt to resume (see asyncDownload.downloadFile)
+            tmpFile = self._tmpFile(fname, resumable=True)
+            asyncDownload.downloadFile(url=source, ofile=tmpFile, **downloadArgs)
+            return self._store(key=self.key(product, issueTime), tmpFile=tmpFile, fname=fname,
+                               source=source)
+        tmpFile = self._tmpFile(fname)
+        try:
+            shutil.copyfile(source, tmpFile)
+            return self._store(key=self.key(product, issueTime), tmpFile=tmpFile, fname=fname,
+                               source=source, expectedSize=os.path.getsize(source))
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+
+    def fetchTo(self, product=None, issueTime=None, source=None, outDir=None, fname=None, **downloadArgs):
+        """
+        Same as fetch, and then hard-links the cached file into outDir (under its
+        original file name). Returns the path of the file in outDir.
+        """
+        path = self.fetch(product=product, issueTime=issueTime, source=source, fname=fname, **downloadArgs)
+        if fname is None:
+            fname = os.path.basename(source.replace("\\", "/").rstrip("/"))
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+        ofile = os.path.join(outDir, fname)
+        runHandoff.linkFile(path, ofile)
+        return ofile
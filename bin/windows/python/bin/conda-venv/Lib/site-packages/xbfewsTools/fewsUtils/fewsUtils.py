@@ -1,4 +1,10 @@
+import os
+import time
+import shutil
+import weakref
+from contextlib import contextmanager
 from datetime import datetime
+from xml.sax.saxutils import escape
 import pytz
 
 def parseFEWSTime(fewsTime=None):
@@ -33,11 +39,158 @@ def clearDiagLastLine(diagFile=None):
     m=d.split("\n")
     s="\n".join(m[:-1])
     fd=open(diagFile,"w+")
-    for i in range(len(s)):
-        fd.write(s[i])
+    fd.write(s)
     fd.close()
 
 def write2DiagFile(errorLevel=None, note=None):
     string = "\n<line level=\"%s\" description=\"From PYTHON: %s\"/>\n" % (errorLevel, note)
     return string
 
+
+
+#====== Atomic file writes ======#
+@contextmanager
+def atomicWrite(ofile=None, mode=None):
+    """
+    Writes a file that another process (or a later run) may read at the same
+    time, e.g. a cache or a state file. The file is written to a temporary
+    file next to it, which is then renamed to ofile, so a half-written file is
+    never read. If writing fails, the temporary file is removed and ofile is
+    left as it was.
+
+    INPUTS:
+        - ofile: path of the file
+        - mode: if given (e.g. "w", "wb"), the temporary file is opened in
+          this mode and the file object is returned. If not, the path of the
+          temporary file is returned, for writers that open the file
+          themselves (e.g. xarray's to_netcdf).
+
+    e.g.
+        with atomicWrite(ofile, "wb") as f:
+            pickle.dump(obj, f)
+    """
+    tmpFile = "%s.%s.tmp" % (ofile, os.getpid())
+    try:
+        if mode is None:
+            yield tmpFile
+        else:
+            with open(tmpFile, mode) as f:
+                yield f
+        os.replace(tmpFile, ofile)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+
+#====== Diagnostics writer ======#
+# Writes status messages to the diag.xml file that FEWS reads once a module has
+# finished. The file is held open and messages are appended in blocks, rather
+# than the whole file being read and rewritten (clearDiagLastLine) every time a
+# message is added. The closing </Diag> tag is written after every block and
+# overwritten by the next one, by seeking back to where it starts, so the file
+# is always valid XML. Messages at warning level or worse (levels 0-2) are
+# written straight away. Anything still buffered is written when the writer is
+# closed, or when it is garbage collected (e.g. when a module fails).
+
+# FEWS diagnostic levels: 0 = fatal, 1 = error, 2 = warning, 3 = info, 4 = debug
+diagFooter = "</Diag>"
+
+
+class _diagFile:
+
+    def __init__(self, diagFile=None):
+        # The file is opened in binary mode, so that positions can be sought to
+        self.fd = open(diagFile, "r+b")
+        # Position of the closing tag (or the end of the file if there isn't one)
+        self.fd.seek(0, os.SEEK_END)
+        size = self.fd.tell()
+        self.fd.seek(max(0, size-256))
+        tail = self.fd.read()
+        i = tail.rfind(diagFooter.encode())
+        self.footerPos = size if i < 0 else size - len(tail) + i
+        self.buffer = []
+
+    def flush(self):
+        if self.fd is None or not self.buffer:
+            return
+        self.fd.seek(self.footerPos)
+        self.fd.write("".join(self.buffer).encode("utf-8"))
+        self.footerPos = self.fd.tell()
+        self.fd.write(diagFooter.encode())
+        self.fd.truncate()
+        self.fd.flush()
+        self.buffer = []
+
+    def close(self):
+        if self.fd is None:
+            return
+        # Also makes sure the closing tag is there, even if nothing was written
+        self.fd.seek(self.footerPos)
+        self.fd.write("".join(self.buffer).encode("utf-8") + diagFooter.encode())
+        self.fd.truncate()
+        self.fd.close()
+        self.fd = None
+        self.buffer = []
+
+
+class diagWriter:
+
+    def __init__(self, diagFile=None, blankFile=None, bufferSize=20, timestamps=True):
+        """
+        Opens a FEWS diagnostics file for writing.
+
+        INPUTS:
+            - diagFile: path to the diagnostics file (diag.xml)
+            - blankFile: template diagnostics file (diagOpen.txt). If given,
+              it is copied to diagFile first, starting a new diagnostics file.
+              If not, messages are added to the existing diagFile.
+            - bufferSize: number of messages held in memory before they are
+              written to file
+            - timestamps: if True, the time of each message and the time
+              elapsed since the writer was opened are added to the message
+        """
+        if blankFile is not None:
+            shutil.copy(blankFile, diagFile)
+        self.diagFile = diagFile
+        self.bufferSize = int(bufferSize)
+        self.timestamps = timestamps
+        self.startTime = time.time()
+        self._file = _diagFile(diagFile)
+        # Writes anything still buffered if the writer isn't closed explicitly
+        self._finalizer = weakref.finalize(self, self._file.close)
+
+    def formatLine(self, errorLevel=None, note=None):
+        """
+        Returns a diagnostics line in the format FEWS expects, see also 
+        write2DiagFile. 
+        """
+        if self.timestamps:
+            note = "[%s | +%.1f s] %s" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                          time.time()-self.startTime, note)
+        return "\n<line level=\"%s\" description=\"From PYTHON: %s\"/>\n" % (
+                    errorLevel, escape(str(note), {"\"":"&quot;"}))
+
+    def write(self, errorLevel=None, note=None):
+        """
+        Adds a message to the diagnostics file.
+
+        INPUTS:
+            - errorLevel: FEWS diagnostic level (0 = fatal, 1 = error, 
+              2 = warning, 3 = info, 4 = debug)
+            - note: the message
+        """
+        self._file.buffer.append(self.formatLine(errorLevel=errorLevel, note=note))
+        if int(errorLevel) <= 2 or len(self._file.buffer) >= self.bufferSize:
+            self._file.flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+from datetime import datetime
+from . import fewsUtils
+
+#====== Handing XBeach run directories over without copying ======#
+# An XBeach run is built in the forecast directory ([Region Home]\Forecasts\...\XBeach),
+# run in the module directory ([Region Home]\Modules\XBeach\[site]\[time]SystemTime-[site])
+# and handed back to the forecast directory to be post-processed. Rather than copying
+# the files each way (including the grids and the multi-gigabyte xboutput.nc), the
+# files are hard-linked: both directories then point to the same data on disk, and
+# the data is only freed once the file is deleted from both (see wipeForecast.py).
+# Files are only copied if they can't be hard-linked (e.g. the two directories are
+# on different drives).
+#
+# Each handover writes a manifest (handoffManifest.json) to the receiving directory,
+# recording which stage produced ("owns") each file and whether it was linked or
+# copied. The files handed over are only ever read by the receiving side, or
+# replaced as a whole (never written to in place), so sharing them is safe.
+
+# Name of the manifest file written to the receiving directory
+manifestName = "handoffManifest.json"
+
+
+def linkFile(src=None, dst=None):
+    """
+    Hard-links src to dst, replacing dst if it exists. Falls back to copying the
+    file if it can't be hard-linked. Returns "hardlink", "copy" or "same" (if dst
+    already is the same file as src).
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return "same"
+        # Replace rather than overwrite, so that any other links to dst are untouched
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        shutil.copy2(src, dst)
+        return "copy"
+
+
+def readManifest(runDir=None):
+    """
+    Returns the manifest of a directory as a dictionary, or None if it doesn't
+    have one.
+    """
+    path = os.path.join(runDir, manifestName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _writeManifest(runDir=None, manifest=None):
+    path = os.path.join(runDir, manifestName)
+    with fewsUtils.atomicWrite(path, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def handoffDir(srcDir=None, dstDir=None, owner=None, replace=True, skipOwners=()):
+    """
+    Hands the contents of a run directory over to another directory by
+    hard-linking every file (including those in sub-directories).
+
+    INPUTS:
+        - srcDir: directory to hand over
+        - dstDir: receiving directory
+        - owner: name of the stage that produced the files in srcDir (e.g.
+          "PreProcessXBeach"). Files listed in the manifest of srcDir keep the
+          owner given there, so that files handed back keep their original owner.
+        - replace: if True, dstDir is replaced as a whole: the files are linked
+          into a staging directory, which is then renamed to dstDir, so dstDir
+          is never left half-built. If False, the files are added to dstDir,
+          replacing any existing files of the same name.
+        - skipOwners: files owned by these stages (according to the manifest of
+          srcDir) are not handed over, e.g. the output of a previous XBeach run
+          of the same forecast when handing the inputs over to XBeach again.
+
+    OUTPUTS:
+        - The manifest written to dstDir (dictionary)
+    """
+    srcManifest = readManifest(srcDir) or {"files":{}}
+    if replace:
+        buildDir = dstDir.rstrip("\\/") + ".staging"
+        if os.path.exists(buildDir):
+            shutil.rmtree(buildDir)
+        os.makedirs(buildDir)
+        files = {}
+    else:
+        buildDir = dstDir
+        if not os.path.exists(buildDir):
+            os.makedirs(buildDir)
+        files = (readManifest(dstDir) or {"files":{}})["files"]
+
+    for root, dirs, fnames in os.walk(srcDir):
+        rel = os.path.relpath(root, srcDir)
+        outDir = buildDir if rel == "." else os.path.join(buildDir, rel)
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+        for fname in fnames:
+            relPath = fname if rel == "." else os.path.join(rel, fname).replace("\\", "/")
+            if relPath == manifestName:
+                continue
+            fileOwner = srcManifest["files"].get(relPath, {}).get("owner", owner)
+            if fileOwner in skipOwners:
+                continue
+            method = linkFile(os.path.join(root, fname), os.path.join(outDir, fname))
+            if method == "same" and relPath in files:
+                continue
+            files[relPath] = {"owner":fileOwner, "method":method,
+                              "size":os.path.getsize(os.path.join(outDir, fname))}
+
+    manifest = {"source":os.path.abspath(srcDir), "handedOverAt":datetime.now().isoformat(),
+                "files":files}
+    _writeManifest(buildDir, manifest)
+
+    if replace:
+        # Swap the staged directory into place
+        if os.path.exists(dstDir):
+            shutil.rmtree(dstDir)
+        os.replace(buildDir, dstDir)
+    return manifest
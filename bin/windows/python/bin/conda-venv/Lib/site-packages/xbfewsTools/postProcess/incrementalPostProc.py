@@ -0,0 +1,268 @@
+import os
+import pickle
+import numpy as np
+import xarray as xr
+from . import postProcTools
+from ..fewsUtils import fewsUtils
+
+#====== Incremental post-processing of XBeach output ======#
+# The heavy part of post-processing an XBeach run is reading xboutput.nc: the
+# extreme water line needs every gauge ("pointtime") record, and the erosion
+# scarps and maximum erosion/flow grids need every spatial ("globaltime" and
+# "meantime") record. Rather than reading the whole file once XBeach has
+# finished, xbPostProcState can be updated while XBeach is still running
+# (see tailXBeachOutput.py in the PostProcessXBeach module): each update reads
+# only the records written since the previous one, and keeps the reduced
+# results (gauge column indeces, scarp column indeces and running maxima).
+# postprocessMain.py then only has to read the last few records, if any, and
+# export the results.
+#
+# XBeach may be part of the way through writing the last record of each time
+# dimension, so until XBeach has finished, the last record is left for the
+# next update. netCDF doesn't guarantee that records read while another process
+# is writing the file have all reached the disk, so once XBeach has finished:
+#     - the block of records read by the last update before that is read again
+#     (the state is taken back to what it was before that update)
+#     - the gauge times read earlier are checked against the finished file, and
+#     if they don't match, the whole file is read again from the start
+# The size, modification time and time dimension lengths of the finished file
+# are saved with the state, so that postprocessMain.py only uses a saved state
+# that was made from the xboutput.nc it is post-processing (see sourceMatches).
+
+# Name of the file the state is saved to, in the XBeach run directory
+stateFileName = "postProcState.pkl"
+# Time dimensions of the XBeach output
+timeDims = ("pointtime", "globaltime", "meantime")
+
+
+def ncFileInfo(ncFile=None, sizes=None):
+    """
+    Size and modification time of an XBeach output file, and the lengths of
+    its time dimensions (sizes, a dictionary, e.g. ds.sizes).
+    """
+    st = os.stat(ncFile)
+    return {"size":st.st_size, "mtime_ns":st.st_mtime_ns,
+            "sizes":{d:int(sizes[d]) for d in timeDims}}
+
+
+class xbPostProcState:
+
+    def __init__(self, morstart=None, totalRunTime=None, scarpThreshold=0.5, maxBlockMB=256):
+        # Time (s) morphology is switched on, and the total run time (s) including
+        # spin-up. Scarps and maximum grids are only computed if morphology was
+        # switched on before the end of the run.
+        self.morstart = morstart
+        self.totalRunTime = totalRunTime
+        self.morphology = morstart is not None and morstart < totalRunTime
+        # See hotspotForecast.scarpThreshold
+        self.scarpThreshold = scarpThreshold
+        # Rough upper limit on the memory used for each block of records read, in MB
+        self.maxBlockMB = maxBlockMB
+        # XBeach grid
+        self.globalx = None
+        self.globaly = None
+        # Extreme water line: gauge times and the column index closest to each
+        # gauge (pointtime x rows), dummy gauge excluded
+        self.nPointTimes = 0
+        self._pointTimes = []
+        self._colIndeces = []
+        # Erosion scarps: globaltime index morphology is switched on at, the bed
+        # elevation at that time, and the scarp column index in each row
+        # (timesteps x rows) for globaltime steps from eroStartIndex+2
+        self.eroStartIndex = None
+        self.zbi = None
+        self.nGlobalTimes = 0
+        self._scarpTimesteps = []
+        self._scarpCols = []
+        # Maximum erosion, flow depth and u/v flow velocities
+        self.nMeanTimes = 0
+        self.maxima = None
+        # True once XBeach has finished and the whole file has been read
+        self.finished = False
+        # File info of the finished output file (see ncFileInfo)
+        self.ncInfo = None
+        # The state before the last update that read any records, which the
+        # final update goes back to (see _snapshot)
+        self._checkpoint = None
+
+    @property
+    def pointTimes(self):
+        return np.concatenate(self._pointTimes) if self._pointTimes else np.empty(0)
+
+    @property
+    def colIndeces(self):
+        if not self._colIndeces:
+            return np.empty((0, 0 if self.globalx is None else self.globalx.shape[0]), dtype=np.int64)
+        return np.concatenate(self._colIndeces, axis=0)
+
+    @property
+    def scarpTimesteps(self):
+        return np.concatenate(self._scarpTimesteps) if self._scarpTimesteps else np.empty(0, dtype=np.int64)
+
+    @property
+    def scarpCols(self):
+        if not self._scarpCols:
+            return np.empty((0, 0 if self.globalx is None else self.globalx.shape[0]), dtype=np.int64)
+        return np.concatenate(self._scarpCols, axis=0)
+
+    def update(self, ncFile=None, final=False):
+        """
+        Reads the records added to an XBeach output file since the last update,
+        and updates the extreme water line, scarp and maximum grid results.
+
+        INPUTS:
+            - ncFile: path to xboutput.nc
+            - final: True once XBeach has finished. All records are then read,
+              including the last one, and the state is marked as finished.
+        """
+        ds = xr.open_dataset(ncFile, cache=False)
+        try:
+            if final:
+                self._rewind(ds)
+                self._update(ds, final=True)
+                sizes = dict(ds.sizes)
+            else:
+                snapshot = self._snapshot()
+                # A read that fails part of the way through is undone, so it is
+                # tried again as a whole next time
+                try:
+                    self._update(ds, final=False)
+                except Exception:
+                    self._restore(snapshot)
+                    raise
+                if self._counters() != snapshot["counters"]:
+                    self._checkpoint = snapshot
+        finally:
+            ds.close()
+        if final:
+            self.ncInfo = ncFileInfo(ncFile, sizes)
+            self._checkpoint = None
+            self.finished = True
+
+    def sourceMatches(self, ncFile=None):
+        """
+        True if the state was finished from ncFile as it is now (same size,
+        modification time and time dimension lengths).
+        """
+        if not self.finished or getattr(self, "ncInfo", None) is None or not os.path.exists(ncFile):
+            return False
+        with xr.open_dataset(ncFile, cache=False) as ds:
+            sizes = dict(ds.sizes)
+        if any(d not in sizes for d in timeDims):
+            return False
+        return ncFileInfo(ncFile, sizes) == self.ncInfo
+
+    #====== Going back over records read while XBeach was writing ======#
+    def _counters(self):
+        return (self.nPointTimes, self.eroStartIndex, self.zbi is not None,
+                self.nGlobalTimes, self.nMeanTimes)
+
+    def _snapshot(self):
+        # Everything an update changes. The lists are only ever appended to, so
+        # their lengths are enough; the maxima are updated in place, so are copied.
+        return {"counters":self._counters(),
+                "nPointBlocks":len(self._pointTimes), "nScarpBlocks":len(self._scarpTimesteps),
+                "zbi":self.zbi,
+                "maxima":None if self.maxima is None else tuple(m.copy() for m in self.maxima)}
+
+    def _restore(self, snapshot=None):
+        (self.nPointTimes, self.eroStartIndex, _, self.nGlobalTimes, self.nMeanTimes) = snapshot["counters"]
+        del self._pointTimes[snapshot["nPointBlocks"]:]
+        del self._colIndeces[snapshot["nPointBlocks"]:]
+        del self._scarpTimesteps[snapshot["nScarpBlocks"]:]
+        del self._scarpCols[snapshot["nScarpBlocks"]:]
+        self.zbi = snapshot["zbi"]
+        self.maxima = snapshot["maxima"]
+
+    def _reset(self):
+        # Start again from the beginning of the file
+        self.__init__(morstart=self.morstart, totalRunTime=self.totalRunTime,
+                      scarpThreshold=self.scarpThreshold, maxBlockMB=self.maxBlockMB)
+
+    def _rewind(self, ds):
+        # Goes back to before the last block of records read while XBeach was
+        # running, and checks that the records read before that are still there
+        if self._checkpoint is not None:
+            self._restore(self._checkpoint)
+            self._checkpoint = None
+        if self.nPointTimes == 0:
+            return
+        readTimes = self.pointTimes
+        fileTimes = ds["pointtime"].isel({"pointtime":slice(0, self.nPointTimes)}).values
+        if fileTimes.shape != readTimes.shape or not np.array_equal(fileTimes, readTimes):
+            self._reset()
+
+    def _update(self, ds, final=False):
+        # Number of complete records of each time dimension
+        margin = 0 if final else 1
+        nPoint = max(0, ds.sizes["pointtime"] - margin)
+        nGlobal = max(0, ds.sizes["globaltime"] - margin)
+        nMean = max(0, ds.sizes["meantime"] - margin)
+        if self.globalx is None:
+            self.globalx = ds.globalx.values
+            self.globaly = ds.globaly.values
+
+        #========== Extreme water line ==========#
+        # Column index of the grid point nearest to each gauge (the first gauge
+        # is the dummy point XBeach needs, and is left out)
+        if nPoint > self.nPointTimes:
+            pointTime = slice(self.nPointTimes, nPoint)
+            pointx = ds["point_xz"].isel({"pointtime":pointTime, "points":slice(1,None)}).values
+            self._colIndeces.append(postProcTools.nearestColIndex(globalx=self.globalx, pointx=pointx))
+            self._pointTimes.append(ds["pointtime"].isel({"pointtime":pointTime}).values)
+            self.nPointTimes = nPoint
+
+        if not self.morphology:
+            return
+
+        #========== Bed elevation when morphology is switched on ==========#
+        if self.eroStartIndex is None:
+            if nMean < 2:
+                return
+            dtout = (ds.meantime[1]-ds.meantime[0]).values
+            self.eroStartIndex = int(self.morstart/dtout)+1
+            self.nGlobalTimes = self.eroStartIndex+2
+        if self.zbi is None:
+            if nGlobal <= self.eroStartIndex:
+                return
+            self.zbi = ds["zb"].isel({"globaltime":self.eroStartIndex}).values
+
+        #========== Erosion scarps ==========#
+        if nGlobal > self.nGlobalTimes:
+            timesteps = np.arange(self.nGlobalTimes, nGlobal)
+            self._scarpCols.append(postProcTools.scarpColIndeces(ds=ds, zbi=self.zbi, timesteps=timesteps,
+                                                                 threshold=self.scarpThreshold,
+                                                                 maxBlockMB=self.maxBlockMB))
+            self._scarpTimesteps.append(timesteps)
+            self.nGlobalTimes = nGlobal
+
+        #========== Maximum erosion, flow depth and flow velocities ==========#
+        # Meantime step t goes with globaltime step t+1
+        t1 = nMean if final else min(nMean, nGlobal-1)
+        if t1 > self.nMeanTimes:
+            self.maxima = postProcTools.maxGrids(ds=ds, zbi=self.zbi, maxBlockMB=self.maxBlockMB,
+                                                 t0=self.nMeanTimes, t1=t1, maxima=self.maxima)
+            self.nMeanTimes = t1
+
+    def save(self, ofile=None):
+        """
+        Saves the state to a pickle file (see fewsUtils.atomicWrite).
+        """
+        with fewsUtils.atomicWrite(ofile, "wb") as output:
+            pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
+
+
+def loadState(ifile=None, ncFile=None):
+    """
+    Loads a state saved with xbPostProcState.save, or returns None if there
+    isn't one. If ncFile is given, None is also returned if the state wasn't
+    made from ncFile as it is now (see xbPostProcState.sourceMatches), e.g. a
+    state left over from an earlier run of XBeach.
+    """
+    if ifile is None or not os.path.exists(ifile):
+        return None
+    with open(ifile, "rb") as f:
+        state = pickle.load(f)
+    if ncFile is not None and not state.sourceMatches(ncFile):
+        return None
+    return state
@@ -0,0 +1,359 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xarray as xr
+from . import postProcTools
+from ..fewsUtils import fewsUtils
+
+#====== Storm impact indicators for the whole forecast at once ======#
+# The building-scarp distance (BSD) and safe corridor width (SCW) indicators are
+# worked out for every timestep of a forecast and every row of the XBeach grid
+# (i.e. every corridor) in one go, rather than one timestep at a time:
+#     - the erosion scarp and extreme water line positions of every timestep are
+#     loaded at once, either from the GeoPackage store or from the per-timestep
+#     shapefiles written by postprocessMain.py, as (time x row) x and y arrays
+#     - the distances are computed for every timestep (see
+#     postProcTools.nearestDistanceXY), and classified with compute_bsd and
+#     compute_scw
+#     - the results are saved as a single netCDF file (the "cube",
+#     indicators_cube.nc), with a time and a corridor dimension
+# The per-timestep shapefiles (which FEWS reads) and GeoPackage layers are then
+# written from the cube, if they are needed (see writeTimestepPoints), on a pool of
+# worker processes.
+#
+# Timesteps without an erosion scarp carry the last scarp found forward (which is
+# what the per-timestep indicator shapefiles have always shown). The time of the
+# scarp used at each timestep is kept in scarp_time_hrs.
+
+# Name of the cube, in the indicators folder of the post-processing directory
+cubeFileName = "indicators_cube.nc"
+# Indicator levels, as they are stored in the cube (0 where there is no indicator,
+# e.g. rows without a scarp)
+levelCodes = {"Low":1, "Medium":2, "High":3}
+
+
+def readTimestepPoints(fDir=None, fName=None, times=None):
+    """
+    Reads the per-timestep point shapefiles written by postprocessMain.py into
+    a single GeoDataFrame, in the same form as a layer of the GeoPackage store
+    (see postProcTools.readTimeseriesStore).
+
+    INPUTS:
+        - fDir: folder of the shapefiles
+        - fName: file name, with %s where the time (in hours) goes, e.g.
+          "scarp_%shrs_points.shp"
+        - times: model times (hours) to read. Timesteps without a file are
+          skipped.
+
+    OUTPUT:
+        - GeoDataFrame of the points of every timestep, with the time
+          ("time_hrs") and the row index of the XBeach grid ("rowInd"). Where
+          a shapefile has no rowInd field (gauges), the points are in row order.
+    """
+    gdfs = []
+    for t_step in times:
+        fPath = os.path.join(fDir, fName % f'{(t_step):.2f}'.zfill(6))
+        if not os.path.exists(fPath):
+            continue
+        gdf = gpd.read_file(fPath)
+        if "rowInd" not in gdf.columns:
+            gdf["rowInd"] = np.arange(0, len(gdf))
+        gdfs.append(gdf[["rowInd","geometry"]].assign(time_hrs=round(t_step, 2)))
+    if not gdfs:
+        return gpd.GeoDataFrame({"time_hrs":[], "rowInd":[]}, geometry=[])
+    return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), geometry="geometry")
+
+
+def pointsToArrays(points=None, times=None, nRows=None):
+    """
+    Turns points keyed by time and row (e.g. a layer of the GeoPackage store)
+    into (time x row) arrays of their x and y coordinates.
+
+    INPUTS:
+        - points: GeoDataFrame with "time_hrs", "rowInd" and point geometries
+        - times: model times (hours) of the rows of the arrays
+        - nRows: number of rows (corridors). Points in other rows are left out.
+
+    OUTPUT:
+        - x, y: (time x row) arrays, NaN where there is no point
+    """
+    x = np.full((len(times), nRows), np.nan)
+    y = np.full((len(times), nRows), np.nan)
+    if points is None or len(points) == 0:
+        return x, y
+    # Times are stored rounded to 2 decimal places (as in the shapefile names)
+    tInd = pd.Index(np.round(times, 2)).get_indexer(np.round(points["time_hrs"].to_numpy(dtype=float), 2))
+    rowInd = points["rowInd"].to_numpy(dtype=np.int64)
+    keep = (tInd >= 0) & (rowInd >= 0) & (rowInd < nRows)
+    x[tInd[keep], rowInd[keep]] = points.geometry.x.to_numpy()[keep]
+    y[tInd[keep], rowInd[keep]] = points.geometry.y.to_numpy()[keep]
+    return x, y
+
+
+def _holdLast(x=None, y=None, times=None):
+    # Carries the points of the last timestep that has any forward to the
+    # timesteps that have none. Returns the arrays and the time the points of
+    # each timestep are from (NaN before the first timestep with points).
+    has = ~np.isnan(x).all(axis=1)
+    src = np.where(has, np.arange(0, len(times)), -1)
+    src = np.maximum.accumulate(src)
+    found = src >= 0
+    xHeld = np.full(x.shape, np.nan)
+    yHeld = np.full(y.shape, np.nan)
+    xHeld[found] = x[src[found]]
+    yHeld[found] = y[src[found]]
+    srcTime = np.full(len(times), np.nan)
+    srcTime[found] = np.asarray(times, dtype=float)[src[found]]
+    return xHeld, yHeld, srcTime
+
+
+def _distanceCube(srcX=None, srcY=None, tgtX=None, tgtY=None):
+    # (time x row) distances from the source points of each timestep to the
+    # nearest target point of the same timestep. Sources may be fixed (1D).
+    nt = tgtX.shape[0]
+    srcX = np.broadcast_to(srcX, (nt, srcX.shape[-1]))
+    srcY = np.broadcast_to(srcY, (nt, srcY.shape[-1]))
+    dist = np.full(srcX.shape, np.nan)
+    for t in np.arange(0, nt):
+        dist[t] = postProcTools.nearestDistanceXY(srcX=srcX[t], srcY=srcY[t],
+                                                  tgtX=tgtX[t], tgtY=tgtY[t])
+    return dist
+
+
+def _levels(dist=None, valid=None, classify=None):
+    # Indicator level codes (see levelCodes) of the valid cells, using
+    # compute_bsd or compute_scw
+    codes = np.zeros(dist.shape, dtype=np.int8)
+    if valid.any():
+        levels = classify(pd.Series(dist[valid]))
+        codes[valid] = levels.map(levelCodes).fillna(0).to_numpy(dtype=np.int8)
+    return codes
+
+
+def computeIndicators(times=None, toeX=None, toeY=None, corridorX=None, corridorY=None,
+                      scarpX=None, scarpY=None, ewlX=None, ewlY=None,
+                      scarpMaxX=None, scarpMaxY=None, ewlMaxX=None, ewlMaxY=None, epsg=None):
+    """
+    Computes the building-scarp distance (BSD) and safe corridor width (SCW)
+    indicators for every timestep and corridor of a forecast.
+
+    INPUTS:
+        - times: model times (hours)
+        - toeX, toeY: locations of the dune toes (or other points the BSD is
+          measured from), one per corridor (row of the XBeach grid)
+        - corridorX, corridorY: locations of the corridor points the SCW is
+          measured from, one per corridor
+        - scarpX, scarpY: (time x row) erosion scarp locations, NaN where there
+          is no scarp (see pointsToArrays)
+        - ewlX, ewlY: (time x row) extreme water line locations
+        - scarpMaxX, scarpMaxY: most landward erosion scarp over the whole
+          forecast, one per row (NaN where there is no scarp). None if no scarp
+          was detected.
+        - ewlMaxX, ewlMaxY: extreme water line over the whole forecast, one per row
+        - epsg: projection of the coordinates
+
+    OUTPUT:
+        - xarray dataset (time x corridor) of the positions, distances (bsd_dist,
+          scw_dist) and indicator levels (bsd_level, scw_level), plus the
+          indicators over the whole forecast (bsd_dist_overall etc., corridor only)
+
+    BSD: for each row with a scarp, the distance from the row's dune toe to the
+    nearest scarp point. SCW: for each corridor, the distance to the nearest
+    point of the extreme water line. The same as indicatorsMain.py has always
+    computed, one timestep at a time.
+    """
+    times = np.asarray(times, dtype=float)
+    nRows = len(toeX)
+    if np.isnan(ewlX).all(axis=1).any():
+        missing = times[np.isnan(ewlX).all(axis=1)]
+        raise FileNotFoundError("No extreme water line for time(s) (hrs): %s" % missing)
+
+    #========== Building-scarp distance ==========#
+    scarpX, scarpY, scarpTime = _holdLast(x=scarpX, y=scarpY, times=times)
+    bsdValid = ~np.isnan(scarpX) & ~np.isnan(np.broadcast_to(toeX, scarpX.shape))
+    bsdDist = _distanceCube(srcX=toeX, srcY=toeY, tgtX=scarpX, tgtY=scarpY)
+    bsdDist[~bsdValid] = np.nan
+    bsdLevel = _levels(dist=bsdDist, valid=bsdValid, classify=postProcTools.compute_bsd)
+
+    #========== Safe corridor width ==========#
+    scwDist = _distanceCube(srcX=corridorX, srcY=corridorY, tgtX=ewlX, tgtY=ewlY)
+    scwValid = np.broadcast_to(~np.isnan(corridorX), scwDist.shape)
+    scwLevel = _levels(dist=scwDist, valid=scwValid, classify=postProcTools.compute_scw)
+
+    #========== Over the whole forecast ==========#
+    # BSD: from each dune toe to the most landward scarp. If no scarp was
+    # detected, every row is "Low".
+    if scarpMaxX is None or np.isnan(scarpMaxX).all():
+        bsdDistOverall = np.full(nRows, np.nan)
+        bsdLevelOverall = np.full(nRows, levelCodes["Low"], dtype=np.int8)
+    else:
+        bsdValidOverall = ~np.isnan(scarpMaxX) & ~np.isnan(toeX)
+        bsdDistOverall = postProcTools.nearestDistanceXY(srcX=np.where(bsdValidOverall, toeX, np.nan), srcY=toeY,
+                                                         tgtX=np.where(bsdValidOverall, scarpMaxX, np.nan), tgtY=scarpMaxY)
+        bsdLevelOverall = _levels(dist=bsdDistOverall, valid=bsdValidOverall, classify=postProcTools.compute_bsd)
+    # SCW: from each point of the extreme water line to the nearest corridor
+    scwDistOverall = postProcTools.nearestDistanceXY(srcX=ewlMaxX, srcY=ewlMaxY, tgtX=corridorX, tgtY=corridorY)
+    scwLevelOverall = _levels(dist=scwDistOverall, valid=~np.isnan(ewlMaxX), classify=postProcTools.compute_scw)
+
+    levelAttrs = {"flag_values":np.array([0] + list(levelCodes.values()), dtype=np.int8),
+                  "flag_meanings":"none " + " ".join(levelCodes)}
+    ds = xr.Dataset({"toe_x":("corridor", np.asarray(toeX, dtype=float)),
+                     "toe_y":("corridor", np.asarray(toeY, dtype=float)),
+                     "corridor_x":("corridor", np.asarray(corridorX, dtype=float)),
+                     "corridor_y":("corridor", np.asarray(corridorY, dtype=float)),
+                     "scarp_x":(("time","corridor"), scarpX),
+                     "scarp_y":(("time","corridor"), scarpY),
+                     "scarp_time_hrs":("time", scarpTime),
+                     "ewl_x":(("time","corridor"), ewlX),
+                     "ewl_y":(("time","corridor"), ewlY),
+                     "bsd_dist":(("time","corridor"), bsdDist),
+                     "bsd_level":(("time","corridor"), bsdLevel, levelAttrs),
+                     "scw_dist":(("time","corridor"), scwDist),
+                     "scw_level":(("time","corridor"), scwLevel, levelAttrs),
+                     "scarp_max_x":("corridor", np.full(nRows, np.nan) if scarpMaxX is None else scarpMaxX),
+                     "scarp_max_y":("corridor", np.full(nRows, np.nan) if scarpMaxY is None else scarpMaxY),
+                     "ewl_max_x":("corridor", ewlMaxX),
+                     "ewl_max_y":("corridor", ewlMaxY),
+                     "bsd_dist_overall":("corridor", bsdDistOverall),
+                     "bsd_level_overall":("corridor", bsdLevelOverall, levelAttrs),
+                     "scw_dist_overall":("corridor", scwDistOverall),
+                     "scw_level_overall":("corridor", scwLevelOverall, levelAttrs)},
+                    coords={"time_hrs":("time", np.round(times, 2)),
+                            "rowInd":("corridor", np.arange(0, nRows))})
+    ds.attrs["epsg"] = int(epsg) if epsg is not None else -1
+    return ds
+
+
+def saveCube(ds=None, ofile=None):
+    """
+    Saves the indicator cube to netCDF (see fewsUtils.atomicWrite).
+    """
+    with fewsUtils.atomicWrite(ofile) as tmpFile:
+        ds.to_netcdf(tmpFile)
+    return ofile
+
+
+def levelNames(codes=None):
+    """
+    Indicator level names ("Low", "Medium", "High") of level codes from the
+    cube. None where there is no indicator.
+    """
+    names = {code:level for level, code in levelCodes.items()}
+    return [names.get(int(c)) for c in np.asarray(codes).ravel()]
+
+
+def writeIndicatorTimesteps(shared=None, tInd=None):
+    """
+    Writes the BSD and SCW points of a block of timesteps, see
+    writeTimestepPoints and postProcTools.mapTimesteps. Returns the
+    GeoDataFrames for the GeoPackage store (None if it isn't written, or for
+    the BSD before the first scarp), one pair per timestep.
+    """
+    cube = shared["cube"]
+    plotAttrs = shared["plotAttrs"]
+    rowInd = cube["rowInd"]
+    epsg = shared["epsg"]
+    results = []
+    for t in tInd:
+        t_step = cube["time_hrs"][t]
+        tstep_hrs_str = f'{(t_step):.2f}'.zfill(6)
+
+        #========== Building-scarp distance ==========#
+        # Rows with a scarp at this timestep (none before the first scarp)
+        bsd_gdf = None
+        rows = ~np.isnan(cube["scarp_x"][t])
+        if rows.any():
+            bsd_gdf = gpd.GeoDataFrame({"rowInd":rowInd[rows]},
+                                       geometry=gpd.points_from_xy(cube["scarp_x"][t,rows],
+                                                                   cube["scarp_y"][t,rows]), crs=epsg)
+            bsd_gdf = bsd_gdf.merge(plotAttrs, how="inner", on="rowInd")
+            bsd_gdf["bsd_dist"] = cube["bsd_dist"][t,rows]
+            bsd_gdf["BSD"] = levelNames(cube["bsd_level"][t,rows])
+            if shared["bsdDir"] is not None:
+                bsd_gdf.to_file(os.path.join(shared["bsdDir"], "bsd_%shrs.shp" % tstep_hrs_str))
+
+        #========== Safe corridor width ==========#
+        # One point per row of the extreme water line, with the SCW of the
+        # corridor in the same row
+        scw_gdf = gpd.GeoDataFrame({"ewl_dist":cube["scw_dist"][t],
+                                    "SCW":levelNames(cube["scw_level"][t])},
+                                   geometry=gpd.points_from_xy(cube["ewl_x"][t],
+                                                               cube["ewl_y"][t]), crs=epsg)
+        if shared["scwDir"] is not None:
+            scw_gdf.to_file(os.path.join(shared["scwDir"], "scw_%shrs.shp" % tstep_hrs_str))
+
+        if shared["store"]:
+            results.append((None if bsd_gdf is None else bsd_gdf.assign(time_hrs=round(t_step, 2)),
+                            scw_gdf.assign(time_hrs=round(t_step, 2))))
+        else:
+            results.append((None, None))
+    return results
+
+
+def writeTimestepPoints(ds=None, plots_gdf=None, bsdDir=None, scwDir=None, store=None, epsg=None,
+                        nWorkers=1):
+    """
+    Writes the per-timestep BSD and SCW points from the indicator cube, as
+    shapefiles (bsd_[time]hrs.shp and scw_[time]hrs.shp, the files FEWS reads)
+    and/or as layers of a GeoPackage store.
+
+    INPUTS:
+        - ds: indicator cube (see computeIndicators)
+        - plots_gdf: the dune toes, with their row index (rowInd). Their
+          attributes are added to the BSD points.
+        - bsdDir, scwDir: folders for the shapefiles. Shapefiles aren't written
+          if None.
+        - store: dictionary the GeoDataFrames of each timestep are added to,
+          with the layers "bsd_points" and "scw_points" (see
+          postProcTools.writeTimeseriesStore), or None
+        - epsg: projection of the points
+        - nWorkers: number of worker processes the timesteps are spread over
+          (see postProcTools.mapTimesteps)
+    """
+    # Sent to each worker process once: the arrays of the cube that are needed,
+    # and the dune toe attributes
+    cubeVars = ["rowInd","time_hrs","scarp_x","scarp_y","bsd_dist","bsd_level",
+                "ewl_x","ewl_y","scw_dist","scw_level"]
+    shared = {"cube":{var:ds[var].values for var in cubeVars},
+              "plotAttrs":pd.DataFrame(plots_gdf.drop(columns="geometry")),
+              "bsdDir":bsdDir, "scwDir":scwDir, "store":store is not None, "epsg":epsg}
+    results = postProcTools.mapTimesteps(func=writeIndicatorTimesteps, nTimesteps=ds.sizes["time"],
+                                         shared=shared, nWorkers=nWorkers)
+    if store is not None:
+        for bsd_gdf, scw_gdf in results:
+            if bsd_gdf is not None:
+                store["bsd_points"].append(bsd_gdf)
+            store["scw_points"].append(scw_gdf)
+
+
+def overallPoints(ds=None, plots_gdf=None, epsg=None):
+    """
+    BSD and SCW points over the whole forecast, from the indicator cube.
+
+    INPUTS:
+        - ds: indicator cube (see computeIndicators)
+        - plots_gdf: the dune toes, with their row index (rowInd)
+        - epsg: projection of the points
+
+    OUTPUT:
+        - bsd_gdf: BSD at the most landward scarp of each row. If no scarp was
+          detected, the dune toes, all with a BSD of "Low".
+        - scw_gdf: SCW at each point of the extreme water line
+    """
+    rows = ~np.isnan(ds["scarp_max_x"].values)
+    if rows.any():
+        bsd_gdf = gpd.GeoDataFrame({"rowInd":ds["rowInd"].values[rows]},
+                                   geometry=gpd.points_from_xy(ds["scarp_max_x"].values[rows],
+                                                               ds["scarp_max_y"].values[rows]), crs=epsg)
+        bsd_gdf = bsd_gdf.merge(pd.DataFrame(plots_gdf.drop(columns="geometry")), how="inner", on="rowInd")
+        bsd_gdf["bsd_dist"] = ds["bsd_dist_overall"].values[rows]
+        bsd_gdf["BSD"] = levelNames(ds["bsd_level_overall"].values[rows])
+    else:
+        bsd_gdf = plots_gdf.copy()
+        bsd_gdf["BSD"] = "Low"
+    scw_gdf = gpd.GeoDataFrame({"ewl_dist":ds["scw_dist_overall"].values,
+                                "SCW":levelNames(ds["scw_level_overall"].values)},
+                               geometry=gpd.points_from_xy(ds["ewl_max_x"].values,
+                                                           ds["ewl_max_y"].values), crs=epsg)
+    return bsd_gdf, scw_gdf
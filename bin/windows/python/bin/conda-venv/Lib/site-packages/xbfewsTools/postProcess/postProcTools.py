@@ -4,13 +4,15 @@ import geopandas as gpd
 import numpy as np
 from rasterio.mask import mask
 from scipy.interpolate import griddata
-from shapely.geometry import Polygon, shape 
+from shapely.geometry import Polygon, shape, Point, LineString
 import pandas as pd
 import rasterio
 from rasterio.transform import Affine
 from pyproj import CRS
 import glob
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 def nearGeom(point, pts=None, gdfIn=None, outVar=None):
     # find the nearest point and return the corresponding Place value
@@ -24,6 +26,347 @@ def nearGeom(point, pts=None, gdfIn=None, outVar=None):
     else:
         raise
 
+def nearestColIndex(globalx=None, pointx=None):
+    """
+    Finds the cross-shore column of the XBeach grid that is closest to the
+    run-up gauge in each row, for every gauge output time at once. Replaces
+    a per-row, per-timestep search with one binary search (searchsorted)
+    per grid row that covers all of the gauge output times.
+
+    INPUTS:
+        - globalx: 2D array (rows x columns) of the x-coordinates of the
+          XBeach grid (globalx in xboutput.nc)
+        - pointx: 2D array (time x rows) of the x-coordinates of the run-up
+          gauges (point_xz in xboutput.nc, dummy point removed). There
+          should be one gauge per grid row.
+
+    OUTPUT:
+        - colIndeces: 2D integer array (time x rows) of the column index
+          closest to each gauge. Where two columns are equally close, the
+          lower column index is returned.
+    """
+    globalx = np.asarray(globalx, dtype=float)
+    pointx = np.atleast_2d(np.asarray(pointx, dtype=float))
+    nrows, ncols = globalx.shape
+    colIndeces = np.empty(pointx.shape, dtype=np.int64)
+    # Sort each row once. Stable sort so that duplicated x values keep
+    # their lowest column index first
+    order = np.argsort(globalx, axis=1, kind="stable")
+    xSorted = np.take_along_axis(globalx, order, axis=1)
+    for row in np.arange(0, nrows):
+        xs = xSorted[row]
+        # First sorted position of each x value, so that duplicated
+        # x values resolve to their lowest column index
+        firstPos = np.searchsorted(xs, xs, side="left")
+        # Position of every gauge (all times) in the sorted row
+        right = np.searchsorted(xs, pointx[:,row], side="left")
+        right = firstPos[np.clip(right, 0, ncols-1)]
+        left = firstPos[np.clip(right-1, 0, ncols-1)]
+        distLeft = np.abs(pointx[:,row] - xs[left])
+        distRight = np.abs(pointx[:,row] - xs[right])
+        colLeft = order[row][left]
+        colRight = order[row][right]
+        # Pick the closer of the two neighbours, and the lower column
+        # index if they are equally close
+        useLeft = (distLeft < distRight) | ((distLeft == distRight) & (colLeft <= colRight))
+        colIndeces[:,row] = np.where(useLeft, colLeft, colRight)
+    return colIndeces
+
+def intervalMaxima(colIndeces=None, times=None, interval=900):
+    """
+    Reduces a (time x rows) matrix of column indeces to the maximum
+    (i.e. most landward) column index in each row over each output interval.
+    An interval closes at every time that is a multiple of "interval", and
+    includes all of the times since the previous interval closed. Times
+    after the last multiple of "interval" are not assigned to an interval.
+
+    INPUTS:
+        - colIndeces: 2D array (time x rows), e.g. from nearestColIndex
+        - times: 1D array of output times in seconds (e.g. pointtime)
+        - interval: Length of the output interval in seconds (default
+          is 15 minutes)
+
+    OUTPUTS:
+        - exportTimes: 1D array of the times (seconds) closing each interval
+        - maxima: 2D array (intervals x rows) of maximum column indeces
+    """
+    times = np.asarray(times)
+    ends = np.where(times % interval == 0)[0]
+    if len(ends) == 0:
+        return times[ends], np.empty((0, colIndeces.shape[1]), dtype=colIndeces.dtype)
+    starts = np.concatenate([[0], ends[:-1]+1])
+    maxima = np.maximum.reduceat(colIndeces[:ends[-1]+1], starts, axis=0)
+    return times[ends], maxima
+
+def maxGrids(ds=None, zbi=None, maxBlockMB=256, readAhead=True, t0=0, t1=None, maxima=None):
+    """
+    Computes the maximum erosion, flow depth and u/v flow velocities over
+    every "meantime" step of an XBeach output file. The time axis is read
+    in blocks of several timesteps (one netCDF hyperslab read per variable
+    per block), and running maxima are kept in preallocated arrays, so
+    memory use is bounded by maxBlockMB regardless of the length of the
+    run. The results are identical to looping over the timesteps one by
+    one, where for meantime step t:
+        - erosion = zb at globaltime t+1 minus the initial bed (zbi)
+        - flow depth = zs_max at t minus zb at globaltime t+1
+        - velocities = u_max and v_max at t
+    and the maxima start from zero erosion and the first meantime step.
+
+    INPUTS:
+        - ds: xarray dataset of xboutput.nc, opened lazily (xr.open_dataset)
+        - zbi: 2D array of the initial bed elevation (zb when morphology
+          is switched on)
+        - maxBlockMB: rough upper limit on the memory used for each block
+          of timesteps, in MB
+        - readAhead: if True, the next block is read (and decompressed) in
+          a background thread while the current block is being reduced
+        - t0, t1: range of "meantime" steps to reduce (default: all of them).
+          Used to update the maxima as the output file is being written
+          (see incrementalPostProc.py).
+        - maxima: the maxima returned by a previous call, updated in place.
+          If None, the maxima start from zero erosion and the first meantime
+          step.
+
+    OUTPUTS:
+        - maxEro, maxFlowDepth, maxUVel, maxVVel: 2D arrays of the maxima
+    """
+    nt = ds["meantime"].sizes["meantime"] if t1 is None else int(t1)
+    zbi = np.asarray(zbi)
+    if maxima is None:
+        # Initial values, as in the original loop
+        maxEro = zbi - zbi
+        maxFlowDepth = ds["zs_max"].isel({"meantime":0}).values - zbi
+        maxUVel = ds["u_max"].isel({"meantime":0}).values.copy()
+        maxVVel = ds["v_max"].isel({"meantime":0}).values.copy()
+    else:
+        maxEro, maxFlowDepth, maxUVel, maxVVel = maxima
+    # Number of timesteps per block: four variables are read per timestep
+    bytesPerStep = 4*zbi.size*8
+    blockSize = int(max(1, min(nt, (maxBlockMB*1024**2)//max(1, bytesPerStep))))
+
+    def readBlock(t0, t1):
+        # Global time and mean time are not the same: meantime step t goes with
+        # globaltime step t+1
+        return (ds["zb"].isel({"globaltime":slice(t0+1, t1+1)}).values,
+                ds["zs_max"].isel({"meantime":slice(t0, t1)}).values,
+                ds["u_max"].isel({"meantime":slice(t0, t1)}).values,
+                ds["v_max"].isel({"meantime":slice(t0, t1)}).values)
+
+    blocks = [(b0, min(b0+blockSize, nt)) for b0 in range(int(t0), nt, blockSize)]
+    executor = ThreadPoolExecutor(max_workers=1) if readAhead else None
+    try:
+        pending = None
+        if executor is not None and len(blocks) > 0:
+            pending = executor.submit(readBlock, *blocks[0])
+        for i, (t0, t1) in enumerate(blocks):
+            if executor is not None:
+                zb, zsMax, uMax, vMax = pending.result()
+                if i+1 < len(blocks):
+                    pending = executor.submit(readBlock, *blocks[i+1])
+            else:
+                zb, zsMax, uMax, vMax = readBlock(t0, t1)
+            # np.max propagates NaNs in the same way as np.maximum does
+            np.maximum(maxEro, np.max(zb - zbi, axis=0), out=maxEro)
+            np.maximum(maxFlowDepth, np.max(zsMax - zb, axis=0), out=maxFlowDepth)
+            np.maximum(maxUVel, np.max(uMax, axis=0), out=maxUVel)
+            np.maximum(maxVVel, np.max(vMax, axis=0), out=maxVVel)
+            del zb, zsMax, uMax, vMax
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    return maxEro, maxFlowDepth, maxUVel, maxVVel
+
+def scarpColIndex(zbi=None, zb=None, threshold=0.5):
+    """
+    Finds the erosion scarp, i.e. the most landward (highest column index)
+    grid cell where the bed has dropped by more than the threshold, in every
+    row of the XBeach grid and for every timestep at once.
+
+    INPUTS:
+        - zbi: 2D array (rows x columns) of the initial bed elevation
+        - zb: 3D array (time x rows x columns) of the bed elevation
+        - threshold: minimum drop in bed level (m) for a cell to count as
+          eroded
+
+    OUTPUT:
+        - colIndeces: 2D integer array (time x rows) of the column index of
+          the scarp. -1 where no cell in the row is eroded.
+    """
+    # NaNs (e.g. masked cells) never count as eroded
+    eroded = (zbi[None,:,:] - zb) > threshold
+    ncols = eroded.shape[-1]
+    # Position of the last eroded cell in each row, from the first one in the
+    # reversed row
+    colIndeces = ncols - 1 - np.argmax(eroded[:,:,::-1], axis=-1)
+    colIndeces[~eroded.any(axis=-1)] = -1
+    return colIndeces
+
+def scarpColIndeces(ds=None, zbi=None, timesteps=None, threshold=0.5, maxBlockMB=256):
+    """
+    Runs scarpColIndex over the "globaltime" steps of an XBeach output file,
+    reading zb in blocks of timesteps so that memory use is bounded.
+
+    INPUTS:
+        - ds: xarray dataset of xboutput.nc, opened lazily (xr.open_dataset)
+        - zbi: 2D array of the initial bed elevation
+        - timesteps: 1D array of consecutive "globaltime" indeces
+        - threshold: see scarpColIndex
+        - maxBlockMB: rough upper limit on the memory used for each block
+          of timesteps, in MB
+
+    OUTPUT:
+        - colIndeces: 2D integer array (timesteps x rows), see scarpColIndex
+    """
+    timesteps = np.asarray(timesteps, dtype=np.int64)
+    zbi = np.asarray(zbi)
+    colIndeces = np.full((len(timesteps), zbi.shape[0]), -1, dtype=np.int64)
+    # zb, the bed level change and the eroded cells are held for each block
+    bytesPerStep = 3*zbi.size*8
+    blockSize = int(max(1, (maxBlockMB*1024**2)//max(1, bytesPerStep)))
+    for i0 in range(0, len(timesteps), blockSize):
+        i1 = min(i0+blockSize, len(timesteps))
+        zb = ds["zb"].isel({"globaltime":slice(int(timesteps[i0]), int(timesteps[i1-1])+1)}).values
+        colIndeces[i0:i1] = scarpColIndex(zbi=zbi, zb=zb, threshold=threshold)
+    return colIndeces
+
+#====== Per-timestep exports on a pool of worker processes ======#
+# Exporting the outputs of each timestep (e.g. one shapefile per timestep) is
+# independent of every other timestep, so the timesteps are split into blocks of
+# consecutive timesteps that are spread over a pool of worker processes. The data
+# every block needs (grids, dune toes, etc.) is sent to each worker once, when it
+# starts, rather than with every block. Each timestep writes its own files, and
+# the results come back in timestep order, so the outputs are the same whatever
+# the number of workers.
+
+# Data shared by every block, set once in each worker process
+_poolShared = {}
+
+def _initPoolWorker(shared=None):
+    _poolShared.clear()
+    _poolShared.update(shared or {})
+
+def _runBlock(func, block):
+    return func(_poolShared, block)
+
+def mapTimesteps(func=None, nTimesteps=None, shared=None, nWorkers=None, blocksPerWorker=4,
+                 minPerWorker=16):
+    """
+    Runs a per-timestep function over all timesteps, on a pool of worker 
+    processes.
+
+    INPUTS:
+        - func: function taking (shared, tInd), where tInd is an array of
+          consecutive timestep indeces, and returning a list with one result
+          per timestep. Must be defined at the top level of a module (so that
+          the worker processes can import it).
+        - nTimesteps: number of timesteps
+        - shared: dictionary of the data every timestep needs
+        - nWorkers: number of worker processes. None uses every core, 1 runs
+          everything in the current process.
+        - blocksPerWorker: number of blocks of timesteps per worker, so that
+          the work is still spread evenly if some timesteps take longer
+        - minPerWorker: minimum number of timesteps per worker. Starting a
+          worker process takes a couple of seconds (it has to import
+          geopandas etc.), so short runs use fewer workers.
+
+    OUTPUT:
+        - List of the results of every timestep, in timestep order
+    """
+    if nWorkers is None:
+        nWorkers = os.cpu_count() or 1
+    if nTimesteps == 0:
+        return []
+    nWorkers = max(1, min(nWorkers, -(-nTimesteps//minPerWorker)))
+    blocks = np.array_split(np.arange(0, nTimesteps), min(nTimesteps, nWorkers*blocksPerWorker))
+    if nWorkers == 1:
+        results = [func(shared, block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=nWorkers, initializer=_initPoolWorker,
+                                 initargs=(shared,)) as executor:
+            results = list(executor.map(_runBlock, [func]*len(blocks), blocks))
+    return [r for blockResults in results for r in blockResults]
+
+def exportGaugeTimesteps(shared=None, tInd=None):
+    """
+    Exports the extreme water line (points and line) of a block of gauge 
+    output timesteps, see mapTimesteps. Shapefiles are written if
+    shared["writeShp"] is True. Returns the GeoDataFrames for the GeoPackage
+    store if shared["writeStore"] is True (otherwise None), one pair per
+    timestep.
+    """
+    globalx = shared["globalx"]
+    globaly = shared["globaly"]
+    rowIndeces = shared["rowIndeces"]
+    epsg = shared["epsg"]
+    results = []
+    for i in tInd:
+        time = shared["exportTimes"][i]
+        colIndexMax = shared["colIndecesMax"][i]
+        time_str = f'{(time/3600):.2f}'.zfill(6)
+        # Return the x and y locations of the max landward gauge points as shapely points
+        maxWaterLine = [Point(xpt,ypt) for xpt, ypt in zip(globalx[rowIndeces,colIndexMax],
+                                                           globaly[rowIndeces,colIndexMax])]
+        # Export max water line as GeoSeries, convert a line shapefile
+        gdf1 = gpd.GeoSeries(maxWaterLine,crs=epsg)
+        gdf2 = gpd.GeoSeries(LineString(maxWaterLine),crs=epsg)
+        if shared["writeShp"]:
+            gdf1.to_file(os.path.join(shared["gaugesDirPts"],"gauges_%shrs_points.shp" % time_str))
+            gdf2.to_file(os.path.join(shared["gaugesDirLines"],"gauges_%shrs_lines.shp" % time_str))
+        if shared["writeStore"]:
+            time_hrs = round(time/3600, 2)
+            results.append((gpd.GeoDataFrame({"time_hrs":time_hrs, "rowInd":rowIndeces},
+                                             geometry=gdf1.values, crs=epsg),
+                            gpd.GeoDataFrame({"time_hrs":[time_hrs]},
+                                             geometry=gdf2.values, crs=epsg)))
+        else:
+            results.append(None)
+    return results
+
+def exportScarpTimesteps(shared=None, tInd=None):
+    """
+    Exports the erosion scarp (points and line) of a block of spatial output
+    timesteps, see mapTimesteps and exportGaugeTimesteps. Returns the
+    GeoDataFrames for the GeoPackage store, one pair per timestep (None where
+    there is no scarp, or for the line if there is only one scarp point).
+    """
+    df = shared["df"]
+    tstepBounds = shared["tstepBounds"]
+    epsg = shared["epsg"]
+    results = []
+    for i in tInd:
+        timestep = shared["timesteps"][i]
+        # Let the user know how post-processing is progressing
+        if timestep % 10 == 0: 
+            print("Processing time step %s" % timestep)
+        # Convert timestep to appropriate string for saving the files
+        tstep_hrs = shared["tstepsHrs"][i]
+        tstring = f'{tstep_hrs:.2f}'.zfill(6)
+        # Time step's scarp points
+        dftstep = df.iloc[tstepBounds[i]:tstepBounds[i+1]]
+        # Sometimes we won't get a scarp and that's fine
+        if len(dftstep) == 0:
+            results.append((None, None))
+            continue
+        # Export point shapefile for erosion scarp
+        gdf1 = gpd.GeoDataFrame(dftstep, geometry=gpd.points_from_xy(dftstep.xScarp, dftstep.yScarp), crs=epsg)
+        gdf1 = gdf1[["geometry","rowInd"]]
+        if shared["writeShp"]:
+            gdf1.to_file(os.path.join(shared["scarpDirPts"],"scarp_%shrs_points.shp" % tstring))
+        pts = gdf1.assign(time_hrs=round(tstep_hrs, 2)) if shared["writeStore"] else None
+        # You need at least two points to make a line
+        if len(gdf1) < 2:
+            results.append((pts, None))
+            continue
+        # Export line shapefile for erosion scarp 
+        gdf2 = gpd.GeoSeries(LineString(gdf1.geometry.tolist()),crs=epsg)
+        if shared["writeShp"]:
+            gdf2.to_file(os.path.join(shared["scarpDirLines"],"scarp_%shrs.shp" % tstring))
+        line = None
+        if shared["writeStore"]:
+            line = gpd.GeoDataFrame({"time_hrs":[round(tstep_hrs, 2)]}, geometry=gdf2.values, crs=epsg)
+        results.append((pts, line))
+    return results
+
 def search_string_in_file(file_name, string_to_search):
     """Search for the given string in file and return lines containing that string,
     along with line numbers"""
@@ -170,6 +513,73 @@ def XB2csv(x1d=None,y1d=None,arr2d=None,outPath=None):
     df.to_csv(outPath)
 
 
+def writeTimeseriesStore(layers=None, storePath=None, epsg=None):
+    """
+    Writes the per-timestep outputs of a hotspot forecast (e.g. gauges and
+    scarp points/lines) to a single GeoPackage, one layer per output type,
+    instead of one shapefile per timestep. Each layer is keyed by the model
+    time in hours ("time_hrs") and, for points, the row index of the XBeach
+    grid ("rowInd"). An index on these keys is added so that a single
+    timestep can be pulled out of the store without scanning it.
+
+    INPUTS:
+        - layers: dictionary of {layer name: list of GeoDataFrames}. Each
+          GeoDataFrame holds one timestep and must have a "time_hrs" column.
+        - storePath: path of the GeoPackage. Overwritten if it exists.
+        - epsg: projection of the geometries
+
+    OUTPUT:
+        - storePath: path of the GeoPackage that was written
+    """
+    if os.path.exists(storePath):
+        os.remove(storePath)
+    for layer in layers:
+        if len(layers[layer]) == 0:
+            continue
+        gdf = gpd.GeoDataFrame(pd.concat(layers[layer], ignore_index=True),
+                               geometry="geometry", crs=epsg)
+        gdf.to_file(storePath, layer=layer, driver="GPKG")
+    # Index the time (and row) keys of each layer
+    if os.path.exists(storePath):
+        with sqlite3.connect(storePath) as con:
+            for layer in layers:
+                if len(layers[layer]) == 0:
+                    continue
+                keys = ["time_hrs"]
+                if "rowInd" in layers[layer][0].columns:
+                    keys.append("rowInd")
+                con.execute('CREATE INDEX IF NOT EXISTS "idx_%s_time" ON "%s" (%s)'
+                            % (layer, layer, ", ".join(keys)))
+    return storePath
+
+def readTimeseriesStore(storePath=None, layer=None, timeHrs=None):
+    """
+    Reads one layer of a GeoPackage written by writeTimeseriesStore.
+
+    INPUTS:
+        - storePath: path of the GeoPackage
+        - layer: name of the layer to read (e.g. "gauges_points")
+        - timeHrs: model time in hours of the timestep to read. If None,
+          the whole time series is returned.
+
+    OUTPUT:
+        - gdf: GeoDataFrame of the requested timestep(s). Empty if the
+          timestep is not in the store.
+    """
+    if timeHrs is None:
+        return gpd.read_file(storePath, layer=layer)
+    # Times are stored rounded to 2 decimal places (as in the shapefile names)
+    timeHrs = round(float(timeHrs), 2)
+    try:
+        gdf = gpd.read_file(storePath, layer=layer,
+                            where="time_hrs > %s AND time_hrs < %s" % (timeHrs-0.001, timeHrs+0.001))
+    except Exception:
+        # Older versions of geopandas/fiona don't support "where", so
+        # read the whole layer and filter it instead
+        gdf = gpd.read_file(storePath, layer=layer)
+        gdf = gdf[np.isclose(gdf["time_hrs"], timeHrs)]
+    return gdf
+
 def delete_files(path, pattern):
     for f in glob.iglob(os.path.join(path, pattern)):
         try:
@@ -177,6 +587,72 @@ def delete_files(path, pattern):
         except:
             pass
 
+def nearestDistanceXY(srcX=None, srcY=None, tgtX=None, tgtY=None):
+    """
+    Distance from each source point to the nearest target point, found for
+    every source at once with a KD-tree (n log n rather than comparing every
+    source with every target).
+
+    INPUTS:
+        - srcX, srcY: 1D arrays of the coordinates of the points to measure from
+        - tgtX, tgtY: 1D arrays of the coordinates of the points to measure to.
+          NaN coordinates (e.g. rows without a scarp) are left out.
+
+    OUTPUT:
+        - 1D array of distances, one per source point. NaN where the source
+          coordinates are NaN, or if there are no target points.
+    """
+    from scipy.spatial import cKDTree
+    srcX = np.asarray(srcX, dtype=float)
+    srcY = np.asarray(srcY, dtype=float)
+    tgtX = np.asarray(tgtX, dtype=float)
+    tgtY = np.asarray(tgtY, dtype=float)
+    srcValid = ~(np.isnan(srcX) | np.isnan(srcY))
+    tgtValid = ~(np.isnan(tgtX) | np.isnan(tgtY))
+    dist = np.full(len(srcX), np.nan)
+    if srcValid.any() and tgtValid.any():
+        tgtXY = np.column_stack([tgtX[tgtValid], tgtY[tgtValid]])
+        nearest = cKDTree(tgtXY).query(np.column_stack([srcX[srcValid], srcY[srcValid]]), k=1)[1]
+        # Distance to the nearest point worked out the same way as shapely does,
+        # so that distances right on an indicator threshold are classified the same
+        dx = srcX[srcValid] - tgtXY[nearest,0]
+        dy = srcY[srcValid] - tgtXY[nearest,1]
+        dist[srcValid] = np.sqrt(dx*dx + dy*dy)
+    return dist
+
+def nearestDistance(sources=None, targets=None):
+    """
+    Distance from each geometry in sources to the nearest geometry in targets,
+    e.g. from each dune toe to the nearest scarp point (building-scarp distance)
+    or from each corridor point to the nearest extreme water line point (safe
+    corridor width). Gives the same result as
+    sources.apply(lambda g: targets.distance(g).min()), but for points the
+    nearest targets are found with a KD-tree (see nearestDistanceXY).
+
+    INPUTS:
+        - sources: GeoSeries of the geometries to measure from
+        - targets: GeoSeries of the geometries to measure to
+
+    OUTPUT:
+        - Series of distances, with the same index as sources. NaN where the
+          source geometry is missing, or if there are no target geometries.
+    """
+    sources = gpd.GeoSeries(sources)
+    targets = gpd.GeoSeries(targets)
+    srcValid = ~(sources.isna() | sources.is_empty).to_numpy()
+    tgtValid = ~(targets.isna() | targets.is_empty).to_numpy()
+    # Lines/polygons: compare every source with every target
+    if not ((sources[srcValid].geom_type == "Point").all() and (targets[tgtValid].geom_type == "Point").all()):
+        return sources.apply(lambda g: targets.distance(g).min())
+
+    srcX = np.full(len(sources), np.nan)
+    srcY = np.full(len(sources), np.nan)
+    srcX[srcValid] = sources[srcValid].x.to_numpy()
+    srcY[srcValid] = sources[srcValid].y.to_numpy()
+    dist = nearestDistanceXY(srcX=srcX, srcY=srcY,
+                             tgtX=targets[tgtValid].x.to_numpy(), tgtY=targets[tgtValid].y.to_numpy())
+    return pd.Series(dist, index=sources.index)
+
 def compute_scw(ewlDistSeries=None):
     thresholdsSCW = [{"lower": 0, "upper": 5, "level": "High"},
         {"lower": 5, "upper": 10, "level": "Medium"},
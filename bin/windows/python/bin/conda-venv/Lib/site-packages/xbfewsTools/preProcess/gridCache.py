@@ -0,0 +1,108 @@
+import os
+import json
+import numpy as np
+from ..fewsUtils import fewsUtils
+
+#====== Binary cache of the XBeach grids (x.grd, y.grd, z.grd, ne_layer.grd) ======#
+# The XBeach grids are plain text, and parsing them with np.loadtxt/pd.read_csv
+# every time they are needed (gauge locations and wave boundary in
+# preprocessMain.py, and the scripts in Scripts\indicators, Scripts\topobathy and
+# Scripts\visualize) is slow for the larger grids. Instead, the first time a grid
+# is loaded it is parsed once and saved next to it as a binary .npy file:
+#
+#     [grid folder]\x.grd
+#     [grid folder]\x.grd.npy         <- the parsed grid
+#     [grid folder]\x.grd.npy.json    <- size and modification time of x.grd
+#
+# Every later load memory-maps the .npy file, which is near-instant, so long as
+# the size and modification time of the text grid still match the ones recorded
+# in the .json file. If the grid has been changed (or the .npy file is missing),
+# it is parsed and saved again. The files are written to a temporary file and
+# then renamed, so a half-written cache file is never read. If the grid folder
+# can't be written to, the grid is parsed and returned as it is.
+
+# Bump if the format of the cached grids changes
+cacheVersion = 1
+# File names of the grids that make up an XBeach grid set
+gridNames = {"x":"x.grd", "y":"y.grd", "z":"z.grd", "ne_layer":"ne_layer.grd"}
+
+
+def cachePaths(grdFile=None, cacheDir=None):
+    """
+    Returns the paths of the .npy file and its .json file for a grid. By
+    default these are saved next to the grid.
+    """
+    if cacheDir is None:
+        cacheDir = os.path.dirname(os.path.abspath(grdFile))
+    npyFile = os.path.join(cacheDir, os.path.basename(grdFile) + ".npy")
+    return npyFile, npyFile + ".json"
+
+
+def _sourceInfo(grdFile=None):
+    # What the cached grid is checked against
+    st = os.stat(grdFile)
+    return {"version":cacheVersion, "size":st.st_size, "mtime_ns":st.st_mtime_ns}
+
+
+def _isValid(npyFile=None, metaFile=None, info=None):
+    # True if the cached grid was made from the text grid as it is now
+    if not (os.path.exists(npyFile) and os.path.exists(metaFile)):
+        return False
+    try:
+        with open(metaFile) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return all(meta.get(k) == v for k, v in info.items())
+
+
+def _writeCache(arr=None, npyFile=None, metaFile=None, info=None):
+    # The .npy file is written first, so the .json file only ever points to a
+    # complete grid
+    for ofile, write in ((npyFile, lambda f: np.save(f, arr)),
+                         (metaFile, lambda f: f.write(json.dumps(info).encode()))):
+        with fewsUtils.atomicWrite(ofile, "wb") as f:
+            write(f)
+
+
+def loadGrid(grdFile=None, cacheDir=None, mmap=True):
+    """
+    Loads an XBeach grid (e.g. x.grd), from its binary cache if it is up to date.
+
+    INPUTS:
+        - grdFile: path to the text grid
+        - cacheDir: folder the cache files are saved in. Defaults to the folder
+          the grid is in.
+        - mmap: if True, the cached grid is memory-mapped (read-only) rather than
+          read into memory
+
+    OUTPUTS:
+        - 2D numpy array (rows, columns), the same as np.loadtxt(grdFile)
+    """
+    npyFile, metaFile = cachePaths(grdFile=grdFile, cacheDir=cacheDir)
+    # Checked before the grid is parsed, so that a grid changed part of the way
+    # through is parsed again next time
+    info = _sourceInfo(grdFile)
+    if not _isValid(npyFile=npyFile, metaFile=metaFile, info=info):
+        arr = np.loadtxt(grdFile, ndmin=2)
+        try:
+            _writeCache(arr=arr, npyFile=npyFile, metaFile=metaFile, info=info)
+        except OSError:
+            return arr
+    return np.load(npyFile, mmap_mode="r" if mmap else None)
+
+
+def loadGridBundle(gridDir=None, names=("x","y","z","ne_layer"), cacheDir=None, mmap=True):
+    """
+    Loads several grids of an XBeach grid set (see loadGrid).
+
+    INPUTS:
+        - gridDir: folder containing the grids
+        - names: which grids to load, keys of gridNames
+        - cacheDir, mmap: see loadGrid
+
+    OUTPUTS:
+        - Dictionary of 2D numpy arrays, keyed by name
+    """
+    return {name: loadGrid(grdFile=os.path.join(gridDir, gridNames[name]),
+                           cacheDir=cacheDir, mmap=mmap) for name in names}
@@ -0,0 +1,293 @@
+import functools
+import numpy as np
+import pandas as pd
+
+#====== Harmonic tide predictions ======#
+# Predicts astronomical tides at a station from its harmonic constituents, so
+# that tide predictions can be generated for any time vector (e.g. exactly the
+# forecast window at the forecast time step), instead of being read from large
+# precomputed csv files. The predicted tide is:
+#
+#     h(t) = Z0 + sum( f * A * cos(V(t) + u - G) )
+#
+# where, for each constituent, A is the amplitude, G the Greenwich phase lag
+# (i.e. phases relative to GMT/UTC), V the equilibrium argument, and f and u the
+# nodal corrections. The equilibrium arguments and nodal corrections follow
+# Schureman (1958), "Manual of Harmonic Analysis and Prediction of Tides",
+# US Coast and Geodetic Survey Special Publication 98. As is standard practice,
+# the nodal corrections are evaluated once per year (at the middle of the year)
+# and cached.
+#
+# Constituent files are csv files with the columns "constituent", "amplitude_m"
+# and "phase_deg", e.g.:
+#     constituent,amplitude_m,phase_deg
+#     Z0,0.000,0.0
+#     M2,0.051,259.3
+#     K1,0.162,292.8
+#     ...
+# The optional "Z0" row gives the mean water level above the datum of the
+# predictions (its phase is ignored). A constituent file can be made from a
+# series of tide predictions with fitConstituents (see
+# Scripts\waterLevs\fitTideConstituents.py).
+
+# Epoch the astronomical arguments are computed from: J2000 (2000-01-01 12:00 GMT)
+j2000 = np.datetime64("2000-01-01T12:00:00", "ns")
+
+# Rates of change of the astronomical arguments (tau, s, h, p, N, p1) in
+# degrees/hour, from the rates per Julian century in astronomicalArguments
+# (a Julian century is 876600 hours)
+argumentRates = np.array([15. - 481267.8813/876600. + 36000.7698/876600.,
+                          481267.8813/876600., 36000.7698/876600., 4069.0137/876600.,
+                          -1934.1363/876600., 1.7195/876600.])
+
+# Equilibrium arguments of each constituent, as multiples of the astronomical
+# arguments (tau, s, h, p, N, p1) plus a phase offset in degrees:
+#     tau: mean lunar time          s: mean longitude of the moon
+#     h: mean longitude of the sun  p: longitude of the moon's perigee
+#     N: longitude of the moon's ascending node
+#     p1: longitude of the sun's perigee
+# Also the nodal correction formula used for each constituent (see nodalFactors)
+constituentTable = {
+    #             tau   s   h   p   N  p1  offset  nodal
+    "SA":       ( 0,   0,  1,  0,  0,  0,    0.,   None),
+    "SSA":      ( 0,   0,  2,  0,  0,  0,    0.,   None),
+    "MM":       ( 0,   1,  0, -1,  0,  0,    0.,   "MM"),
+    "MF":       ( 0,   2,  0,  0,  0,  0,    0.,   "MF"),
+    "2Q1":      ( 1,  -3,  0,  2,  0,  0,   90.,   "O1"),
+    "Q1":       ( 1,  -2,  0,  1,  0,  0,   90.,   "O1"),
+    "RHO1":     ( 1,  -2,  2, -1,  0,  0,   90.,   "O1"),
+    "O1":       ( 1,  -1,  0,  0,  0,  0,   90.,   "O1"),
+    "P1":       ( 1,   1, -2,  0,  0,  0,   90.,   None),
+    "S1":       ( 1,   1, -1,  0,  0,  0,    0.,   None),
+    "K1":       ( 1,   1,  0,  0,  0,  0,  -90.,   "K1"),
+    "J1":       ( 1,   2,  0, -1,  0,  0,  -90.,   "J1"),
+    "OO1":      ( 1,   3,  0,  0,  0,  0,  -90.,   "OO1"),
+    "2N2":      ( 2,  -2,  0,  2,  0,  0,    0.,   "M2"),
+    "MU2":      ( 2,  -2,  2,  0,  0,  0,    0.,   "M2"),
+    "N2":       ( 2,  -1,  0,  1,  0,  0,    0.,   "M2"),
+    "NU2":      ( 2,  -1,  2, -1,  0,  0,    0.,   "M2"),
+    "M2":       ( 2,   0,  0,  0,  0,  0,    0.,   "M2"),
+    "LAMBDA2":  ( 2,   1, -2,  1,  0,  0,  180.,   "M2"),
+    "L2":       ( 2,   1,  0, -1,  0,  0,  180.,   "M2"),
+    "T2":       ( 2,   2, -3,  0,  0,  1,    0.,   None),
+    "S2":       ( 2,   2, -2,  0,  0,  0,    0.,   None),
+    "R2":       ( 2,   2, -1,  0,  0, -1,  180.,   None),
+    "K2":       ( 2,   2,  0,  0,  0,  0,    0.,   "K2"),
+    "M3":       ( 3,   0,  0,  0,  0,  0,    0.,   "M3"),
+    "MN4":      ( 4,  -1,  0,  1,  0,  0,    0.,   "M2^2"),
+    "M4":       ( 4,   0,  0,  0,  0,  0,    0.,   "M2^2"),
+    "MS4":      ( 4,   2, -2,  0,  0,  0,    0.,   "M2"),
+    "S4":       ( 4,   4, -4,  0,  0,  0,    0.,   None),
+    "M6":       ( 6,   0,  0,  0,  0,  0,    0.,   "M2^3"),
+}
+
+
+def astronomicalArguments(times=None):
+    """
+    Computes the astronomical arguments (tau, s, h, p, N, p1), in degrees, for
+    a vector of times.
+
+    INPUTS:
+        - times: numpy datetime64 array (or anything pd.to_datetime accepts),
+          in GMT/UTC
+
+    OUTPUTS:
+        - (6, n) numpy array of the arguments tau, s, h, p, N and p1
+    """
+    times = np.asarray(pd.to_datetime(times).values, dtype="datetime64[ns]")
+    # Days and Julian centuries since J2000
+    d = (times - j2000).astype(np.float64)/86400e9
+    T = d/36525.
+    s = 218.3165 + 481267.8813*T
+    h = 280.4661 + 36000.7698*T
+    p = 83.3535 + 4069.0137*T
+    N = 125.0445 - 1934.1363*T
+    p1 = 282.9384 + 1.7195*T
+    # Hour angle of the mean sun (180 degrees at midnight GMT), then mean lunar time
+    hourAngle = 360.*d
+    tau = hourAngle - s + h
+    return np.mod(np.vstack((tau, s, h, p, N, p1)), 360.)
+
+
+def _nodalCorrection(formula=None, N=None):
+    # Nodal factor f and nodal angle u (degrees) for a longitude of the moon's
+    # node N (radians), Schureman (1958) Table 14 approximations
+    if formula is None:
+        return 1., 0.
+    if formula == "MM":
+        return 1.000 - 0.130*np.cos(N), 0.
+    if formula == "MF":
+        return (1.043 + 0.414*np.cos(N),
+                -23.7*np.sin(N) + 2.7*np.sin(2*N) - 0.4*np.sin(3*N))
+    if formula == "O1":
+        return (1.009 + 0.187*np.cos(N) - 0.015*np.cos(2*N),
+                10.8*np.sin(N) - 1.3*np.sin(2*N) + 0.2*np.sin(3*N))
+    if formula == "K1":
+        return (1.006 + 0.115*np.cos(N) - 0.009*np.cos(2*N),
+                -8.9*np.sin(N) + 0.7*np.sin(2*N))
+    if formula == "J1":
+        return 1.013 + 0.168*np.cos(N) - 0.017*np.cos(2*N), -12.9*np.sin(N) + 1.3*np.sin(2*N)
+    if formula == "OO1":
+        return 1.027 + 0.504*np.cos(N) + 0.134*np.cos(2*N), -36.68*np.sin(N) + 4.02*np.sin(2*N)
+    if formula == "K2":
+        return (1.024 + 0.286*np.cos(N) + 0.008*np.cos(2*N),
+                -17.7*np.sin(N) + 0.7*np.sin(2*N))
+    # M2 and the constituents derived from it
+    fM2, uM2 = 1.000 - 0.037*np.cos(N), -2.1*np.sin(N)
+    if formula == "M2":
+        return fM2, uM2
+    if formula == "M3":
+        return fM2**1.5, 1.5*uM2
+    if formula == "M2^2":
+        return fM2**2, 2*uM2
+    if formula == "M2^3":
+        return fM2**3, 3*uM2
+    raise ValueError("Unknown nodal correction: %s" % formula)
+
+
+@functools.lru_cache(maxsize=None)
+def nodalFactors(year=None, constituents=None):
+    """
+    Nodal factors f and nodal angles u (degrees) of the given constituents for
+    a year. Evaluated at the middle of the year (2 July), and cached, so that
+    they are only computed once per year and set of constituents.
+
+    INPUTS:
+        - year: year (int)
+        - constituents: tuple of constituent names (e.g. ("M2","S2","K1"))
+
+    OUTPUTS:
+        - f, u: numpy arrays, one value per constituent
+    """
+    midYear = np.array([np.datetime64("%04d-07-02T00:00:00" % year, "ns")])
+    N = np.radians(astronomicalArguments(midYear)[4, 0])
+    fu = np.array([_nodalCorrection(formula=constituentTable[c][7], N=N) for c in constituents],
+                  dtype=np.float64)
+    return fu[:,0], fu[:,1]
+
+
+class tideStation:
+
+    def __init__(self, constituents=None, amplitudes=None, phases=None, z0=0.):
+        # Constituent names, amplitudes (m) and Greenwich phase lags (degrees)
+        self.constituents = tuple(c.upper() for c in constituents)
+        for c in self.constituents:
+            if c not in constituentTable:
+                raise ValueError("Constituent %s is not supported. Supported "
+                                 "constituents: %s" % (c, ", ".join(constituentTable)))
+        self.amplitudes = np.asarray(amplitudes, dtype=np.float64)
+        self.phases = np.asarray(phases, dtype=np.float64)
+        # Mean water level above the datum of the predictions (m)
+        self.z0 = float(z0)
+        # Doodson numbers (n, 6) and phase offsets (n,) of the constituents
+        self._doodson = np.array([constituentTable[c][:6] for c in self.constituents],
+                                 dtype=np.float64).reshape(-1, 6)
+        self._offsets = np.array([constituentTable[c][6] for c in self.constituents],
+                                 dtype=np.float64)
+
+    def speeds(self):
+        """
+        Returns the speeds of the constituents (degrees/hour), as a numpy array.
+        """
+        return self._doodson @ argumentRates
+
+    def _arguments(self, times=None):
+        # Nodal factors f and arguments V + u (degrees) of the constituents at
+        # each time, both (n constituents, n times)
+        # Equilibrium arguments
+        V = self._doodson @ astronomicalArguments(times) + self._offsets[:,None]
+        # Nodal corrections for each year covered by the times
+        years = times.astype("datetime64[Y]").astype(int) + 1970
+        f = np.empty(V.shape)
+        u = np.empty(V.shape)
+        for year in np.unique(years):
+            inYear = years == year
+            fYear, uYear = nodalFactors(year=int(year), constituents=self.constituents)
+            f[:,inYear] = fYear[:,None]
+            u[:,inYear] = uYear[:,None]
+        return f, V + u
+
+    def predict(self, times=None):
+        """
+        Predicts the tide (m) at a vector of times (GMT/UTC). Returns a numpy
+        array the same length as times.
+        """
+        times = np.asarray(pd.to_datetime(times).values, dtype="datetime64[ns]")
+        if times.size == 0 or len(self.constituents) == 0:
+            return np.full(times.shape, self.z0)
+        f, arg = self._arguments(times)
+        arg = np.radians(arg - self.phases[:,None])
+        return self.z0 + np.sum(f*self.amplitudes[:,None]*np.cos(arg), axis=0)
+
+
+def loadConstituents(ifile=None):
+    """
+    Loads the harmonic constituents of a station from a csv file (see the
+    format at the top of this module). Returns a tideStation instance.
+    """
+    dfc = pd.read_csv(ifile, skipinitialspace=True)
+    dfc['constituent'] = dfc['constituent'].astype(str).str.strip().str.upper()
+    isZ0 = dfc['constituent'] == "Z0"
+    z0 = dfc.loc[isZ0, 'amplitude_m'].sum()
+    dfc = dfc[~isZ0]
+    return tideStation(constituents=dfc['constituent'].tolist(),
+                       amplitudes=dfc['amplitude_m'].values,
+                       phases=dfc['phase_deg'].values, z0=z0)
+
+
+def saveConstituents(station=None, ofile=None):
+    """
+    Saves the harmonic constituents of a station (tideStation instance) to a
+    csv file that loadConstituents reads.
+    """
+    dfc = pd.DataFrame({"constituent":("Z0",) + station.constituents,
+                        "amplitude_m":np.concatenate(([station.z0], station.amplitudes)),
+                        "phase_deg":np.concatenate(([0.], station.phases))})
+    dfc.to_csv(ofile, index=False, float_format="%.4f")
+    return ofile
+
+
+def fitConstituents(times=None, heights=None, constituents=None):
+    """
+    Harmonic analysis: fits the amplitudes and phases of a set of constituents
+    (and Z0) to a series of water levels by least squares, using the same
+    equilibrium arguments and nodal corrections as tideStation.predict. 
+    Constituents that can't be separated from one listed before them over the
+    length of the series (the Rayleigh criterion, i.e. their speeds differ by
+    less than one cycle over the series) are left out.
+
+    INPUTS:
+        - times: numpy datetime64 array (or anything pd.to_datetime accepts),
+          in GMT/UTC
+        - heights: water levels (m) at the times, e.g. tide predictions
+        - constituents: names of the constituents to fit, most important
+          first. Defaults to all of the constituents in constituentTable.
+
+    OUTPUTS:
+        - tideStation instance
+    """
+    times = np.asarray(pd.to_datetime(times).values, dtype="datetime64[ns]")
+    heights = np.asarray(heights, dtype=np.float64)
+    if constituents is None:
+        constituents = list(constituentTable)
+    # Rayleigh criterion
+    spanHours = (times.max() - times.min()).astype(np.float64)/3600e9
+    speeds = tideStation(constituents=constituents, amplitudes=np.zeros(len(constituents)),
+                         phases=np.zeros(len(constituents))).speeds()
+    keep = []
+    for i in range(len(constituents)):
+        if abs(speeds[i])*spanHours >= 360. and all(abs(speeds[i]-speeds[j])*spanHours >= 360. for j in keep):
+            keep.append(i)
+    constituents = [constituents[i] for i in keep]
+    station = tideStation(constituents=constituents, amplitudes=np.zeros(len(constituents)),
+                          phases=np.zeros(len(constituents)))
+    # h = Z0 + sum( f*a*cos(V+u) + f*b*sin(V+u) ), where a = A*cos(G), b = A*sin(G)
+    f, arg = station._arguments(times)
+    arg = np.radians(arg)
+    design = np.hstack((np.ones((times.size, 1)), (f*np.cos(arg)).T, (f*np.sin(arg)).T))
+    coefs = np.linalg.lstsq(design, heights, rcond=None)[0]
+    a, b = coefs[1:len(constituents)+1], coefs[len(constituents)+1:]
+    station.z0 = float(coefs[0])
+    station.amplitudes = np.hypot(a, b)
+    station.phases = np.mod(np.degrees(np.arctan2(b, a)), 360.)
+    return station
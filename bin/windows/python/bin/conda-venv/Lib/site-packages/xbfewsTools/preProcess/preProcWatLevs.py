@@ -5,6 +5,9 @@ import geopandas as gpd
 import pytz
 import xarray as xr
 from datetime import datetime, timedelta
+from . import spatialIndex
+from . import harmonicTides
+from ..fewsUtils import fewsUtils
 
 #============== Generate time series - GMT ==============#
 def generateTimeSeries(forecast=None):
@@ -39,7 +42,9 @@ def loadTideData(ifile=None, forecast=None):
 
     """
     Loads the tide predictions from an input file using attributes from a
-    forecast object.
+    forecast object. If the tide predictions have been converted to a binary
+    tide store (see convertTideData), and the store is up to date with the
+    input file, the store is used instead of parsing the csv file.
 
     INPUTS:
         - ifile: Input file containing tide predictions 
@@ -51,15 +56,112 @@ def loadTideData(ifile=None, forecast=None):
     interval. 
     """
 
+    #============== Use binary tide store if available ==============#
+    timesFile, valuesFile = tideStorePaths(ifile=ifile)
+    if (os.path.exists(timesFile) and os.path.exists(valuesFile) and
+            (not os.path.exists(ifile) or os.path.getmtime(timesFile) >= os.path.getmtime(ifile))):
+        return loadTideStore(ifile=ifile, forecast=forecast)
+
     #============== Load tide data - MUST BE IN GMT ==============#
+    dft = readTideCSV(ifile=ifile)
+    # Slice and dice the df
+    dft = dft[(dft.index >= forecast.startTime) & (dft.index <= forecast.endTime)]
+
+    return dft
+
+def readTideCSV(ifile=None):
+
+    """
+    Reads a whole csv file of tide predictions (in GMT), with the date/time
+    in the format DD-MM-YYYY HH:MM. Returns a dataframe.
+    """
+
     # Load tide predictions as a dataframe
     dft = pd.read_csv(ifile, names=['datetime_gmt','tide_m'], header=0)
     # Set datetime as index in dataframe
     dft['datetime_gmt'] = pd.to_datetime(dft['datetime_gmt'], format="%d-%m-%Y %H:%M", utc=True)
     dft.index=dft['datetime_gmt']
     dft = dft.drop(columns=['datetime_gmt'])
-    # Slice and dice the df
-    dft = dft[(dft.index >= forecast.startTime) & (dft.index <= forecast.endTime)]
+
+    return dft
+
+def tideStorePaths(ifile=None):
+
+    """
+    Returns the paths of the binary tide store that goes with a csv file of 
+    tide predictions: [name]_times.npy (times, int64 nanoseconds since 
+    1970-01-01 GMT) and [name]_values.npy (tide levels in m, float64).
+    """
+
+    stem = os.path.splitext(ifile)[0]
+    return "%s_times.npy" % stem, "%s_values.npy" % stem
+
+def convertTideData(ifile=None):
+
+    """
+    One-time conversion of a csv file of tide predictions to a binary tide
+    store, written next to the csv file (see tideStorePaths). The store
+    is sorted by time so that it can be sliced with a binary search. 
+    Tide levels are kept as float64 so that they are identical to the 
+    values in the csv file.
+
+    Returns the paths of the two files in the store.
+    """
+
+    dft = readTideCSV(ifile=ifile).sort_index(kind="mergesort")
+    times = dft.index.tz_convert(pytz.utc).tz_localize(None).values.astype("datetime64[ns]").astype(np.int64)
+    values = dft['tide_m'].to_numpy(dtype=np.float64)
+    for ofile, arr in zip(tideStorePaths(ifile=ifile), [times, values]):
+        with fewsUtils.atomicWrite(ofile, "wb") as f:
+            np.save(f, arr)
+
+    return tideStorePaths(ifile=ifile)
+
+def loadTideStore(ifile=None, forecast=None):
+
+    """
+    Loads the tide predictions over the forecast interval from the binary tide
+    store that goes with a csv file (see convertTideData). The store is 
+    memory-mapped and only the forecast interval is read. Returns the same 
+    dataframe as loadTideData does from the csv file.
+    """
+
+    timesFile, valuesFile = tideStorePaths(ifile=ifile)
+    times = np.load(timesFile, mmap_mode="r")
+    values = np.load(valuesFile, mmap_mode="r")
+    # Start/end of the forecast interval in nanoseconds since 1970-01-01 GMT
+    startTime = pd.Timestamp(forecast.startTime).value
+    endTime = pd.Timestamp(forecast.endTime).value
+    i0 = np.searchsorted(times, startTime, side="left")
+    i1 = np.searchsorted(times, endTime, side="right")
+    index = pd.to_datetime(np.array(times[i0:i1]), utc=True)
+    index.name = 'datetime_gmt'
+    dft = pd.DataFrame({'tide_m':np.array(values[i0:i1])}, index=index)
+
+    return dft
+
+def predictTideData(ifile=None, forecast=None):
+
+    """
+    Predicts the astronomical tides over the forecast interval from the 
+    harmonic constituents of a station (see harmonicTides.py), at exactly
+    the forecast time step. Unlike loadTideData, no tide predictions are
+    read from file and no interpolation is needed afterwards.
+
+    INPUTS:
+        - ifile: csv file containing the harmonic constituents of the 
+          station, e.g. [city]Constituents.csv
+        - forecast: Forecast object. Forecast objects typically set in 
+          initializeForecast.py or initializeHotspot.py. Attributes given 
+          in fewsForecast.py.
+
+    Returns a dataframe containing tide predictions (column tide_m) for the 
+    forecast interval, with the same index as generateTimeSeries.
+    """
+
+    station = harmonicTides.loadConstituents(ifile=ifile)
+    dft = generateTimeSeries(forecast=forecast)
+    dft['tide_m'] = station.predict(times=dft.index.tz_convert(pytz.utc).tz_localize(None))
 
     return dft
 
@@ -100,8 +202,88 @@ def loadSurgeData(surgePath=None, forecast=None):
     return dfs
 
 
+#============== Subset of the NSS forecast ==============#
+def nssSubsetPath(ifile=None, subsetDir=None):
+
+    """
+    Path of the subset of an NSS forecast file (see subsetNSS): the same
+    file name with "_subset" added, in subsetDir (defaults to the folder
+    of the NSS file).
+    """
+
+    if subsetDir is None:
+        subsetDir = os.path.dirname(ifile)
+    fname = os.path.splitext(os.path.basename(ifile))[0] + "_subset.nc"
+    return os.path.join(subsetDir, fname)
+
+
+def subsetNSS(ifile=None, ofile=None, lon=None, lat=None, cacheDir=None):
+
+    """
+    The BoM National Storm Surge (NSS) forecast covers the whole Australian
+    coastline, whereas each hotspot only needs one point, and each region a
+    few hundred. This extracts the points on the NSS mesh closest to the 
+    given lat/lon points into a small netCDF file, so that the forecast 
+    only has to be read and searched once, when it is downloaded (see 
+    retrieveNSS.py in the NSSDownload module). The subset keeps the same
+    variables and "point"/"time" dimensions as the NSS file, plus:
+        - source_point: index of each point on the full NSS mesh
+        - query_lon, query_lat: the lat/lon points the subset was made for,
+          so that openNSS can tell whether a point is in the subset
+
+    INPUTS:
+        - ifile: path to the NSS forecast netCDF file
+        - ofile: path of the subset file. Defaults to nssSubsetPath(ifile).
+        - lon, lat: lists/arrays of the longitudes and latitudes of the 
+          points of interest
+        - cacheDir: directory where the index for the NSS mesh is cached 
+          (see nssPointIndeces)
+
+    OUTPUT:
+        - ofile
+    """
+
+    if ofile is None:
+        ofile = nssSubsetPath(ifile)
+    return spatialIndex.subsetMesh(ifile=ifile, ofile=ofile, lon=lon, lat=lat, dim="point",
+                                   indexFunc=_nssIndexFunc(cacheDir))
+
+
+def openNSS(ifile=None, lon=None, lat=None, subsetDir=None, create=False, cacheDir=None):
+
+    """
+    Opens an NSS forecast file, reading the subset made when it was 
+    downloaded (see subsetNSS) instead of the full file if the subset
+    was made for all of the given lat/lon points.
+
+    INPUTS:
+        - ifile: path to the full NSS forecast netCDF file
+        - lon, lat: lists/arrays of the longitudes and latitudes of the 
+          points that are going to be extracted
+        - subsetDir: folder of the subset (see nssSubsetPath)
+        - create: if True and there is no suitable subset, a subset is made
+          for the given points (e.g. when going through archived forecasts
+          more than once)
+        - cacheDir: directory where the index for the NSS mesh is cached 
+          (see nssPointIndeces). Only used for the full file.
+
+    OUTPUT:
+        - ds: xarray dataset
+        - isSubset: True if ds is the subset
+    """
+
+    return spatialIndex.openSubset(ifile=ifile, subsetFile=nssSubsetPath(ifile, subsetDir=subsetDir),
+                                   lon=lon, lat=lat, dim="point",
+                                   indexFunc=_nssIndexFunc(cacheDir), create=create)
+
+
+def _nssIndexFunc(cacheDir=None):
+    # Nearest point look-up used for the subsets (see spatialIndex.subsetMesh)
+    return lambda ds, lon, lat: nssPointIndeces(ds=ds, lon=lon, lat=lat, cacheDir=cacheDir)
+
+
 #======================== Process surge data ========================#
-def processNSS_nc(forecast=None, nssDir=None, fname=None):
+def processNSS_nc(forecast=None, nssDir=None, fname=None, cacheDir=None):
 
     """
     Extracts storm surge signal from BoM National Storm Surge (NSS) 
@@ -111,7 +293,9 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
     forecast.lonSurge and forecast.latSurge. This point is determined
     manually as the most appropriate point for extracting the surge
     signal at a given hotspot location. The point lat/lon is set in 
-    hotspotLocations.csv. 
+    hotspotLocations.csv. If the subset of the netCDF file made when it
+    was downloaded has the point, the subset is read instead (see
+    openNSS).
 
     INPUTS:
         - forecast: hotspotForecast object. Should have lonSurge and
@@ -119,6 +303,8 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
           set file. 
         - nssDir: Directory of the NSS file download
         - fname: The name of the netCDF file. 
+        - cacheDir: Directory where the point index for the NSS mesh is
+          cached (see nssPointIndeces). If None, the index is built in memory.
 
     OUTPUT:
         - dfOut: The storm surge time series, including any desired spin-up
@@ -126,17 +312,20 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
           3 days
 
 
-    Note: this funciton could potentially throw errors if the lat/lon
-    given in hotspotLocations.csv doesn't match a lat/lon given on
-    the NSS mesh. If that's the case, extract the index of the point
-    that is closest to the point listed in hotspotLocations.csv.
+    Note: the point on the NSS mesh closest to the lat/lon given in 
+    hotspotLocations.csv is used, so the lat/lon doesn't have to match
+    a point on the mesh exactly (e.g. if the BoM mesh changes).
     """
         
     # =================== Paths =================== #
     ifile = os.path.join(nssDir,fname)
 
-    # Load dataset
-    ds = xr.open_dataset(ifile)
+    # Load dataset. Reads the subset made when the file was downloaded, if it
+    # has this point (see subsetNSS)
+    ds, isSubset = openNSS(ifile=ifile, lon=[forecast.lonSurge], lat=[forecast.latSurge])
+    # The subset only has a few points, so its index isn't worth caching
+    if isSubset:
+        cacheDir = None
 
     #print(ds.keys)
     # ds.keys will reveal that the NetCDF file does not have lat/lon dimensions - it has a "point" and "time" dimensions
@@ -145,12 +334,9 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
     # This is because this is not a regular grid; each point has a unique lat, lon value
     # The following will return the index that matches the lat/lon point of interest
     # This index allows for selection of subsets of the xarray dataset (the loaded netCDF)
-    df = pd.DataFrame({"lon":ds.coords['lon'].values,"lat":ds.coords['lat'].values})
-    # Return index of the point that matches the lat/lon point. If this doesn't work, 
-    # try a function that returns the closest point. Methods for this are given in 
-    # preprocessMainRegional.py
-    ind = df[(df['lon']==forecast.lonSurge) & 
-            (df['lat']==forecast.latSurge)].index
+    # Return index of the point that matches (or is closest to) the lat/lon point.
+    ind = nssPointIndeces(ds=ds, lon=[forecast.lonSurge], lat=[forecast.latSurge], 
+                          cacheDir=cacheDir)
 
     # Select surge timeseries for the point of interest
     surge = ds.surge[ind].values
@@ -159,6 +345,7 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
     dfOut = pd.DataFrame({"Datetime_gmt":ds.coords['time'].values,
                     "surge (m)":surge[0]
                     })
+    ds.close()
 
     # Add 12-hour spin-up timeseries that retains the first value
     # of the surge forecast
@@ -223,49 +410,73 @@ def processNSS_nc(forecast=None, nssDir=None, fname=None):
     return dfOut
 
 
-#============== Extract surge data ==============#
-def extractNSS(forecast=None, ds=None, nss_lat=None, nss_lon=None):
+#============== Find points on the NSS mesh ==============#
+def nssPointIndeces(ds=None, lon=None, lat=None, cacheDir=None):
 
     """
-    Extracts the surge forecast from the NSS output from the BoM.
-    The point you want to extract needs to be precisely known
-    (see nearGeom function in preProcWaves - this can provide
-    the precise nearest point on the mesh).
+    Returns the indeces of the points on the BoM National Storm Surge (NSS)
+    mesh that are closest to the given lat/lon points, i.e. the indeces
+    along the "point" dimension of the NSS netCDF file. Points that are on
+    the mesh return their own index. 
+
+    Inputs:
+    ds: xarray dataset containing the netCDF storm surge output.
+    lon, lat: lists/arrays of the longitudes and latitudes of the points
+      of interest.
+    cacheDir: directory where the index for the NSS mesh is saved, so that
+      it is only built once for a given mesh (see spatialIndex.py). This is 
+      normally [Region Home]/Modules/NSSDownload/meshIndex. If None, the
+      index is built in memory.
+
+    Output:
+    Numpy array of point indeces, one for each lat/lon point.
+    """
+
+    return spatialIndex.nearestNodes(lon=ds.coords['lon'].values,
+                                     lat=ds.coords['lat'].values,
+                                     queryLon=lon, queryLat=lat,
+                                     cacheDir=cacheDir, name="nss")
+
+
+#============== Extract surge data at several points ==============#
+def extractNSSPoints(forecast=None, ds=None, pointIndeces=None, columns=None):
+
+    """
+    Extracts the surge forecast from the NSS output from the BoM at 
+    several points at once.
 
     Inputs:
     forecast: FEWS forecast object, can be a hotspot or regional
       forecast. Defined in initializeRegional.py, initializeHotpsot.py,
       class structure is provided in fewsForecast.py
     ds: xarray dataset containing the netCDF storm surge output.
-    nss_lat: latitude of the point of interest where NSS surge forecast
-      will be extracted from.
-    nss_lon: ditto but for the longitude of the point
+    pointIndeces: indeces of the points on the NSS mesh to extract 
+      (see nssPointIndeces).
+    columns: names of the columns in the output dataframe, one for 
+      each point. Defaults to the point indeces. 
 
     Output:
-    Returns a dataframe with the surge forecast time series at the
-    given point. 
+    Returns a dataframe with the surge forecast time series (in m) for each
+    point, one column per point.
     """
 
-    # Select dataset by point of interest
-    ds = ds[['surge']]
-    ds = ds.where(ds.lat==nss_lat, drop=True)
-    ds = ds.where(ds.lon==nss_lon, drop=True)
-    
-    # Select surge timeseries for the point of interest
-    surge = ds.surge.values[0]
+    pointIndeces = np.asarray(pointIndeces, dtype=np.int64)
+    if columns is None:
+        columns = pointIndeces
+
+    # Select surge timeseries for all of the points of interest in one go
+    surge = ds['surge'].isel(point=pointIndeces).transpose('time','point').values
 
     # Create new pandas df
-    dfOut = pd.DataFrame({"Datetime_gmt":ds.coords['time'].values,
-                    "surge (m)":surge
-                    })
+    dfOut = pd.DataFrame(surge, columns=columns,
+                         index=pd.Index(ds.coords['time'].values, name="Datetime_gmt"))
 
     # Time parameters
-    dt_delta = dfOut.Datetime_gmt[1]-dfOut.Datetime_gmt[0]
-    surgeStartTime = dfOut.Datetime_gmt[0]
-    surgeEndTime = dfOut.Datetime_gmt.iloc[-1]
+    dt_delta = dfOut.index[1]-dfOut.index[0]
+    surgeStartTime = dfOut.index[0]
+    surgeEndTime = dfOut.index[-1]
 
     # Set timezone info
-    dfOut = dfOut.set_index("Datetime_gmt")
     dfOut = dfOut.tz_localize(pytz.utc)
 
 
@@ -282,11 +493,101 @@ def extractNSS(forecast=None, ds=None, nss_lat=None, nss_lon=None):
         extendedSeries = pd.date_range(start=extendedTSStartTime,
                             end=extendedTSEndTime,
                             freq=dt_delta)
-        extended_df = pd.DataFrame({"Datetime_gmt":extendedSeries,
-                            "surge (m)":0
-                            }).set_index("Datetime_gmt")
+        extended_df = pd.DataFrame(0, columns=dfOut.columns,
+                                   index=pd.Index(extendedSeries, name="Datetime_gmt"))
         # Concatenate this to the water level series df
         dfOut = pd.concat([dfOut,extended_df])
 
 
-    return dfOut
\ No newline at end of file
+    return dfOut
+
+
+#============== Extract surge data ==============#
+def extractNSS(forecast=None, ds=None, nss_lat=None, nss_lon=None, cacheDir=None):
+
+    """
+    Extracts the surge forecast from the NSS output from the BoM.
+    The closest point on the NSS mesh to the point of interest is 
+    used (see nssPointIndeces). To extract several points at once,
+    use extractNSSPoints.
+
+    Inputs:
+    forecast: FEWS forecast object, can be a hotspot or regional
+      forecast. Defined in initializeRegional.py, initializeHotpsot.py,
+      class structure is provided in fewsForecast.py
+    ds: xarray dataset containing the netCDF storm surge output.
+    nss_lat: latitude of the point of interest where NSS surge forecast
+      will be extracted from.
+    nss_lon: ditto but for the longitude of the point
+    cacheDir: directory where the index for the NSS mesh is cached 
+      (see nssPointIndeces)
+
+    Output:
+    Returns a dataframe with the surge forecast time series at the
+    given point. 
+    """
+
+    # Select dataset by point of interest
+    ind = nssPointIndeces(ds=ds, lon=[nss_lon], lat=[nss_lat], cacheDir=cacheDir)
+    dfOut = extractNSSPoints(forecast=forecast, ds=ds, pointIndeces=ind, 
+                             columns=["surge (m)"])
+
+    return dfOut
+
+
+#============== Water levels for many profiles at once ==============#
+def regionalWatLevs(watlevSeries=None, surgeSeries=None):
+
+    """
+    Combines the astronomical tide and the storm surge for many profiles
+    (e.g. CoastSat transects) at once, into a single dataset with a 
+    "transect" dimension. 
+
+    Inputs:
+    watlevSeries: dataframe with the tide time series ("tide_m" column),
+      interpolated to the forecast time step (see interpSeries). 
+    surgeSeries: dataframe with the storm surge time series, one column per
+      profile, with the profile ids as column names (see extractNSSPoints),
+      interpolated to the forecast time step.
+
+    Output:
+    xarray dataset with the tide (time), the surge (time x transect) and the
+    total water level, rounded to 2 decimals (time x transect). Only the 
+    times that are in both the tide and surge time series are kept. Times
+    are in GMT/UTC.
+    """
+
+    # Keep times common to both the tide and the surge
+    times = watlevSeries.index.intersection(surgeSeries.index)
+    tide = watlevSeries.loc[times, 'tide_m'].to_numpy(dtype=np.float64)
+    surge = surgeSeries.loc[times].to_numpy(dtype=np.float64)
+    # Total water level for every profile at once
+    wl = (tide[:,np.newaxis] + surge).round(2)
+
+    # netCDF times can't be timezone-aware, they are stored in GMT/UTC
+    if times.tz is not None:
+        times = times.tz_convert(pytz.utc).tz_localize(None)
+    ds = xr.Dataset({"tide_m":(("time",), tide),
+                     "surge_m":(("time","transect"), surge),
+                     "wl_m":(("time","transect"), wl)},
+                    coords={"time":times.values,
+                            "transect":np.asarray(surgeSeries.columns).astype(str)})
+    ds["time"].attrs["timezone"] = "GMT/UTC"
+    ds["wl_m"].attrs["description"] = "Astronomical tide plus storm surge"
+
+    return ds
+
+
+def writeWatLevCSVs(ds=None, outDir=None):
+
+    """
+    Writes the water level forecast for each profile out to its own csv file,
+    [profile id]_wlFor.csv, from a dataset produced by regionalWatLevs.
+    """
+
+    times = pd.DatetimeIndex(ds["time"].values, name="time_gmt").tz_localize(pytz.utc)
+    wl = ds["wl_m"].values
+    for i, profileID in enumerate(ds["transect"].values):
+        dfOut = pd.DataFrame({"wl_m":wl[:,i]}, index=times)
+        dfOut.to_csv(os.path.join(outDir, '%s_wlFor.csv' % profileID))
+
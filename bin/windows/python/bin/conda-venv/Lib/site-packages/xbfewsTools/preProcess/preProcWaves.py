@@ -4,7 +4,11 @@ import pandas as pd
 import geopandas as gpd
 import xarray as xr
 from shapely.ops import nearest_points
+from scipy.spatial import cKDTree
+from . import spatialIndex
+from . import gridCache
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 #============== Read in Auswave mesh point locations ==============#
 def loadMeshPts(meshPts=None, epsg=None):
@@ -16,8 +20,8 @@ def loadMeshPts(meshPts=None, epsg=None):
 
     return gdf
 
-#============== Load Auswave output forecast name  ==============#
-def loadAuswave(forecast=None, wavesDir=None):
+#============== Auswave output forecast name  ==============#
+def auswaveFileName(forecast=None):
 
     # Parse date to match Auswave output naming convention
     bomDate = str(str(forecast.roundedTime.year)+
@@ -29,12 +33,73 @@ def loadAuswave(forecast=None, wavesDir=None):
     cityCode = forecast.waveCode
     fname = "%s.msh.%s.nc" % (cityCode,bomDT)
 
+    return fname
+
+#============== Load Auswave output forecast ==============#
+def loadAuswave(forecast=None, wavesDir=None):
+
     # Read in output
-    ausWavedf = os.path.join(wavesDir, fname)
+    ausWavedf = os.path.join(wavesDir, auswaveFileName(forecast=forecast))
     ds = xr.open_dataset(ausWavedf)
 
     return ds
 
+#============== Subset of the Auswave output ==============#
+def auswaveSubsetPath(ifile=None, name="subset", subsetDir=None):
+    """
+    Path of a subset of an Auswave output file (see subsetAuswave): the same
+    file name with "_[name]" added (e.g. the hotspot name), in subsetDir 
+    (defaults to the folder of the Auswave file).
+    """
+    if subsetDir is None:
+        subsetDir = os.path.dirname(ifile)
+    fname = os.path.splitext(os.path.basename(ifile))[0] + "_%s.nc" % name
+    return os.path.join(subsetDir, fname)
+
+def subsetAuswave(ifile=None, ofile=None, lon=None, lat=None, cacheDir=None, meshName="auswave"):
+    """
+    Extracts the nodes of the Auswave output nearest to the points of interest
+    (e.g. the XBeach boundary points in auswaveOutPts_[site].csv and the point
+    near the offshore buoy) into a small (time x node) netCDF file, so that the
+    mesh only has to be read and searched once, when it is downloaded (see 
+    retrieveAusWaves.py in the WaveDownload module). The subset keeps the same
+    variables and dimensions as the Auswave output, plus:
+        - source_node: index of each node on the full Auswave mesh
+        - query_lon, query_lat: the points the subset was made for, so that 
+          openAuswave can tell whether a point is in the subset
+    ifile: path to the Auswave output
+    ofile: path of the subset file
+    lon, lat: longitudes and latitudes of the points of interest
+    cacheDir, meshName: see extractAusWavePts
+    Returns ofile.
+    """
+    return spatialIndex.subsetMesh(ifile=ifile, ofile=ofile, lon=lon, lat=lat, dim="node",
+                                   indexFunc=_auswaveIndexFunc(cacheDir, meshName))
+
+def openAuswave(ifile=None, lon=None, lat=None, name="subset", subsetDir=None, create=False,
+                cacheDir=None, meshName="auswave"):
+    """
+    Opens an Auswave output file, reading the subset made when it was 
+    downloaded (see subsetAuswave) instead of the full file if the subset was
+    made for all of the given points.
+    ifile: path to the full Auswave output
+    lon, lat: longitudes and latitudes of the points that are going to be extracted
+    name, subsetDir: see auswaveSubsetPath
+    create: if True and there is no suitable subset, a subset is made for the
+            given points (e.g. when going through archived forecasts more than once)
+    cacheDir, meshName: see extractAusWavePts. Only used when making a subset.
+    Returns the xarray dataset, and True if it is the subset.
+    """
+    subsetFile = auswaveSubsetPath(ifile=ifile, name=name, subsetDir=subsetDir)
+    return spatialIndex.openSubset(ifile=ifile, subsetFile=subsetFile, lon=lon, lat=lat, dim="node",
+                                   indexFunc=_auswaveIndexFunc(cacheDir, meshName), create=create)
+
+def _auswaveIndexFunc(cacheDir=None, meshName="auswave"):
+    # Nearest node look-up used for the subsets (see spatialIndex.subsetMesh)
+    return lambda ds, lon, lat: spatialIndex.nearestNodes(lon=ds.longitude.values, lat=ds.latitude.values,
+                                                          queryLon=lon, queryLat=lat,
+                                                          cacheDir=cacheDir, name=meshName)
+
 def nearGeom(point, pts=None, gdfIn=None, outVar=None):
     """
     Finds the nearest point and returns the corresponding values.
@@ -59,24 +124,24 @@ def nearGeom(point, pts=None, gdfIn=None, outVar=None):
     else:
         raise
 
-def extractAusWavePts(ds=None, meshPts=None, epsg=None):
-
-    # Convert xarray dataset to geodataframe
-    dfPts = pd.DataFrame({"Lon":ds.longitude.values,
-                        "Lat":ds.latitude.values})
-    gdfPts = gpd.GeoDataFrame(dfPts, geometry=gpd.points_from_xy(dfPts.Lon,dfPts.Lat))
-    gdfPts.set_crs(epsg=int(epsg))
-
-    # unary union of the geomtries 
-    pts = gdfPts.geometry.unary_union
-    # Find the nearest geometries in Auswave output to "points of interest"
+def extractAusWavePts(ds=None, meshPts=None, epsg=None, cacheDir=None, name="auswave"):
+    """
+    Slices the Auswave output to the nodes nearest to the points of interest.
+    ds: xarray dataset of Auswave output
+    meshPts: GeoDataFrame of the points of interest (lon/lat)
+    epsg: epsg code of the Auswave output
+    cacheDir: directory where the nearest-node index for the Auswave mesh is 
+              saved, so that it is only built once per mesh (see spatialIndex.py). 
+              If None, the index is built in memory.
+    name: name of the mesh for the cached index, e.g. the Auswave city code
+    """
+    # Find the nearest nodes in Auswave output to "points of interest"
     # Return the old Auswave index value for slicing Auswave output
-
-    meshPts["oldIndex"] = meshPts.apply(lambda row: nearGeom(row.geometry, 
-                                                            pts=pts, 
-                                                            gdfIn=gdfPts, 
-                                                            outVar="index"), 
-                                                            axis=1)
+    meshPts["oldIndex"] = spatialIndex.nearestNodes(lon=ds.longitude.values,
+                                                   lat=ds.latitude.values,
+                                                   queryLon=meshPts.geometry.x.values,
+                                                   queryLat=meshPts.geometry.y.values,
+                                                   cacheDir=cacheDir, name=name)
     indArr = meshPts["oldIndex"].to_numpy()
     ds = ds.isel(node=indArr)
 
@@ -92,118 +157,127 @@ def getTimeStep(ds=None):
 
     return dt
 
+def _writeWaveFile(ofile=None, block=None, rowTemplate=None):
+    # Writes one wave file: a (time x hs/tp/dir) block, one row per time step
+    with open(ofile, "w") as f:
+        f.write((rowTemplate*block.shape[0]) % tuple(block.ravel().tolist()))
+
 def generateWaveFiles(ds=None, forecast=None,
                       jonSwapParam=3.3,dirSpread=10.,
-                      dtbc=1.):
-
+                      dtbc=1., boundaryDf=None, nWorkers=1):
+    """
+    Writes the XBeach wave boundary files (wavefile[n].txt, one for each node
+    in ds, in the same order) to forecast.xbWorkDir. Each file starts with the 
+    spin-up period, which repeats the first values of the forecast.
+    ds: xarray dataset of Auswave output, sliced to the XBeach boundary points
+        (see extractAusWavePts)
+    forecast: hotspotForecast object
+    jonSwapParam, dirSpread, dtbc: JONSWAP parameters, the same for every file
+    boundaryDf: locations of the wave files on the XBeach grid (see 
+                moveWavestoBoundary). If given, loclist.txt is written too.
+    nWorkers: number of threads writing the files
+    Returns the list of wave file names.
+    """
     dt = getTimeStep(ds=ds)
     # Round to 3 decimal places
     roundDec = 3
-    for index in np.arange(0,ds.sizes['node']):
-        # Extract the wave parameters for each point from forecast
-        dfOut = pd.DataFrame({"Datetime_gmt":ds.time[:].values,
-                             "Hsig":ds.hs[:,0].values.round(roundDec),
-                             "Tp":ds.tp[:,0].values.round(roundDec),
-                             "dir":ds.dir[:,0].values.round(roundDec),
-                             "JS":jonSwapParam,
-                             "dirSpread":dirSpread,
-                             "dt_sec":dt.round(roundDec),
-                             "dtbc":dtbc}).set_index("Datetime_gmt")
-        dfOut.index = pd.to_datetime(dfOut.index)
-        # Add 12-hour spin-up timeseries that retains the first values
-        # of the wave forecast
-        spinUpTime = forecast.spinUpWindow # in hours
-        spinUpEndTime = forecast.roundedTime
-        spinUpStartTime = spinUpEndTime-(spinUpTime)
-        spinUp_series = pd.date_range(start=spinUpStartTime,
-                                end=spinUpEndTime-timedelta(seconds=dt),
-                                freq=timedelta(seconds=dt))
-        spinUp_df = pd.DataFrame({"Datetime_gmt":spinUp_series,
-                                  "Hsig":dfOut['Hsig'][0],
-                                  "Tp":dfOut['Tp'][0],
-                                  "dir":dfOut['dir'][0],
-                                  "JS":dfOut['JS'][0],
-                                  "dirSpread":dfOut['dirSpread'][0],
-                                  "dt_sec":dfOut['dt_sec'][0],
-                                  "dtbc":dfOut['dtbc'][0]}).set_index("Datetime_gmt")
-        spinUp_df.index = pd.to_datetime(spinUp_df.index)
-        # Concatenate spin-up timeseries with real timeseries
-        dfOut = pd.concat([spinUp_df,dfOut])
-
-        ofileName = "wavefile%s.txt" % (index+1)
-        dfOut.to_csv(os.path.join(forecast.xbWorkDir,ofileName), 
-                    sep='\t', header=False, index=False)
+
+    # Wave parameters of every node at once (node x time x hs/tp/dir)
+    waves = np.stack([ds[var].transpose("node","time").values.astype(np.float64).round(roundDec)
+                      for var in ["hs","tp","dir"]], axis=-1)
+
+    # Add 12-hour spin-up timeseries that retains the first values
+    # of the wave forecast. The spin-up period is the same for every node.
+    spinUpTime = forecast.spinUpWindow # in hours
+    spinUpEndTime = forecast.roundedTime
+    spinUpStartTime = spinUpEndTime-(spinUpTime)
+    spinUp_series = pd.date_range(start=spinUpStartTime,
+                            end=spinUpEndTime-timedelta(seconds=dt),
+                            freq=timedelta(seconds=dt))
+    spinUp = np.repeat(waves[:,:1,:], len(spinUp_series), axis=1)
+    waves = np.concatenate([spinUp,waves], axis=1)
+
+    # Each row is Hsig, Tp, dir, then the parameters that are the same for 
+    # every row (JONSWAP parameter, directional spreading, time step of the
+    # forecast, and dtbc), tab-separated
+    constants = "\t".join(str(float(c)) for c in [jonSwapParam, dirSpread, dt.round(roundDec), dtbc])
+    rowTemplate = "%s\t%s\t%s\t" + constants + "\n"
+
+    # Wave file names
+    if boundaryDf is not None:
+        fileNames = boundaryDf["wavefile"].tolist()
+    else:
+        fileNames = ["wavefile%s.txt" % (index+1) for index in np.arange(0,ds.sizes['node'])]
+    ofiles = [os.path.join(forecast.xbWorkDir,ofileName) for ofileName in fileNames]
+
+    # Write the files
+    if nWorkers > 1:
+        with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+            list(executor.map(lambda i: _writeWaveFile(ofiles[i], waves[i], rowTemplate),
+                              range(len(ofiles))))
+    else:
+        for i in range(len(ofiles)):
+            _writeWaveFile(ofiles[i], waves[i], rowTemplate)
+
+    # Export the locations of the wave time series 
+    # forcing to XBeach-friendly input file
+    if boundaryDf is not None:
+        with open(os.path.join(forecast.xbWorkDir, "loclist.txt"), 'w') as fp:
+            fp.write('LOCLIST\n')
+            fp.write("".join("%s %s %s\n" % row for row in 
+                             zip(boundaryDf["xtarget"], boundaryDf["ytarget"], boundaryDf["wavefile"])))
+
+    return fileNames
 
 
 def moveWavestoBoundary(meshPts=None, 
                         forecast=None):
-
-    # Load XBeach input files
-    xgrd = np.loadtxt(forecast.xgrdPath)
-    ygrd = np.loadtxt(forecast.ygrdPath)
-    zgrd = np.loadtxt(forecast.zgrdPath)
+    """
+    Places each of the Auswave output points on the seaward boundary of the
+    XBeach grid (first column), in the row of the boundary node closest to it.
+    The boundary nodes are put in a KD-tree and all of the points are looked up
+    in one go, rather than searching the whole grid point by point.
+    meshPts: GeoDataFrame of the Auswave output points (lon/lat), with "ind"
+             and "wavefile" columns (see preprocessMain.py)
+    forecast: hotspotForecast object
+    Returns a DataFrame of the points with their position on the boundary
+    (xtarget, ytarget, as ints), and the number of columns and rows of the grid.
+    """
+    # Load XBeach input files (from their binary cache, see gridCache.py)
+    xgrd = gridCache.loadGrid(forecast.xgrdPath)
+    ygrd = gridCache.loadGrid(forecast.ygrdPath)
+    zgrd = gridCache.loadGrid(forecast.zgrdPath)
 
     # (np.array.shape commands returns rows, columns in that order)
     ncolXB = xgrd.shape[1]
     nrowXB = xgrd.shape[0]
-    nx = np.arange(0,nrowXB)
-    nx = np.repeat(nx,ncolXB)
-    ny = np.arange(0,ncolXB)
-    ny = np.tile(ny,nrowXB)
-    xbgdf = pd.DataFrame({'globalx':xgrd.flatten(),
-                           'globaly':ygrd.flatten(),
-                           'zb':zgrd.flatten()})
-    xbgdf['nx'] = nx
-    xbgdf['ny'] = ny
-    xbgdf = xbgdf.set_index(['nx','ny'])
-
-    # Convert to geodataframe to do point searching
-    #xbgdf = xbds.to_dataframe()
-    #print(xbgdf.head())
-    xbgdf = gpd.GeoDataFrame(xbgdf, geometry=gpd.points_from_xy(xbgdf.globalx,xbgdf.globaly))
+    # First column, starting from seaward boundary
+    targetCol = 0
     xbEPSG = int(forecast.xbeachEPSG)
-    xbgdf.set_crs(xbEPSG)
 
-    # Using points of interest (now in ds), find closest points on XBeach mesh,
-    # return value of index in XBeach output
     # Reproject points to projection used in XBeach
     gdf_proj = meshPts.copy()
     gdf_proj.set_crs(epsg=forecast.auswaveEPSG, inplace=True)
     gdf_proj['geometry'] = gdf_proj['geometry'].to_crs(epsg=xbEPSG)
-    # unary union of the geomtries 
-    pts = xbgdf.geometry.unary_union
-    gdf_proj["xbIndex"] = gdf_proj.apply(lambda row: 
-                     nearGeom(row.geometry, pts=pts, gdfIn=xbgdf, outVar="index"), axis=1)
-
-
-    # Grab the index in the relevant row, first column
-    # Column indeces go up starting from seaward points
-    # Split xbeach indeces into separate rows, cols
-    indList = gdf_proj.xbIndex.tolist()
-    gdf_proj[["xbcol","xbrow"]] = pd.DataFrame(indList, index=gdf_proj.index)
-    gdf_proj['targetCol'] = 0 # First column, starting from seaward boundary
-    gdf_proj['targetRow'] = gdf_proj.xbrow
-
-    # Grab relevant geometries from XBeach grid using target indeces
-    # Slice by desired cols first
-    #gdf_proj['targetX'] = xbgdf.loc[0]
-    targetColArr = gdf_proj['targetCol'].values
-    targetRowArr = gdf_proj['targetRow'].values
-    targetInd = zip(targetColArr,targetRowArr)
-    xbgdf_subset = xbgdf.loc[targetInd]
-    xbgdf_subset['xtarget'] = xbgdf_subset.geometry.x
-    xbgdf_subset['ytarget'] = xbgdf_subset.geometry.y
-    # Round vals
-    xbgdf_subset = xbgdf_subset.round({'xtarget':2,'ytarget':2})
-    # Bring old index over for merging
-    xbgdf_subset['ind'] = gdf_proj['ind'].values
-
-    # Merge dfs
-    df = pd.merge(gdf_proj,xbgdf_subset,on="ind")
 
+    # Closest node on the seaward boundary to each point. Column indeces go up
+    # starting from seaward points, so the row of that node is the row the
+    # wave time series is placed in.
+    boundaryX = np.asarray(xgrd[:,targetCol], dtype=np.float64)
+    boundaryY = np.asarray(ygrd[:,targetCol], dtype=np.float64)
+    tree = cKDTree(np.column_stack((boundaryX, boundaryY)))
+    _, targetRow = tree.query(np.column_stack((gdf_proj.geometry.x.values,
+                                               gdf_proj.geometry.y.values)))
+
+    df = pd.DataFrame(gdf_proj)
+    df['targetRow'] = targetRow
+    df['targetCol'] = targetCol
+    df['globalx'] = boundaryX[targetRow]
+    df['globaly'] = boundaryY[targetRow]
+    df['zb'] = np.asarray(zgrd[targetRow,targetCol])
     # Round and convert coordinates to ints
-    df['xtarget'] = df['xtarget'].round(decimals=0).astype(int)
-    df['ytarget'] = df['ytarget'].round(decimals=0).astype(int)
+    df['xtarget'] = df['globalx'].round(2).round(decimals=0).astype(int)
+    df['ytarget'] = df['globaly'].round(2).round(decimals=0).astype(int)
 
     return df, ncolXB, nrowXB
 
@@ -0,0 +1,191 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+from ..fewsUtils import fewsUtils
+
+#====== Nearest-node look-ups on forecast meshes (Auswave, NSS) ======#
+# Finding the forecast node closest to each point of interest by building a
+# shapely unary_union of the whole mesh and searching it point by point is slow.
+# Instead, a KD-tree is built once for a given mesh and used to look up all of
+# the points of interest in one go. Lon/lat coordinates are converted to
+# x/y/z coordinates on a unit sphere before building the tree, so that the
+# nearest node is the nearest along the earth's surface rather than in degrees.
+# The tree can be saved to a cache directory, keyed on a name (e.g. the Auswave
+# city code) and a hash of the mesh coordinates, so that it only has to be built
+# again if the mesh changes.
+
+# Bump if the format of the cached index changes
+indexVersion = 1
+
+# Indexes already loaded in this Python session, keyed by cache file name
+_loadedIndexes = {}
+
+
+def lonLat2xyz(lon=None, lat=None):
+    """
+    Converts lon/lat (degrees) to x/y/z coordinates on a unit sphere.
+    Returns an (n, 3) numpy array.
+    """
+    lon = np.radians(np.asarray(lon, dtype=np.float64).ravel())
+    lat = np.radians(np.asarray(lat, dtype=np.float64).ravel())
+    cosLat = np.cos(lat)
+    return np.column_stack((cosLat*np.cos(lon), cosLat*np.sin(lon), np.sin(lat)))
+
+
+def meshHash(lon=None, lat=None):
+    """
+    Hash of the mesh coordinates. Two meshes with the same node locations,
+    in the same order, have the same hash.
+    """
+    h = hashlib.sha1()
+    h.update(str(indexVersion).encode())
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class meshIndex:
+
+    def __init__(self, lon=None, lat=None):
+        # Number of nodes in the mesh
+        self.nNodes = int(np.asarray(lon).size)
+        # Hash of the mesh coordinates the index was built for
+        self.meshHash = meshHash(lon=lon, lat=lat)
+        # KD-tree of the mesh nodes on the unit sphere
+        self.tree = cKDTree(lonLat2xyz(lon=lon, lat=lat))
+
+    def query(self, lon=None, lat=None):
+        """
+        Returns the indeces of the mesh nodes nearest to each of the query
+        points, as a numpy integer array.
+        """
+        _, ind = self.tree.query(lonLat2xyz(lon=lon, lat=lat))
+        return np.asarray(ind, dtype=np.int64)
+
+
+def loadMeshIndex(lon=None, lat=None, cacheDir=None, name="mesh"):
+    """
+    Loads the index for a mesh from the cache directory, or builds it (and saves
+    it to the cache directory) if it hasn't been built before.
+
+    INPUTS:
+        - lon, lat: coordinates of the mesh nodes (1D arrays)
+        - cacheDir: directory the index is saved in. If None, the index is only
+          kept in memory.
+        - name: name of the mesh, e.g. the Auswave city code ("SYD")
+
+    OUTPUTS:
+        - meshIndex instance
+    """
+    mHash = meshHash(lon=lon, lat=lat)
+    fname = "%s_%s.pkl" % (name, mHash[:16])
+    if fname in _loadedIndexes:
+        return _loadedIndexes[fname]
+
+    index = None
+    if cacheDir is not None:
+        cachePath = os.path.join(cacheDir, fname)
+        if os.path.exists(cachePath):
+            try:
+                with open(cachePath, "rb") as f:
+                    index = pickle.load(f)
+                if index.meshHash != mHash:
+                    index = None
+            # A corrupt/incompatible cache file is rebuilt
+            except Exception:
+                index = None
+
+    if index is None:
+        index = meshIndex(lon=lon, lat=lat)
+        if cacheDir is not None:
+            if not os.path.exists(cacheDir):
+                os.makedirs(cacheDir, exist_ok=True)
+            with fewsUtils.atomicWrite(cachePath, "wb") as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+
+    _loadedIndexes[fname] = index
+    return index
+
+
+def nearestNodes(lon=None, lat=None, queryLon=None, queryLat=None,
+                 cacheDir=None, name="mesh"):
+    """
+    Returns the indeces of the mesh nodes (lon, lat) nearest to each of the
+    query points (queryLon, queryLat). See loadMeshIndex for the other inputs.
+    """
+    index = loadMeshIndex(lon=lon, lat=lat, cacheDir=cacheDir, name=name)
+    return index.query(lon=queryLon, lat=queryLat)
+
+
+#====== Subsets of forecast files at the nodes nearest to points of interest ======#
+def subsetMesh(ifile=None, ofile=None, lon=None, lat=None, dim=None, indexFunc=None):
+    """
+    Extracts the mesh nodes of a forecast file (e.g. NSS, Auswave) nearest to
+    the points of interest into a small netCDF file, so that the full file only
+    has to be read and searched once. The subset keeps the same variables and
+    dimensions as the forecast file, plus:
+        - source_[dim]: index of each node on the full mesh
+        - query_lon, query_lat: the points the subset was made for, so that
+          openSubset can tell whether a point is in the subset
+
+    INPUTS:
+        - ifile: path to the forecast netCDF file
+        - ofile: path of the subset file
+        - lon, lat: longitudes and latitudes of the points of interest
+        - dim: name of the mesh node dimension, e.g. "point" (NSS) or "node"
+          (Auswave)
+        - indexFunc: function called as indexFunc(ds, lon, lat), returning the
+          index of the nearest node to each point (e.g. using nearestNodes)
+
+    OUTPUTS:
+        - ofile
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+
+    with xr.open_dataset(ifile) as ds:
+        # Each node only once, in mesh order
+        ind = np.unique(indexFunc(ds, lon, lat))
+        subset = ds.isel({dim:ind}).load()
+    subset["source_%s" % dim] = (dim, ind)
+    subset["query_lon"] = ("query", lon)
+    subset["query_lat"] = ("query", lat)
+    subset.attrs["source_file"] = os.path.basename(ifile)
+    with fewsUtils.atomicWrite(ofile) as tmpFile:
+        subset.to_netcdf(tmpFile)
+    return ofile
+
+
+def openSubset(ifile=None, subsetFile=None, lon=None, lat=None, dim=None, indexFunc=None,
+               create=False):
+    """
+    Opens a forecast file, reading its subset (see subsetMesh) instead of the
+    full file if the subset is newer than the forecast file and was made for
+    all of the given points.
+
+    INPUTS:
+        - ifile: path to the full forecast netCDF file
+        - subsetFile: path of the subset
+        - lon, lat: longitudes and latitudes of the points that are going to
+          be extracted
+        - dim, indexFunc: see subsetMesh. Only used when making a subset.
+        - create: if True and there is no suitable subset, a subset is made
+          for the given points
+
+    OUTPUTS:
+        - ds: xarray dataset
+        - isSubset: True if ds is the subset
+    """
+    if os.path.exists(subsetFile) and os.path.getmtime(subsetFile) >= os.path.getmtime(ifile):
+        ds = xr.open_dataset(subsetFile)
+        queries = set(zip(ds["query_lon"].values.tolist(), ds["query_lat"].values.tolist()))
+        if all((float(x), float(y)) in queries for x, y in zip(lon, lat)):
+            return ds, True
+        ds.close()
+    if create:
+        subsetMesh(ifile=ifile, ofile=subsetFile, lon=lon, lat=lat, dim=dim, indexFunc=indexFunc)
+        return xr.open_dataset(subsetFile), True
+    return xr.open_dataset(ifile), False